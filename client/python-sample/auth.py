@@ -1,26 +1,80 @@
 import base64
+import json
+import os
+import time
 import requests
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, x25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
 
+LEASE_FILE = 'license.lease'
 
-def authentication(public_key, api_key, serial, hwid):
+
+def x25519_encrypt(public_key, plaintexts):
+    """
+    Encrypts the payload for products that use X25519 keys:
+    ephemeral public key (32 bytes) | nonce (12 bytes) | AES-256-GCM ciphertext
+    """
+    ephemeral_key = x25519.X25519PrivateKey.generate()
+    raw = (serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+    ephemeral_public = ephemeral_key.public_key().public_bytes(*raw)
+    aes_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=ephemeral_public + public_key.public_bytes(*raw),
+                   info=b'license-key-manager/x25519').derive(ephemeral_key.exchange(public_key))
+    nonce = os.urandom(12)
+    return ephemeral_public + nonce + AESGCM(aes_key).encrypt(nonce, plaintexts, None)
+
+
+def _b64url_decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def check_lease(public_key, serial, hwid, lease_file=LEASE_FILE):
     """
-    Connects to the server and authenticates the license
+    Verifies the offline lease stored by a previous validation.
+    Returns True if the lease was signed by the product, belongs to this serial/device and has not expired.
+    Only RSA products issue leases.
     """
+    if not os.path.exists(lease_file):
+        return False
+    try:
+        with open(lease_file, 'r', encoding='utf-8') as f:
+            body, signature = f.read().strip().split('.')
+        public_key.verify(_b64url_decode(signature), body.encode('ascii'),
+                          padding.PKCS1v15(), hashes.SHA256())
+        claims = json.loads(_b64url_decode(body))
+    except Exception:
+        return False
+
+    return (claims.get('serialKey') == serial and claims.get('hardwareID') == hwid
+            and claims.get('leaseExpiry', 0) > time.time())
+
+
+def authentication(public_key, api_key, serial, hwid, lease_file=LEASE_FILE):
+    """
+    Connects to the server and authenticates the license.
+    The server is only contacted when there is no valid offline lease for this device.
+    """
+    if check_lease(public_key, serial, hwid, lease_file):
+        print("Authentication: LEASE")
+        return True
+
     plaintexts = bytes(serial + ':' + hwid, 'utf-8')
 
-    if isinstance(public_key, rsa.RSAPublicKey):
+    if isinstance(public_key, (rsa.RSAPublicKey, x25519.X25519PublicKey)):
 
-        payload = public_key.encrypt(
-            plaintexts,
-            padding.OAEP(
-                mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                algorithm=hashes.SHA256(),
-                label=None
+        if isinstance(public_key, x25519.X25519PublicKey):
+            payload = x25519_encrypt(public_key, plaintexts)
+        else:
+            payload = public_key.encrypt(
+                plaintexts,
+                padding.OAEP(
+                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                    algorithm=hashes.SHA256(),
+                    label=None
+                )
             )
-        )
         # "9XAG0-OMRZ8-ZYZPT-5AHYO:CPU0_BFEBFBFF000806C1_ToBeFilledByO.E.M."
         #print(plaintexts)
         final_payload = base64.b64encode(payload).decode('utf-8')
@@ -30,13 +84,19 @@ def authentication(public_key, api_key, serial, hwid):
             "apiKey": api_key, "payload": final_payload
         }, timeout=10)
 
-        response_code = server_request.json()['Code']
+        response = server_request.json()
+        response_code = response['Code']
         success_codes=['OKAY', 'SUCCESS']
 
         if any(response_code in i for i in success_codes):
             print(f"Authentication: {response_code}")
+            if response.get('Lease'):
+                with open(lease_file, 'w', encoding='utf-8') as f:
+                    f.write(response['Lease'])
             return True
 
+        if os.path.exists(lease_file):
+            os.remove(lease_file)
         print(f"Error: {response_code}")
         return False
 
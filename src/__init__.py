@@ -35,6 +35,64 @@ def create_app(testing=None, database=None):
     app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+    # Validation logs are buffered and written in batches by a background writer (see logsink.py)
+    app.config['VALIDATION_LOG_ASYNC'] = (testing is None or testing is False) and os.getenv(
+        "VALIDATION_LOG_ASYNC", "1") != "0"
+    app.config['VALIDATION_LOG_BATCH'] = int(os.getenv("VALIDATION_LOG_BATCH") or 200)
+    app.config['VALIDATION_LOG_INTERVAL'] = float(os.getenv("VALIDATION_LOG_INTERVAL") or 1.0)
+    app.config['VALIDATION_LOG_QUEUE'] = int(os.getenv("VALIDATION_LOG_QUEUE") or 10000)
+
+    # Lifetime (in seconds) of the signed offline leases returned by successful validations
+    app.config['LEASE_TTL'] = int(os.getenv("LEASE_TTL") or 86400)
+    # Lifetime (in seconds) of the session tokens that let clients skip the RSA payload on repeat checks
+    app.config['SESSION_TOKEN_TTL'] = int(os.getenv("SESSION_TOKEN_TTL") or 900)
+
+    # Short-lived cache of the validation results of already registered devices ('0' disables it). The stamp file
+    # lets the administrator actions of one gunicorn worker evict the caches of the other workers.
+    app.config['VALIDATION_CACHE_TTL'] = int(os.getenv("VALIDATION_CACHE_TTL") or 60)
+    app.config['VALIDATION_CACHE_SIZE'] = int(os.getenv("VALIDATION_CACHE_SIZE") or 10000)
+    app.config['VALIDATION_CACHE_STAMP'] = None if testing else os.path.abspath(database) + '.cache-stamp'
+
+    # Size of the process pool used to decrypt validation payloads ('0' disables it, 'auto' = one per core)
+    decryptWorkers = os.getenv("DECRYPT_WORKERS") or "0"
+    app.config['DECRYPT_WORKERS'] = 0 if testing else (
+        os.cpu_count() or 1) if decryptWorkers == "auto" else int(decryptWorkers)
+    app.config['DECRYPT_TIMEOUT'] = float(os.getenv("DECRYPT_TIMEOUT") or 10.0)
+
+    # PRAGMAs applied to every SQLite connection (see pragmas.py)
+    app.config['SQLITE_JOURNAL_MODE'] = None if testing else os.getenv("SQLITE_JOURNAL_MODE") or "WAL"
+    app.config['SQLITE_SYNCHRONOUS'] = os.getenv("SQLITE_SYNCHRONOUS") or "NORMAL"
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv("SQLITE_BUSY_TIMEOUT") or 5000)  # milliseconds
+    app.config['SQLITE_CACHE_SIZE'] = int(os.getenv("SQLITE_CACHE_SIZE") or -65536)  # negative = KiB (64 MiB)
+    app.config['SQLITE_MMAP_SIZE'] = int(os.getenv("SQLITE_MMAP_SIZE") or 268435456)  # bytes (256 MiB)
+    app.config['SQLITE_FOREIGN_KEYS'] = os.getenv("SQLITE_FOREIGN_KEYS") or "ON"
+    # Incremental auto_vacuum lets the maintenance job return free pages to the filesystem (new databases only)
+    app.config['SQLITE_AUTO_VACUUM'] = os.getenv("SQLITE_AUTO_VACUUM") or "INCREMENTAL"
+    app.config['SQLITE_ANALYSIS_LIMIT'] = int(os.getenv("SQLITE_ANALYSIS_LIMIT") or 1000)  # rows sampled per index
+    app.config['SQLITE_VACUUM_PAGES'] = int(os.getenv("SQLITE_VACUUM_PAGES") or 1000)  # pages freed per run
+    # Prints the query plan of every distinct SELECT (development diagnostic, see queryplan.py)
+    app.config['SQLITE_EXPLAIN'] = os.getenv("SQLITE_EXPLAIN", "0") == "1"
+
+    # Largest number of licenses created by a single request (see licensebatch.py)
+    app.config['LICENSE_BATCH_MAX'] = int(os.getenv("LICENSE_BATCH_MAX") or 500000)
+
+    # Periodic maintenance jobs, run by a single worker at a time (see scheduler.py). Intervals are in seconds
+    # and '0' disables a job.
+    app.config['SCHEDULER_ENABLED'] = (testing is None or testing is False) and os.getenv(
+        "SCHEDULER_ENABLED", "1") != "0"
+    app.config['SCHEDULER_TICK'] = int(os.getenv("SCHEDULER_TICK") or 30)
+    app.config['SCHEDULER_LEASE'] = int(os.getenv("SCHEDULER_LEASE") or 900)
+    app.config['JOB_EXPIRY_SWEEP_INTERVAL'] = int(os.getenv("JOB_EXPIRY_SWEEP_INTERVAL") or 3600)
+    app.config['JOB_VALIDATION_STATS_INTERVAL'] = int(os.getenv("JOB_VALIDATION_STATS_INTERVAL") or 3600)
+    app.config['JOB_OPTIMIZE_INTERVAL'] = int(os.getenv("JOB_OPTIMIZE_INTERVAL") or 86400)
+    # The retention job moves the validation logs older than VALIDATION_LOG_RETENTION_DAYS to one gzip NDJSON file
+    # per day in VALIDATION_LOG_ARCHIVE_DIR (see archive.py). It is disabled when no directory is set.
+    app.config['JOB_RETENTION_INTERVAL'] = int(os.getenv("JOB_RETENTION_INTERVAL") or 86400)
+    app.config['VALIDATION_LOG_RETENTION_DAYS'] = int(os.getenv("VALIDATION_LOG_RETENTION_DAYS") or 90)
+    app.config['VALIDATION_LOG_RETENTION_CHUNK'] = int(os.getenv("VALIDATION_LOG_RETENTION_CHUNK") or 5000)
+    app.config['VALIDATION_LOG_ARCHIVE_DIR'] = None if testing else os.getenv("VALIDATION_LOG_ARCHIVE_DIR", os.path.join(
+        os.path.dirname(os.path.abspath(database)), 'archive'))
+
     db.init_app(app)
 
     login_manager = LoginManager()
@@ -56,6 +114,18 @@ def create_app(testing=None, database=None):
     # blueprint for non-auth parts of app
     app.register_blueprint(main_blueprint)
 
+    from . import logsink, decryptpool, validationcache, pragmas, queryplan, exports, scheduler  # pylint: disable=C0415
+    from . import archive, licensebatch  # pylint: disable=C0415
+    pragmas.init_app(app)
+    queryplan.init_app(app)
+    logsink.init_app(app)
+    decryptpool.init_app(app)
+    validationcache.init_app(app)
+    exports.init_app(app)
+    archive.init_app(app)
+    licensebatch.init_app(app)
+    scheduler.init_app(app)
+
     with app.app_context():
         # Extrair o caminho do arquivo do URI do SQLite
         db_path = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
@@ -65,31 +135,13 @@ def create_app(testing=None, database=None):
             if db_dir and not exists(db_dir):
                 os.makedirs(db_dir, exist_ok=True)
         
-        # Verificar se o banco existe e se tem as colunas necessárias
-        needs_recreate = False
-        if exists(db_path):
-            try:
-                # Verificar se as novas colunas existem
-                from sqlalchemy import inspect
-                inspector = inspect(db.engine)
-                columns = [col['name'] for col in inspector.get_columns('key')]
-                required_columns = ['expirytype', 'expirydays', 'activationdate']
-                if not all(col in columns for col in required_columns):
-                    print("Database schema outdated. Recreating database...", flush=True)
-                    needs_recreate = True
-            except Exception as e:
-                print(f"Error checking database schema: {e}. Recreating database...", flush=True)
-                needs_recreate = True
-        else:
-            needs_recreate = True
-        
-        # Recriar o banco se necessário
-        if needs_recreate:
-            if exists(db_path):
-                db.drop_all()
-            db.create_all()
-            print("Database created successfully with new schema.", flush=True)
-        
+        # Criar o banco ou aplicar as migrações pendentes (normalmente apenas uma consulta à versão do esquema)
+        from . import migrations  # pylint: disable=C0415
+        migrations.upgrade()
+
+        pragmas.report(app)
+        scheduler.registerJobs()
+
         from . import database_api as DBAPI  # pylint: disable=C0415
         DBAPI.generateUser(os.getenv("ADMINUSERNAME"), os.getenv(
             "ADMINPASSWORD"), os.getenv("ADMINEMAIL"))
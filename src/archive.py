@@ -0,0 +1,116 @@
+import gzip
+import json
+import os
+import re
+import shutil
+from datetime import datetime, timezone
+
+# validationlogs-YYYY-MM-DD.ndjson.gz, one file per day (UTC)
+_FILE_PATTERN_ = re.compile(r'^validationlogs-(\d{4})-(\d{2})-(\d{2})\.ndjson\.gz$')
+
+
+class ValidationLogArchive:
+    """
+        Cold storage of the validation logs removed from the database by the retention job (see
+        database_api.archiveValidationLogs): one gzip NDJSON file per day, holding one JSON object per log.
+
+        - A file is only ever replaced as a whole (written next to it and renamed), so readers never see a partial
+          file. Logs added to a day that is already archived are appended to it as a new gzip member.
+        - The logs are deleted from the database only after their file is on disk: a run interrupted in between
+          is completed by the next one, which skips the logs the file already holds (see 'lastID').
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, day):
+        return os.path.join(self.directory, datetime.fromtimestamp(day, timezone.utc).strftime(
+            'validationlogs-%Y-%m-%d.ndjson.gz'))
+
+    def days(self):
+        """
+            UTC midnight timestamps of the archived days, in ascending order.
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        days = []
+        for name in names:
+            match = _FILE_PATTERN_.match(name)
+            if match:
+                days.append(int(datetime(*map(int, match.groups()), tzinfo=timezone.utc).timestamp()))
+        return sorted(days)
+
+    def lastID(self, day):
+        """
+            Highest log id stored in the file of 'day' (0 when the day is not archived).
+        """
+        return max((row['id'] for row in self._readDay(day)), default=0)
+
+    def append(self, day, chunks):
+        """
+            Adds the logs in 'chunks' (lists of rows, as returned by database_api.streamValidationLogs) to the file
+            of 'day'. The file is synced to disk before this returns. Returns the number of logs written.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(day)
+        temporary = path + '.tmp'
+        if os.path.exists(path):
+            shutil.copyfile(path, temporary)
+        count = 0
+        with open(temporary, 'ab') as output:
+            with gzip.GzipFile(fileobj=output, mode='wb') as member:
+                for rows in chunks:
+                    member.write(''.join(json.dumps(dict(row._mapping)) + '\n' for row in rows).encode('utf-8'))
+                    count += len(rows)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temporary, path)
+        return count
+
+    def read(self, filters=None, newestFirst=False):
+        """
+            Yields the archived logs (as dicts) that match 'filters', oldest first (or newest first, holding one
+            day in memory to sort it). Only the files of the days within the range are opened, as the logs are
+            consumed. 'filters' may hold: result, type, apiKey, serialKey, timestampStart and timestampEnd.
+        """
+        filters = filters or {}
+        start, end = filters.get('timestampStart'), filters.get('timestampEnd')
+        expected = {name: filters[name] for name in ('result', 'type', 'apiKey', 'serialKey') if filters.get(name)}
+        days = self.days()
+        for day in reversed(days) if newestFirst else days:
+            if (start is not None and day + 86400 <= start) or (end is not None and day > end):
+                continue
+            rows = (row for row in self._readDay(day)
+                    if (start is None or row['timestamp'] >= start) and (end is None or row['timestamp'] <= end)
+                    and all(row[name] == value for name, value in expected.items()))
+            if newestFirst:
+                rows = sorted(rows, key=lambda row: (row['timestamp'], row['id']), reverse=True)
+            yield from rows
+
+    # ##########################################################################
+
+    def _readDay(self, day):
+        try:
+            with gzip.open(self.path(day), 'rt', encoding='utf-8') as lines:
+                for line in lines:
+                    yield json.loads(line)
+        except FileNotFoundError:
+            return
+
+
+logArchive = None
+
+
+def init_app(app):
+    global logArchive  # pylint: disable=W0603
+    directory = app.config['VALIDATION_LOG_ARCHIVE_DIR']
+    logArchive = ValidationLogArchive(directory) if directory else None
+
+
+def readValidationLogs(filters=None, newestFirst=False):
+    """
+        Archived logs that match 'filters' (see ValidationLogArchive.read); none when archiving is not configured.
+    """
+    return logArchive.read(filters, newestFirst) if logArchive is not None else iter(())
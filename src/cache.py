@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class BoundedCache:
+    """
+        Small process-wide LRU cache shared by the hot request paths.
+        Entries may carry an optional time-to-live (in seconds); once the TTL runs out the entry
+        behaves as if it had never been stored. The cache never grows beyond 'maxsize' entries.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expiresAt = entry
+            if expiresAt is not None and expiresAt <= monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expiresAt = None if ttl is None else monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (value, expiresAt)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def evict(self, predicate):
+        """
+            Removes every entry whose key satisfies 'predicate'.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,12 +1,61 @@
-from .models import Product, Key, Changelog, Registration, User, Client, Validationlog
-from sqlalchemy import desc
+from .models import Product, Key, Changelog, Registration, User, Client, Validationlog, ValidationStat, MaintenanceJob
+from sqlalchemy import and_, bindparam, case, func, select, text, tuple_
+from sqlalchemy.exc import OperationalError
 from werkzeug.security import generate_password_hash
-from . import db
+from . import archive, db, validationcache
+from .keys import invalidate_private_key
+from collections import Counter, namedtuple
+from itertools import groupby
 from time import time
 from datetime import datetime
+import os
 import sys
 
 
+# Compact, immutable view of a Product used by the validation endpoints
+ProductRecord = namedtuple('ProductRecord', ['id', 'name', 'privateK'])
+
+# License Key row joined with its product name and the Registration of the validating device (if any)
+ValidationContext = namedtuple('ValidationContext', ['id', 'productid', 'productname', 'serialkey', 'maxdevices',
+                                                     'devices', 'status', 'expirydate', 'expirytype', 'expirydays',
+                                                     'activationdate', 'registrationid'])
+
+# License Key row joined with the name of its customer and the hardware IDs of its registered devices
+LicenseRow = namedtuple('LicenseRow', ['id', 'productid', 'clientid', 'serialkey', 'maxdevices', 'devices', 'status',
+                                       'expirydate', 'expirytype', 'expirydays', 'activationdate', 'name', 'hwids'])
+
+# Columns the paginated license listing can be sorted by (the pages are keyed on (column, id))
+LICENSE_SORT_COLUMNS = ('id', 'serialkey', 'expirydate')
+
+# Entity kinds of the full-text search index (see migrations._searchIndex)
+SEARCH_KINDS = ('customer', 'product', 'license', 'device')
+# 'id' is the id of the customer, product or license (devices point to the license they are registered on)
+SearchResult = namedtuple('SearchResult', ['kind', 'id', 'productid', 'label'])
+
+# Cleared in every gunicorn worker when a product changes (through the stamp file of validationcache.py)
+_API_KEY_CACHE_ = validationcache.SharedCache(maxsize=int(os.getenv("APIKEY_CACHE_SIZE") or 1024),
+                                              ttl=int(os.getenv("APIKEY_CACHE_TTL") or 300),
+                                              stamp=validationcache.stamp)
+_API_KEY_NEGATIVE_TTL_ = int(os.getenv("APIKEY_NEGATIVE_TTL") or 30)
+_MISSING_ = object()
+
+# Outcomes of 'claimSeat'
+SEAT_CLAIMED = 'CLAIMED'        # The device was linked to the license
+SEAT_REGISTERED = 'REGISTERED'  # The device was already linked to the license
+SEAT_FULL = 'FULL'              # The license has no free seats left (or is revoked)
+
+
+def commitSession():
+    """
+        Commits the changes staged by functions that were called with 'commit=False'.
+    """
+    db.session.commit()
+
+
+def rollbackSession():
+    db.session.rollback()
+
+
 # //////////////////////////////////////////////////////////////////////////////
 # ///////////  Admin Section ///////////////////////////////////////////////////
 # //////////////////////////////////////////////////////////////////////////////
@@ -69,6 +118,8 @@ def getProduct(productName):
     """ 
         The following function queries the database for a given product. If you wish to extract ALL 
         products, the productName should be '_ALL_'
+        Every product whose name contains 'productName' is returned (the typeahead uses 'search' instead, which
+        matches the start of the words and returns the best matches only).
     """
     if(productName == '_ALL_'):
         return Product.query.all()
@@ -98,6 +149,7 @@ def createProduct(name, category, image, details, privateK, publicK, apiK):
                          details=details, privateK=privateK, publicK=publicK, apiK=apiK)
     db.session.add(newProduct)
     db.session.commit()
+    _API_KEY_CACHE_.clear()
     return newProduct
 
 
@@ -111,6 +163,8 @@ def editProduct(productid, name, category, image, details):
     product.image = image
     product.details = details
     db.session.commit()
+    invalidate_private_key(productid)
+    _API_KEY_CACHE_.clear()
 
 
 def deleteProduct(productid):
@@ -122,12 +176,42 @@ def deleteProduct(productid):
     if product is not None:
         db.session.delete(product)
         db.session.commit()
+        invalidate_private_key(productid)
+        _API_KEY_CACHE_.clear()
+        validationcache.evictProduct(productid)
 
 
 def getProductThroughAPI(apiKey):
     return Product.query.filter_by(apiK=apiKey).first()
 
 
+def getProductRecordThroughAPI(apiKey):
+    """
+        Resolves an API Key into a ProductRecord (or None), going through an in-memory cache first.
+        Unknown keys are cached as well, for a shorter period, so bogus keys do not reach the database.
+    """
+    record = _API_KEY_CACHE_.get(apiKey, _MISSING_)
+    if record is not _MISSING_:
+        return record
+
+    row = db.session.query(Product.id, Product.name, Product.privateK).filter(
+        Product.apiK == apiKey).first()
+    if row is None:
+        _API_KEY_CACHE_.set(apiKey, None, ttl=_API_KEY_NEGATIVE_TTL_)
+        return None
+    record = ProductRecord(row.id, row.name, row.privateK)
+    _API_KEY_CACHE_.set(apiKey, record)
+    return record
+
+
+def getProductKeyRecords():
+    """
+        Returns a ProductRecord for every product (used to warm the private-key caches).
+    """
+    return [ProductRecord(row.id, row.name, row.privateK)
+            for row in db.session.query(Product.id, Product.name, Product.privateK).all()]
+
+
 def resetProductCheck(productid):
     productObj = getProductByID(productid)
     productObj.lastchecked = 0
@@ -147,29 +231,146 @@ def resetProductCheck(productid):
 def getKeys(productID):
     """
         The following function queries the database for all keys belonging to a product. The product
-        is identified by an ID. Returns Key objects with client name joined, and registrations accessible.
-    """
-    from sqlalchemy.orm import joinedload
-    keys = Key.query.filter_by(productid=productID).options(
-        joinedload(Key.registrations)
-    ).all()
-    
-    # Para cada key, adicionar o nome do cliente
+        is identified by an ID. Returns LicenseRow tuples (the key's columns, the client name and the
+        hardware IDs of its registrations), all fetched with a single query.
+    """
+    keyTable, clientTable, registrationTable = Key.__table__, Client.__table__, Registration.__table__
+    keyColumns = LicenseRow._fields[:-2]
+    rows = db.session.execute(
+        select(*[keyTable.c[column] for column in keyColumns], clientTable.c.name, registrationTable.c.hardwareID)
+        .select_from(keyTable.outerjoin(clientTable, clientTable.c.id == keyTable.c.clientid)
+                     .outerjoin(registrationTable, registrationTable.c.keyID == keyTable.c.id))
+        .where(keyTable.c.productid == productID)
+        .order_by(keyTable.c.id))
+
     result = []
-    for key in keys:
-        client = Client.query.filter_by(id=key.clientid).first()
-        # Criar um objeto que combine os dados da key com o nome do cliente
-        key.name = client.name if client else 'Desconhecido'
-        result.append(key)
-    
+    for _, keyRows in groupby(rows, key=lambda row: row[0]):
+        keyRows = list(keyRows)
+        first = keyRows[0]
+        result.append(LicenseRow(*first[:len(keyColumns)],
+                                 first[len(keyColumns)] or 'Desconhecido',
+                                 tuple(row[-1] for row in keyRows if row[-1] is not None)))
     return result
 
 
+def getKeyCount(productID):
+    return Key.query.filter_by(productid=productID).count()
+
+
+def queryLicensePage(productID, filters=None, sort='id', descending=False, after=None, limit=50):
+    """
+        Returns one page of the licenses of a product as (rows, nextCursor, total), using keyset pagination.
+        - 'filters' may hold: status, clientid, serialPrefix, hardwareID (prefix of a registered device),
+          expiresFrom / expiresTo (licenses that never expire are left out of the range) and
+          expiryType ('0' fixed date, '1' days after activation, 'perpetual').
+        - 'after' is the (sort value, id) cursor of the last row of the previous page. 'nextCursor' is the
+          cursor of the last row returned, or None on the last page.
+        - 'total' counts every matching license, and is only computed for the first page (None otherwise).
+        Rows are LicenseRow tuples. Every page costs one query for the keys and one for their hardware IDs.
+    """
+    keyTable, clientTable, registrationTable = Key.__table__, Client.__table__, Registration.__table__
+    filters = filters or {}
+    conditions = [keyTable.c.productid == productID]
+    if filters.get('status') is not None:
+        conditions.append(keyTable.c.status == filters['status'])
+    if filters.get('clientid') is not None:
+        conditions.append(keyTable.c.clientid == filters['clientid'])
+    if filters.get('serialPrefix'):
+        # Prefix ranges (instead of LIKE) can be answered by the index of the column
+        conditions.append(and_(keyTable.c.serialkey >= filters['serialPrefix'],
+                               keyTable.c.serialkey < filters['serialPrefix'] + '\uffff'))
+    if filters.get('hardwareID'):
+        conditions.append(keyTable.c.id.in_(select(registrationTable.c.keyID).where(and_(
+            registrationTable.c.hardwareID >= filters['hardwareID'],
+            registrationTable.c.hardwareID < filters['hardwareID'] + '\uffff'))))
+    if filters.get('expiresFrom') is not None:
+        conditions.append(and_(keyTable.c.expirydate > 0, keyTable.c.expirydate >= filters['expiresFrom']))
+    if filters.get('expiresTo') is not None:
+        conditions.append(and_(keyTable.c.expirydate > 0, keyTable.c.expirydate <= filters['expiresTo']))
+    if filters.get('expiryType') == 'perpetual':
+        conditions.append(and_(keyTable.c.expirytype == 0, keyTable.c.expirydate == 0))
+    elif filters.get('expiryType') == '0':
+        conditions.append(and_(keyTable.c.expirytype == 0, keyTable.c.expirydate > 0))
+    elif filters.get('expiryType') == '1':
+        conditions.append(keyTable.c.expirytype == 1)
+
+    total = None
+    if after is None:
+        total = db.session.execute(select(func.count()).select_from(keyTable).where(and_(*conditions))).scalar()
+
+    sortColumn = keyTable.c[sort]
+    pageConditions = list(conditions)
+    if after is not None:
+        if sort == 'id':
+            pageConditions.append(keyTable.c.id < after[1] if descending else keyTable.c.id > after[1])
+        elif descending:
+            pageConditions.append(tuple_(sortColumn, keyTable.c.id) < tuple_(after[0], after[1]))
+        else:
+            pageConditions.append(tuple_(sortColumn, keyTable.c.id) > tuple_(after[0], after[1]))
+    ordering = [sortColumn.desc(), keyTable.c.id.desc()] if descending else [sortColumn, keyTable.c.id]
+    if sort == 'id':
+        ordering = ordering[:1]
+
+    keyColumns = LicenseRow._fields[:-2]
+    rows = db.session.execute(
+        select(*[keyTable.c[column] for column in keyColumns], clientTable.c.name)
+        .select_from(keyTable.outerjoin(clientTable, clientTable.c.id == keyTable.c.clientid))
+        .where(and_(*pageConditions))
+        .order_by(*ordering)
+        .limit(limit + 1)).fetchall()
+    hasMore = len(rows) > limit
+    rows = rows[:limit]
+
+    hwids = {}
+    if rows:
+        for keyID, hardwareID in db.session.execute(
+                select(registrationTable.c.keyID, registrationTable.c.hardwareID)
+                .where(registrationTable.c.keyID.in_([row[0] for row in rows]))):
+            hwids.setdefault(keyID, []).append(hardwareID)
+
+    page = [LicenseRow(*row[:len(keyColumns)], row[len(keyColumns)] or 'Desconhecido', tuple(hwids.get(row[0], ())))
+            for row in rows]
+    nextCursor = (getattr(page[-1], sort), page[-1].id) if hasMore else None
+    return page, nextCursor, total
+
+
+def getKeysBySerialKeys(serialKeys):
+    """
+        Fetches every License Key whose serial is in 'serialKeys' with a single query.
+        Returns a dictionary indexed by serial key.
+    """
+    if not serialKeys:
+        return {}
+    return {key.serialkey: key for key in Key.query.filter(Key.serialkey.in_(list(serialKeys))).all()}
+
+
 def getKeysBySerialKey(serialKey, productID):
-    print(f'Request with ID: {productID}, Serial: {serialKey}')
     return Key.query.filter_by(serialkey=serialKey, productid=productID).first()
 
 
+def getValidationContext(productID, serialKey, hardwareID):
+    """
+        Fetches everything a validation needs in a single Core query: the License Key row (including its current
+        device count), the name of its product and the id of the Registration of 'hardwareID' (None if the device
+        is not registered yet). Returns a lightweight ValidationContext tuple, or None if the serial key does not
+        belong to the product.
+    """
+    keyTable, productTable, registrationTable = Key.__table__, Product.__table__, Registration.__table__
+    statement = select(
+        keyTable.c.id, keyTable.c.productid, productTable.c.name, keyTable.c.serialkey, keyTable.c.maxdevices,
+        keyTable.c.devices, keyTable.c.status, keyTable.c.expirydate, keyTable.c.expirytype, keyTable.c.expirydays,
+        keyTable.c.activationdate, registrationTable.c.id
+    ).select_from(
+        keyTable.join(productTable, productTable.c.id == keyTable.c.productid).outerjoin(
+            registrationTable, and_(registrationTable.c.keyID == keyTable.c.id,
+                                    registrationTable.c.hardwareID == bindparam('hardwareID')))
+    ).where(keyTable.c.serialkey == bindparam('serialKey')).where(keyTable.c.productid == bindparam('productID'))
+
+    row = db.session.execute(statement, {'productID': productID, 'serialKey': serialKey,
+                                         'hardwareID': hardwareID}).first()
+    return None if row is None else ValidationContext(*row)
+
+
 def createKey(productid, clientid, serialkey, maxdevices, expiryDate, expiryType=0, expiryDays=None):
     """
         Creates a new License Key and stores it in the database.
@@ -178,22 +379,85 @@ def createKey(productid, clientid, serialkey, maxdevices, expiryDate, expiryType
     """
     newKey = Key(productid=productid, clientid=clientid, serialkey=serialkey,
                  maxdevices=maxdevices, devices=0, status=0, expirydate=expiryDate,
-                 expirytype=expiryType, expirydays=expiryDays, activationdate=None)
+                 expirytype=expiryType, expirydays=expiryDays, activationdate=None,
+                 effectiveexpiry=effectiveExpiry(expiryDate, expiryType))
     db.session.add(newKey)
     db.session.commit()
     return newKey.id
 
 
+def existingSerialKeys(serials, chunkSize=5000):
+    """
+        Returns the set of 'serials' that are already assigned to a license, with one indexed query per
+        'chunkSize' serial keys.
+    """
+    keyTable = Key.__table__
+    serials = list(serials)
+    existing = set()
+    for start in range(0, len(serials), chunkSize):
+        existing.update(db.session.execute(select(keyTable.c.serialkey).where(
+            keyTable.c.serialkey.in_(serials[start:start + chunkSize]))).scalars())
+    return existing
+
+
+def createKeys(productid, clientid, serialBatches, maxdevices, expiryDate, expiryType=0, expiryDays=None, user=None):
+    """
+        Creates License Keys in bulk, one transaction per list of serial keys in 'serialBatches': the keys and their
+        'CreatedKey' changelog entries (authored by 'user', if any) are written with one multi-row statement each.
+        Yields the (id, serialkey) rows of every batch once it is committed, so the caller can report progress and
+        knows which keys exist if a later batch fails.
+    """
+    keyTable, logTable = Key.__table__, Changelog.__table__
+    effectiveexpiry = effectiveExpiry(expiryDate, expiryType)
+    userid, username = (user.id, user.name) if user is not None else (None, '')
+    createdKeys = select(keyTable.c.id, keyTable.c.serialkey).where(
+        keyTable.c.serialkey.in_(bindparam('serials', expanding=True))).order_by(keyTable.c.id)
+    for serials in serialBatches:
+        if not serials:
+            continue
+        try:
+            db.session.execute(keyTable.insert(), [
+                {'productid': productid, 'clientid': clientid, 'serialkey': serial, 'maxdevices': maxdevices,
+                 'devices': 0, 'status': 0, 'expirydate': expiryDate, 'expirytype': expiryType,
+                 'expirydays': expiryDays, 'activationdate': None, 'effectiveexpiry': effectiveexpiry}
+                for serial in serials])
+            # Without RETURNING, the ids are read back through the unique index of the serial keys
+            rows = db.session.execute(createdKeys, {'serials': list(serials)}).fetchall()
+            timestamp = int(time())
+            db.session.execute(logTable.insert(), [
+                {'keyID': keyID, 'userid': userid, 'timestamp': timestamp, 'action': 'CreatedKey',
+                 'description': f"$${username}$$ created license #{keyID} for product #{productid}"}
+                for keyID, _ in rows])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        yield rows
+
+
+def effectiveExpiry(expiryDate, expiryType=0):
+    """
+        Effective expiry of a license that was not activated yet: the fixed date, or None when it never expires
+        or when it expires a number of days after its activation (it is set by 'claimSeat' in that case).
+    """
+    if int(expiryType or 0) == 1 or not expiryDate:
+        return None
+    return int(expiryDate)
+
+
 def setKeyState(keyid, newState):
     specificKey = Key.query.filter_by(id=keyid).first()
     specificKey.status = int(newState)
     db.session.commit()
+    validationcache.evictSerial(specificKey.serialkey)
 
 
 def deleteKey(keyid):
     keyS = Key.query.filter_by(id=keyid).first()
+    serialKey = keyS.serialkey
     db.session.delete(keyS)
     db.session.commit()
+    validationcache.evictSerial(serialKey)
 
 
 def resetKey(keyid):
@@ -202,6 +466,7 @@ def resetKey(keyid):
     specificKey.status = 0
     specificKey.devices = 0
     db.session.commit()
+    validationcache.evictSerial(specificKey.serialkey)
 
 
 def getKeyData(keyid):
@@ -209,9 +474,8 @@ def getKeyData(keyid):
 
 
 def getKeyStatistics():
-    activated = Key.query.filter_by(status=1).count()
-    awaitingApproval = Key.query.filter_by(status=0).count()
-    return activated, awaitingApproval
+    counts = dict(db.session.query(Key.status, func.count()).filter(Key.status.in_([0, 1])).group_by(Key.status).all())
+    return counts.get(1, 0), counts.get(0, 0)
 
 
 def getKeyAndClient(keyid):
@@ -224,43 +488,57 @@ def getKeyAndClient(keyid):
 
 
 def updateKeyStatesFromProduct(productid):
+    """
+        Marks the licenses of the product that reached their expiry date as expired (status 3), once a day.
+        A single UPDATE covers both expiry models through 'effectiveexpiry', and the partial index on
+        (productid, effectiveexpiry) of the licenses not yet expired makes it read only the ones past due.
+    """
     product = Product.query.filter_by(id=productid).first()
     dtUpperBound = (datetime.fromtimestamp(int(time()))).replace(
         hour=0, minute=0, second=0, microsecond=0)
-    currentMidnight = datetime.timestamp(dtUpperBound)
+    currentMidnight = int(datetime.timestamp(dtUpperBound))
     if(product.lastchecked >= currentMidnight):
         print("Already checked!")
         return
-    else:
-        print("Not yet checked.")
-        licenseList = Key.query.filter_by(productid=productid).all()
-        for licenseEntry in licenseList:
-            if licenseEntry.expirydate == 0:
-                continue
-            
-            # Verificar expiração baseado no tipo
-            expiryType = getattr(licenseEntry, 'expirytype', 0)
-            expiryDays = getattr(licenseEntry, 'expirydays', None)
-            activationDate = getattr(licenseEntry, 'activationdate', None)
-            
-            if expiryType == 1 and expiryDays is not None:
-                # Modelo de dias: só verifica se já foi ativada
-                if activationDate is not None:
-                    calculatedExpiry = activationDate + (expiryDays * 86400)
-                    if currentMidnight >= calculatedExpiry:
-                        licenseEntry.status = 3
-            else:
-                # Modelo de data fixa (comportamento original)
-                if currentMidnight >= licenseEntry.expirydate:
-                    licenseEntry.status = 3
-        product.lastchecked = int(time())
+    print("Not yet checked.")
+    expired = _expireProductKeys(productid, currentMidnight)
+    product.lastchecked = int(time())
     db.session.commit()
+    if expired:
+        validationcache.evictProduct(productid)
 
 
-def applyExpirationState(keyid):
+def sweepExpiredKeys(deadline=None):
+    """
+        Marks the licenses of every product whose effective expiry is at or before 'deadline' (now by default) as
+        expired. Runs product by product, so each UPDATE uses the partial index and commits on its own.
+        Returns the number of licenses that expired.
+    """
+    deadline = int(time()) if deadline is None else deadline
+    total = 0
+    for (productid,) in db.session.query(Product.id).all():
+        expired = _expireProductKeys(productid, deadline)
+        db.session.commit()
+        if expired:
+            validationcache.evictProduct(productid)
+            total += expired
+    return total
+
+
+def _expireProductKeys(productid, deadline):
+    keyTable = Key.__table__
+    return db.session.execute(keyTable.update().where(and_(
+        keyTable.c.productid == productid,
+        keyTable.c.status != 3,
+        keyTable.c.effectiveexpiry <= deadline)).values(status=3)).rowcount
+
+
+def applyExpirationState(keyid, commit=True):
     keyObject = getKeyData(keyid)
     keyObject.status = 3
-    db.session.commit()
+    if commit:
+        db.session.commit()
+    validationcache.evictSerial(keyObject.serialkey)
     return keyObject
 
 
@@ -286,11 +564,24 @@ def getUserLogs(userid):
     return Changelog.query.filter_by(userid=userid).all()
 
 
-def queryLogs(userid, startdate, enddate):
-    if(userid is None):
-        return Changelog.query.filter(Changelog.timestamp >= startdate).filter(Changelog.timestamp <= enddate).order_by(desc(Changelog.timestamp)).all()
-    else:
-        return Changelog.query.filter(Changelog.userid == userid).filter(Changelog.timestamp >= startdate).filter(Changelog.timestamp <= enddate).order_by(desc(Changelog.timestamp)).all()
+def queryLogs(userid, startdate, enddate, after=None, limit=None):
+    """
+        Changelog entries of the interval (and of one administrator, unless 'userid' is None), newest first.
+        Returns the Core result, whose rows (id, userid, timestamp, description) are fetched from SQLite as they
+        are iterated. 'after' is the (timestamp, id) of the last entry of the previous page, and 'limit' caps
+        the number of rows.
+    """
+    logTable = Changelog.__table__
+    conditions = [logTable.c.timestamp >= startdate, logTable.c.timestamp <= enddate]
+    if(userid is not None):
+        conditions.append(logTable.c.userid == userid)
+    if(after is not None):
+        conditions.append(tuple_(logTable.c.timestamp, logTable.c.id) < tuple_(after[0], after[1]))
+    statement = select(logTable.c.id, logTable.c.userid, logTable.c.timestamp, logTable.c.description).where(
+        and_(*conditions)).order_by(logTable.c.timestamp.desc(), logTable.c.id.desc())
+    if(limit is not None):
+        statement = statement.limit(limit)
+    return db.session.execute(statement)
 
 
 # //////////////////////////////////////////////////////////////////////////////
@@ -302,6 +593,18 @@ def getRegistration(keyID, hardwareID):
     return Registration.query.filter_by(keyID=keyID, hardwareID=hardwareID).first()
 
 
+def getRegistrationPairs(keyIDs, hardwareIDs):
+    """
+        Returns the set of (keyID, hardwareID) pairs registered for the given keys and hardware IDs,
+        using a single query.
+    """
+    if not keyIDs or not hardwareIDs:
+        return set()
+    rows = db.session.query(Registration.keyID, Registration.hardwareID).filter(
+        Registration.keyID.in_(list(keyIDs))).filter(Registration.hardwareID.in_(list(hardwareIDs))).all()
+    return {(row.keyID, row.hardwareID) for row in rows}
+
+
 def getKeyHWIDs(keyID):
     return Registration.query.filter_by(keyID=keyID).all()
 
@@ -312,34 +615,87 @@ def deleteRegistrationsOfKey(keyID):
 
 
 def deleteRegistrationOfHWID(keyID, hardwareID):
-    reg = Registration.query.filter_by(
-        keyID=keyID, hardwareID=hardwareID).first()
-    db.session.delete(reg)
-    originalKey = getKeyData(keyID)
-    originalKey.devices = originalKey.devices - 1
+    registrationTable, keyTable = Registration.__table__, Key.__table__
+    removed = db.session.execute(registrationTable.delete().where(and_(
+        registrationTable.c.keyID == keyID, registrationTable.c.hardwareID == hardwareID))).rowcount
+    if not removed:
+        raise LookupError(f"Hardware ID '{hardwareID}' is not linked to license #{keyID}")
+    db.session.execute(keyTable.update().where(keyTable.c.id == keyID).values(
+        devices=keyTable.c.devices - removed))
+    serialKey = db.session.execute(select(keyTable.c.serialkey).where(keyTable.c.id == keyID)).scalar()
     db.session.commit()
+    validationcache.evictSerial(serialKey)
+    _expireKey(keyID)
 
 
-def addRegistration(keyID, hardwareID, keyObject):
-    # Add a new Registration that links a KeyID with an HardwareID
-    newDevice = Registration(keyID=keyID, hardwareID=hardwareID)
-    db.session.add(newDevice)
-
-    # Update the number of active devices of a license key and its state
-    newActiveDevices = keyObject.devices + 1
-    keyObject.devices = newActiveDevices
-    if(keyObject.status != 1):
-        keyObject.status = 1
-        # Se a licença está sendo ativada pela primeira vez e usa modelo de dias, salvar data de ativação
-        if keyObject.activationdate is None:
-            from time import time
-            keyObject.activationdate = int(time())
-            # Se for modelo de dias, calcular a data de expiração baseada na ativação
-            if keyObject.expirytype == 1 and keyObject.expirydays is not None:
-                keyObject.expirydate = keyObject.activationdate + (keyObject.expirydays * 86400)
-
-    # Submit all changes
-    db.session.commit()
+def claimSeat(keyID, hardwareID, commit=True):
+    """
+        Atomically links 'hardwareID' to the License Key 'keyID', taking one of its device seats.
+        Returns a (outcome, expirydate) pair, where outcome is SEAT_CLAIMED, SEAT_REGISTERED or SEAT_FULL.
+
+        Both checks are enforced by the database instead of Python, so concurrent first validations of the
+        same serial (several gunicorn workers) can neither exceed 'maxdevices' nor link a device twice:
+        - the Registration is inserted with 'INSERT OR IGNORE' against the unique (keyID, hardwareID) index;
+        - the seat is taken with a conditional 'UPDATE ... WHERE devices < maxdevices'. When no row matches,
+          the Registration inserted by this call is removed again.
+    """
+    registrationTable, keyTable = Registration.__table__, Key.__table__
+    db.session.flush()
+
+    inserted = db.session.execute(registrationTable.insert().prefix_with('OR IGNORE').values(
+        keyID=keyID, hardwareID=hardwareID)).rowcount
+    if not inserted:
+        outcome = SEAT_REGISTERED
+    else:
+        now = int(time())
+        # Se a licença está sendo ativada pela primeira vez, salvar data de ativação
+        # (e, no modelo de dias, calcular a data de expiração baseada na ativação)
+        firstActivation = and_(keyTable.c.status != 1,
+                               keyTable.c.activationdate.is_(None))
+        claimed = db.session.execute(keyTable.update().where(and_(
+            keyTable.c.id == keyID,
+            keyTable.c.devices < keyTable.c.maxdevices,
+            keyTable.c.status != 2)).values(
+            devices=keyTable.c.devices + 1,
+            status=1,
+            activationdate=case((firstActivation, now),
+                                else_=keyTable.c.activationdate),
+            expirydate=case((and_(firstActivation, keyTable.c.expirytype == 1, keyTable.c.expirydays.isnot(None)),
+                             now + keyTable.c.expirydays * 86400), else_=keyTable.c.expirydate),
+            effectiveexpiry=case((and_(firstActivation, keyTable.c.expirytype == 1, keyTable.c.expirydays.isnot(None)),
+                                  now + keyTable.c.expirydays * 86400), else_=keyTable.c.effectiveexpiry))).rowcount
+        if claimed:
+            outcome = SEAT_CLAIMED
+        else:
+            outcome = SEAT_FULL
+            db.session.execute(registrationTable.delete().where(and_(
+                registrationTable.c.keyID == keyID, registrationTable.c.hardwareID == hardwareID)))
+
+    expiryDate = db.session.execute(select(keyTable.c.expirydate).where(
+        keyTable.c.id == keyID)).scalar()
+    if commit:
+        db.session.commit()
+    _expireKey(keyID)
+    return outcome, expiryDate
+
+
+def addRegistration(keyID, hardwareID, keyObject=None, commit=True):
+    """
+        Links a KeyID with an HardwareID and updates the device count and state of the License Key (see 'claimSeat').
+        If 'keyObject' is not given, it is loaded (from the session's identity map when possible).
+        Returns the updated Key object.
+    """
+    claimSeat(keyID, hardwareID, commit)
+    if keyObject is None:
+        keyObject = Key.query.get(keyID)
+    return keyObject
+
+
+def _expireKey(keyID):
+    # Core statements bypass the ORM, so a Key already loaded in the session must be refreshed on next access
+    keyObject = db.session.identity_map.get(Key.__mapper__.identity_key_from_primary_key([keyID]))
+    if keyObject is not None:
+        db.session.expire(keyObject)
 
 
 # //////////////////////////////////////////////////////////////////////////////
@@ -368,18 +724,25 @@ def deleteCustomer(clientid):
     clientS = Client.query.filter_by(id=clientid).first()
     db.session.delete(clientS)
     db.session.commit()
+    validationcache.clear()
 
 
 def getCustomer(customerName):
     """ 
         The following function queries the database for a given customer. If you wish to extract ALL 
         customers, the customerName should be '_ALL_'
+        Every customer whose name contains 'customerName' is returned (the typeahead uses 'search' instead, which
+        matches the start of the words and returns the best matches only).
     """
     if(customerName == '_ALL_'):
         return Client.query.all()
     return Client.query.filter(Client.name.contains(customerName)).all()
 
 
+def getCustomerCount():
+    return Client.query.count()
+
+
 def getCustomerByID(customerID):
     """ 
         The following function queries the database for a given customer by their ID.
@@ -387,32 +750,301 @@ def getCustomerByID(customerID):
     return Client.query.filter_by(id=customerID).first()
 
 
+# //////////////////////////////////////////////////////////////////////////////
+# ///////////  Search Section //////////////////////////////////////////////////
+# //////////////////////////////////////////////////////////////////////////////
+
+
+def search(term, kinds=None, limit=10, productid=None):
+    """
+        Prefix (typeahead) search over customers (name, email, phone), products (name, category), license serial
+        keys and the hardware IDs of registered devices. Every word of 'term' must match the start of a word of
+        the entry. Returns up to 'limit' SearchResult tuples, best matches first. With 'productid', only the
+        entries of that product are returned (customers, which belong to no product, are kept).
+        The search uses the FTS5 index kept in sync by triggers; without FTS5 it falls back to prefix queries.
+    """
+    words = str(term or '').split()
+    kinds = [kind for kind in (kinds or SEARCH_KINDS) if kind in SEARCH_KINDS]
+    if not words or not kinds:
+        return []
+
+    query = ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+    productFilter = "" if productid is None else "AND (productid = :product OR productid IS NULL) "
+    statement = text("SELECT kind, refid, productid, label FROM search_index WHERE search_index MATCH :query "
+                     f"AND kind IN :kinds {productFilter}ORDER BY rank LIMIT :limit").bindparams(
+                         bindparam('kinds', expanding=True))
+    try:
+        rows = db.session.execute(statement, {'query': query, 'kinds': kinds, 'limit': limit,
+                                              'product': productid}).fetchall()
+    except OperationalError:
+        db.session.rollback()
+        return _searchByPrefix(' '.join(words), kinds, limit, productid)
+    return [SearchResult(*row) for row in rows]
+
+
+def _searchByPrefix(term, kinds, limit, productid=None):
+    keyTable, registrationTable = Key.__table__, Registration.__table__
+    sources = {
+        'customer': select(Client.id, Client.name).where(Client.name.like(term + '%')),
+        'product': select(Product.id, Product.name).where(Product.name.like(term + '%')),
+        'license': select(keyTable.c.id, keyTable.c.productid, keyTable.c.serialkey).where(
+            keyTable.c.serialkey.like(term + '%')),
+        'device': select(registrationTable.c.keyID, keyTable.c.productid, registrationTable.c.hardwareID).join(
+            keyTable, keyTable.c.id == registrationTable.c.keyID).where(registrationTable.c.hardwareID.like(term + '%')),
+    }
+    if productid is not None:
+        sources['product'] = sources['product'].where(Product.id == productid)
+        sources['license'] = sources['license'].where(keyTable.c.productid == productid)
+        sources['device'] = sources['device'].where(keyTable.c.productid == productid)
+    results = []
+    for kind in kinds:
+        for row in db.session.execute(sources[kind].limit(limit - len(results))):
+            if kind == 'customer':
+                results.append(SearchResult(kind, row[0], None, row[1]))
+            elif kind == 'product':
+                results.append(SearchResult(kind, row[0], row[0], row[1]))
+            else:
+                results.append(SearchResult(kind, row[0], row[1], row[2]))
+        if len(results) >= limit:
+            break
+    return results
+
+
 # //////////////////////////////////////////////////////////////////////////////
 # ///////////  Validation Logs /////////////////////////////////////////////////
 # //////////////////////////////////////////////////////////////////////////////
 
 
 def submitValidationLog(result, logtype, ipaddress, apiKey, serialKey, hardwareID):
-    newLog = Validationlog(timestamp=int(time()), result=result, type=logtype,
-                           ipaddress=ipaddress, apiKey=apiKey, serialKey=serialKey, hardwareID=hardwareID)
-    db.session.add(newLog)
-    db.session.commit()
+    submitValidationLogs([{'timestamp': int(time()), 'result': result, 'type': logtype, 'ipaddress': ipaddress,
+                           'apiKey': apiKey, 'serialKey': serialKey, 'hardwareID': hardwareID}])
 
 
-def queryValidationLogs(resultTarget=None, timestampStart=0, timestampEnd=sys.maxsize):
-    if(resultTarget is None):
-        return Validationlog.query.filter(Validationlog.timestamp >= timestampStart).filter(Validationlog.timestamp <= timestampEnd).all()
-    else:
-        return Validationlog.query.filter(Validationlog.result == resultTarget).filter(Validationlog.timestamp >= timestampStart).filter(Validationlog.timestamp <= timestampEnd).all()
+def submitValidationLogs(rows, commit=True):
+    """
+        Stores several validation logs at once, using a single multi-row INSERT and a single commit.
+        Each row is a dictionary with the columns of the Validationlog table.
+        The daily counters of the dashboard (ValidationStat) are updated in the same transaction.
+    """
+    if not rows:
+        return
+    db.session.execute(Validationlog.__table__.insert(), rows)
+    _rollupValidationLogs(rows)
+    if commit:
+        db.session.commit()
+
+
+def _rollupValidationLogs(rows):
+    apiKeys = {row['apiKey'] for row in rows}
+    productIDs = dict(db.session.query(Product.apiK, Product.id).filter(Product.apiK.in_(apiKeys)).all())
+    counts = Counter((_dayOf(row['timestamp']), productIDs.get(row['apiKey'], 0), row['result']) for row in rows)
+    db.session.execute(text(
+        "INSERT INTO validationstat (day, productid, result, count) VALUES (:day, :productid, :result, :count) "
+        "ON CONFLICT (day, productid, result) DO UPDATE SET count = count + excluded.count"),
+        [{'day': day, 'productid': productID, 'result': result, 'count': count}
+         for (day, productID, result), count in counts.items()])
+
+
+def _dayOf(timestamp):
+    return int(timestamp) - int(timestamp) % 86400
+
+
+def queryValidationLogs(resultTarget=None, timestampStart=0, timestampEnd=sys.maxsize, before=None, limit=None):
+    """
+        Validation logs of the interval (and of one result, unless 'resultTarget' is None), newest first. Yields the
+        rows of the table as they are fetched, then those of the days the retention job moved to the archive files,
+        one day at a time, so the archive is only read when the table runs out of rows before 'limit'. 'before' is
+        the (timestamp, id) of the last log of the previous page, and 'limit' caps the number of rows.
+    """
+    logTable = Validationlog.__table__
+    conditions = [logTable.c.timestamp >= timestampStart, logTable.c.timestamp <= timestampEnd]
+    if(resultTarget is not None):
+        conditions.append(logTable.c.result == resultTarget)
+    if(before is not None):
+        conditions.append(tuple_(logTable.c.timestamp, logTable.c.id) < tuple_(before[0], before[1]))
+    statement = select(logTable).where(and_(*conditions)).order_by(logTable.c.timestamp.desc(), logTable.c.id.desc())
+    if(limit is not None):
+        statement = statement.limit(limit)
+    result = db.session.execute(statement)
+    count = 0
+    try:
+        for row in result:
+            yield row
+            count += 1
+            before = (row.timestamp, row.id)
+    finally:
+        result.close()
+    if(limit is not None and count >= limit):
+        return
+
+    if(before is not None):
+        timestampEnd = min(timestampEnd, before[0])
+    archived = archive.readValidationLogs(
+        {'result': resultTarget, 'timestampStart': timestampStart, 'timestampEnd': timestampEnd}, newestFirst=True)
+    for row in archived:
+        if(before is not None and (row['timestamp'], row['id']) >= tuple(before)):
+            continue
+        yield Validationlog(**row)
+        count += 1
+        if(limit is not None and count >= limit):
+            return
+
+
+def streamValidationLogs(filters=None, chunkSize=5000):
+    """
+        Yields the validation logs that match 'filters' in lists of up to 'chunkSize' rows, oldest first. The rows
+        are read from the cursor as the chunks are consumed, so no more than one chunk is held in memory.
+        'filters' may hold: result, type, productid, serialKey, timestampStart, timestampEnd, afterID and untilID.
+    """
+    logTable, productTable = Validationlog.__table__, Product.__table__
+    filters = filters or {}
+    conditions = []
+    if filters.get('timestampStart') is not None:
+        conditions.append(logTable.c.timestamp >= filters['timestampStart'])
+    if filters.get('timestampEnd') is not None:
+        conditions.append(logTable.c.timestamp <= filters['timestampEnd'])
+    if filters.get('result'):
+        conditions.append(logTable.c.result == filters['result'])
+    if filters.get('type'):
+        conditions.append(logTable.c.type == filters['type'])
+    if filters.get('serialKey'):
+        conditions.append(logTable.c.serialKey == filters['serialKey'])
+    if filters.get('afterID') is not None:
+        conditions.append(logTable.c.id > filters['afterID'])
+    if filters.get('untilID') is not None:
+        conditions.append(logTable.c.id <= filters['untilID'])
+    if filters.get('productid') is not None:
+        # The logs reference the product through the API key the client sent
+        conditions.append(logTable.c.apiKey == select(productTable.c.apiK).where(
+            productTable.c.id == filters['productid']).scalar_subquery())
+
+    # Ordered by timestamp only, which the index returns without sorting the whole range first
+    result = db.session.execute(select(logTable).where(*conditions).order_by(logTable.c.timestamp)
+                                .execution_options(stream_results=True))
+    try:
+        for rows in result.partitions(chunkSize):
+            yield rows
+    finally:
+        result.close()
+
+
+def archiveValidationLogs(before, chunkSize=5000):
+    """
+        Moves the validation logs of the days (UTC) that ended before 'before' from the table to the archive
+        files (see archive.py), one day at a time: the logs of a day are written to its file, which is synced,
+        and only then deleted, in transactions of at most 'chunkSize' rows so the write lock is never held for
+        long. The daily counters (validationstat) are kept. Returns the number of logs moved.
+    """
+    logArchive = archive.logArchive
+    if logArchive is None:
+        return 0
+    cutoff = _dayOf(before)
+    moved = 0
+    oldest = db.session.execute(text("SELECT MIN(timestamp) FROM validationlog")).scalar()
+    while oldest is not None and _dayOf(oldest) < cutoff:
+        day = _dayOf(oldest)
+        bounds = {'start': day, 'end': day + 86400}
+        lastID = db.session.execute(text(
+            "SELECT MAX(id) FROM validationlog WHERE timestamp >= :start AND timestamp < :end"), bounds).scalar()
+        # Logs a previous, interrupted run already wrote to the file are only deleted
+        archivedID = logArchive.lastID(day)
+        if lastID > archivedID:
+            moved += logArchive.append(day, streamValidationLogs(
+                {'timestampStart': day, 'timestampEnd': day + 86399, 'afterID': archivedID, 'untilID': lastID},
+                chunkSize))
+        db.session.commit()
+        while db.session.execute(text(
+                "DELETE FROM validationlog WHERE id IN (SELECT id FROM validationlog WHERE timestamp >= :start "
+                "AND timestamp < :end AND id <= :last LIMIT :limit)"),
+                dict(bounds, last=lastID, limit=chunkSize)).rowcount:
+            db.session.commit()
+        db.session.commit()
+        oldest = db.session.execute(text("SELECT MIN(timestamp) FROM validationlog WHERE timestamp >= :end"),
+                                    bounds).scalar()
+    return moved
 
 
 def queryValidationsStats():
     """
-        The following function extracts the validation stats from the last 30 days.
-        To achieve this, the current timestamp is reduced by 2592000 seconds (30 days) and the time is
-        rounded down to midnight of the same day. The result will represent the lower bound for the search.
+        Number of successful and failed validations of the last 30 days (counted from midnight, UTC).
+        Reads the daily counters, so the cost depends on the number of days and not on the number of logs.
+    """
+    lowerBoundDay = _dayOf(int(time()) - 2592000)
+    counts = dict(db.session.query(ValidationStat.result, func.sum(ValidationStat.count)).filter(
+        ValidationStat.day >= lowerBoundDay).filter(ValidationStat.result.in_(['SUCCESS', 'ERROR'])).group_by(
+        ValidationStat.result).all())
+    return counts.get('SUCCESS', 0), counts.get('ERROR', 0)
+
+
+def rebuildValidationStats(sinceDay):
+    """
+        Recomputes the daily counters from 'sinceDay' (UTC midnight timestamp) onwards from the logs themselves,
+        in one transaction. Repairs counters that drifted, e.g. after logs were written or removed by hand.
+    """
+    statTable = ValidationStat.__table__
+    db.session.execute(statTable.delete().where(statTable.c.day >= sinceDay))
+    db.session.execute(text(
+        "INSERT INTO validationstat (day, productid, result, count) "
+        "SELECT validationlog.timestamp - validationlog.timestamp % 86400, coalesce(product.id, 0), "
+        "validationlog.result, COUNT(*) FROM validationlog LEFT JOIN product ON product.\"apiK\" = validationlog.\"apiKey\" "
+        "WHERE validationlog.timestamp >= :since GROUP BY 1, 2, 3"), {'since': sinceDay})
+    db.session.commit()
+
+
+def getDailyValidationStats(days=30, productID=None):
+    """
+        Validation counts per day (UTC) and result of the last 'days' days, optionally of a single product,
+        as (day, result, count) tuples ordered by day. Meant for the dashboard charts.
+    """
+    statTable = ValidationStat.__table__
+    conditions = [statTable.c.day >= _dayOf(int(time()) - days * 86400)]
+    if productID is not None:
+        conditions.append(statTable.c.productid == productID)
+    return db.session.execute(
+        select(statTable.c.day, statTable.c.result, func.sum(statTable.c.count)).where(*conditions)
+        .group_by(statTable.c.day, statTable.c.result).order_by(statTable.c.day)).fetchall()
+
+
+# //////////////////////////////////////////////////////////////////////////////
+# ///////////  Maintenance Jobs ////////////////////////////////////////////////
+# //////////////////////////////////////////////////////////////////////////////
+
+
+def registerJobs(names):
+    """
+        Makes sure every job has its state row (new jobs are due right away).
+    """
+    db.session.execute(text("INSERT OR IGNORE INTO maintenancejob (name, nextrun, runs) VALUES (:name, 0, 0)"),
+                       [{'name': name} for name in names])
+    db.session.commit()
+
+
+def acquireJobLease(name, owner, now, leaseTime, force=False):
+    """
+        Claims the lease of a job that is due (or of any job, with 'force') and not leased by a live worker.
+        The check and the claim are a single UPDATE, so only one worker gets it. Returns True on success.
+    """
+    jobTable = MaintenanceJob.__table__
+    conditions = [jobTable.c.name == name,
+                  (jobTable.c.leaseuntil.is_(None)) | (jobTable.c.leaseuntil < now)]
+    if not force:
+        conditions.append(jobTable.c.nextrun <= now)
+    acquired = db.session.execute(jobTable.update().where(and_(*conditions)).values(
+        leaseowner=owner, leaseuntil=now + leaseTime)).rowcount
+    db.session.commit()
+    return acquired == 1
+
+
+def finishJob(name, owner, startedAt, duration, result, nextRun):
     """
-    dtLowerBound = (datetime.fromtimestamp(int(time()) - 2592000)
-                    ).replace(hour=0, minute=0, second=0, microsecond=0)
-    lowerBoundTimestamp = datetime.timestamp(dtLowerBound)
-    return Validationlog.query.filter_by(result='SUCCESS').filter(Validationlog.timestamp >= lowerBoundTimestamp).count(), Validationlog.query.filter_by(result='ERROR').filter(Validationlog.timestamp >= lowerBoundTimestamp).count()
+        Records the run of a job and releases its lease.
+    """
+    jobTable = MaintenanceJob.__table__
+    db.session.execute(jobTable.update().where(and_(jobTable.c.name == name, jobTable.c.leaseowner == owner)).values(
+        leaseowner=None, leaseuntil=None, lastrun=startedAt, lastduration=duration, lastresult=result[:200],
+        runs=jobTable.c.runs + 1, nextrun=nextRun))
+    db.session.commit()
+
+
+def getJobs():
+    return MaintenanceJob.query.order_by(MaintenanceJob.name).all()
@@ -0,0 +1,150 @@
+import atexit
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import has_app_context
+from .keys import decrypt_data, get_private_key, sign_data
+
+# What the child processes receive instead of a Product (must be picklable)
+_KeyHandle = namedtuple('_KeyHandle', ['id', 'privateK'])
+
+
+class DecryptExecutor:
+    """
+        Runs 'decrypt_data' (and the lease signatures of 'sign_data') in a pool of worker processes.
+
+        The private-key decryption (or signature) is CPU-bound C code that never yields, so under gunicorn's gevent
+        workers it stalls every greenlet of the worker for the whole operation. Dispatching it to a
+        process pool keeps the event loop free (waiting on the future yields to other greenlets) and
+        lets validation throughput scale with the number of cores rather than with the gunicorn workers.
+
+        Each child keeps its own private-key cache, which is warmed with every product key when the
+        pool starts. The pool is created lazily in the process that uses it, so it is never inherited
+        through gunicorn's '--preload' fork.
+    """
+
+    def __init__(self, workers, timeout=10.0, loadKeys=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.loadKeys = loadKeys
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def decrypt(self, payload, product):
+        return self.submit(payload, product).result(timeout=self.timeout)
+
+    def sign(self, data, product):
+        return self._submit(_signInChild, data, product).result(timeout=self.timeout)
+
+    def decryptMany(self, requests):
+        """
+            Decrypts several (payload, product) pairs in parallel. Returns one entry per pair: either the
+            decrypted data or the exception raised while decrypting it.
+        """
+        futures = [self.submit(payload, product)
+                   for payload, product in requests]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=self.timeout))
+            except Exception as exp:
+                results.append(exp)
+        return results
+
+    def submit(self, payload, product):
+        return self._submit(_decryptInChild, payload, product)
+
+    def _submit(self, function, data, product):
+        try:
+            return self._getExecutor().submit(function, data, _KeyHandle(product.id, product.privateK))
+        except BrokenProcessPool:
+            self._executor = None
+            return self._getExecutor().submit(function, data, _KeyHandle(product.id, product.privateK))
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def _getExecutor(self):
+        if self._executor is not None and self._pid == os.getpid():
+            return self._executor
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                handles = [_KeyHandle(record.id, record.privateK)
+                           for record in (self.loadKeys() if self.loadKeys else [])]
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_warmKeys, initargs=(handles,))
+                self._pid = os.getpid()
+                atexit.register(self.shutdown)
+        return self._executor
+
+
+def _warmKeys(handles):
+    for handle in handles:
+        try:
+            get_private_key(handle)
+        except Exception:
+            pass
+
+
+def _decryptInChild(payload, handle):
+    return decrypt_data(payload, handle)
+
+
+def _signInChild(data, handle):
+    return sign_data(data, handle)
+
+
+executor = None
+
+
+def init_app(app):
+    global executor  # pylint: disable=W0603
+    executor = None
+    if app.config['DECRYPT_WORKERS'] > 0:
+        from . import database_api as DBAPI  # pylint: disable=C0415
+
+        def loadKeys():
+            if has_app_context():
+                return DBAPI.getProductKeyRecords()
+            with app.app_context():
+                return DBAPI.getProductKeyRecords()
+
+        executor = DecryptExecutor(app.config['DECRYPT_WORKERS'],
+                                   app.config['DECRYPT_TIMEOUT'], loadKeys)
+
+
+def decrypt(payload, product):
+    """
+        Decrypts a validation payload, in the process pool when one is configured ('DECRYPT_WORKERS').
+    """
+    if executor is None:
+        return decrypt_data(payload, product)
+    return executor.decrypt(payload, product)
+
+
+def decryptMany(requests):
+    if executor is None:
+        results = []
+        for payload, product in requests:
+            try:
+                results.append(decrypt_data(payload, product))
+            except Exception as exp:
+                results.append(exp)
+        return results
+    return executor.decryptMany(requests)
+
+
+def sign(data, product):
+    """
+        Signs a lease (see keys.sign_lease), in the process pool when one is configured ('DECRYPT_WORKERS').
+    """
+    if executor is None:
+        return sign_data(data, product)
+    return executor.sign(data, product)
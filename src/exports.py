@@ -0,0 +1,114 @@
+import click
+import csv
+import io
+import json
+import zlib
+from flask.cli import with_appcontext
+from itertools import islice
+from . import archive
+from . import database_api as DBAPI
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+VALIDATION_LOG_COLUMNS = ('id', 'timestamp', 'result', 'type', 'ipaddress', 'apiKey', 'serialKey', 'hardwareID')
+# Rows fetched from the database and encoded at a time
+_CHUNK_ROWS_ = 5000
+
+
+def exportValidationLogs(filters=None, exportFormat='ndjson', compress=False, chunkRows=_CHUNK_ROWS_):
+    """
+        Generates the validation logs that match 'filters' (see database_api.streamValidationLogs) as NDJSON
+        (one JSON object per line) or CSV (with a header row), in byte chunks ready to be sent or written.
+        With 'compress' the output is a gzip stream. Memory use is bounded by 'chunkRows', whatever the range.
+        The logs of the archived days (see archive.py) come first, then the ones still in the database.
+    """
+    if exportFormat not in EXPORT_FORMATS:
+        raise ValueError(exportFormat)
+    encode = csvLines if exportFormat == 'csv' else _ndjsonLines
+    # wbits=31 writes the gzip container (header and trailer) around the deflate stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def output(text):
+        data = text.encode('utf-8')
+        return compressor.compress(data) if compressor else data
+
+    if exportFormat == 'csv':
+        yield output(csvLines([VALIDATION_LOG_COLUMNS]))
+    for rows in _archivedRows(filters or {}, chunkRows):
+        data = output(encode(rows))
+        if data:
+            yield data
+    for rows in DBAPI.streamValidationLogs(filters, chunkRows):
+        data = output(encode(rows))
+        if data:
+            yield data
+    if compressor:
+        yield compressor.flush()
+
+
+def exportFileName(exportFormat, compress, suffix=''):
+    return f"validationlogs{suffix}.{exportFormat}" + ('.gz' if compress else '')
+
+
+def _archivedRows(filters, chunkRows):
+    filters = dict(filters)
+    productID = filters.pop('productid', None)
+    if productID is not None:
+        # The archived logs reference the product through the API key the client sent, as in the database
+        product = DBAPI.getProductByID(productID)
+        if product is None:
+            return
+        filters['apiKey'] = product.apiK
+    logs = archive.readValidationLogs(filters)
+    while True:
+        rows = [tuple(row[column] for column in VALIDATION_LOG_COLUMNS) for row in islice(logs, chunkRows)]
+        if not rows:
+            return
+        yield rows
+
+
+def _ndjsonLines(rows):
+    return ''.join(json.dumps(dict(zip(VALIDATION_LOG_COLUMNS, row))) + '\n' for row in rows)
+
+
+def csvLines(rows, asBytes=False):
+    """
+        Encodes 'rows' as CSV lines, as a string (or as UTF-8 bytes with 'asBytes').
+    """
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(rows)
+    return buffer.getvalue().encode('utf-8') if asBytes else buffer.getvalue()
+
+
+def outputOption(mode='wb', help="Output file ('-' for standard output)."):  # pylint: disable=W0622
+    """
+        The '--output' option of the commands that write files.
+    """
+    # Not standard output by default: the application prints its startup messages there
+    return click.option('--output', '-o', type=click.File(mode), required=True, help=help)
+
+
+@click.command('export-validation-logs')
+@click.option('--format', 'exportFormat', type=click.Choice(EXPORT_FORMATS), default='ndjson', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@outputOption()
+@click.option('--result', help='Only logs with this result (e.g. SUCCESS or ERROR).')
+@click.option('--type', 'logType', help='Only logs of this validation type.')
+@click.option('--product', type=int, help='Only logs of the product with this ID.')
+@click.option('--serial', help='Only logs of this serial key.')
+@click.option('--from', 'timestampStart', type=int, help='Start of the range (timestamp).')
+@click.option('--to', 'timestampEnd', type=int, help='End of the range (timestamp).')
+@with_appcontext
+def exportValidationLogsCommand(exportFormat, compress, output, result, logType, product, serial,
+                                timestampStart, timestampEnd):
+    """
+        Exports the validation logs as NDJSON or CSV.
+    """
+    filters = {'result': result, 'type': logType, 'productid': product, 'serialKey': serial,
+               'timestampStart': timestampStart, 'timestampEnd': timestampEnd}
+    for chunk in exportValidationLogs(filters, exportFormat, compress):
+        output.write(chunk)
+    output.flush()
+
+
+def init_app(app):
+    app.cli.add_command(exportValidationLogsCommand)
@@ -1,7 +1,6 @@
-from ..keys import generateSerialKey
-from flask import render_template, request
+from flask import current_app, render_template, request, Response, stream_with_context
 from flask_login import current_user
-from .. import database_api as DBAPI
+from .. import database_api as DBAPI, licensebatch
 from . import utils as Utils
 import json
 from time import time
@@ -42,7 +41,9 @@ def createLicense(productID, requestData):
         Creates a license (or multiple licenses) for the indicated productID and validates the data sent by the request (JSON format).
         The return comes in a JSON format, made out of a 'code' field and a 'message' field. The function will always return an error as a 'code' if the productID is invalid or does not exist, if the request data is also invalid or if an error occurs while handling the Database.
         
-        If 'quantity' is provided and greater than 1, multiple identical licenses will be created.
+        If 'quantity' is provided and greater than 1, multiple identical licenses will be created (up to LICENSE_BATCH_MAX),
+        in transactions of a few thousand licenses. With 'format' set to 'csv', the ids and serial keys of the new licenses
+        are streamed back as a CSV download while they are created.
     """
     adminAcc = current_user
     if((not str(productID).isnumeric()) or DBAPI.getProductByID(productID) is None):
@@ -60,8 +61,9 @@ def createLicense(productID, requestData):
         quantity = int(quantity)
         if quantity < 1:
             quantity = 1
-        if quantity > 100:
-            return json.dumps({'code': "ERROR", 'message': "A quantidade máxima de licenças por vez é 100."}), 500
+        if quantity > current_app.config['LICENSE_BATCH_MAX']:
+            return json.dumps({'code': "ERROR", 'message': "A quantidade máxima de licenças por vez é " +
+                               str(current_app.config['LICENSE_BATCH_MAX']) + "."}), 500
     except (ValueError, TypeError):
         quantity = 1
 
@@ -106,24 +108,31 @@ def createLicense(productID, requestData):
             if expiryDate <= int(time()):
                 return json.dumps({'code': "ERROR", 'message': "Entrada incorreta: \n- A data de expiração deve ser no futuro."}), 400
 
+    chunks = licensebatch.createLicenses(int(productID), int(client), quantity, int(maxDevices), expiryDate,
+                                         int(expiryType), expiryDays, adminAcc, progress=_logProgress)
+    if requestData.get('format') == 'csv':
+        fileName = 'licenses-' + str(productID) + '-' + str(int(time())) + '.csv'
+        return Response(stream_with_context(licensebatch.licensesCSV(chunks)), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=' + fileName})
+
+    created = 0
     try:
-        createdIds = []
-        for _ in range(quantity):
-            serialKey = generateSerialKey(20)
-            keyId = DBAPI.createKey(productID, int(
-                client), serialKey, int(maxDevices), expiryDate, int(expiryType), expiryDays)
-            createdIds.append(keyId)
-            DBAPI.submitLog(keyId, adminAcc.id, 'CreatedKey', '$$' + str(adminAcc.name) +
-                            '$$ created license #' + str(keyId) + ' for product #' + str(productID))
+        for rows in chunks:
+            created += len(rows)
     except Exception as exp:
         print(exp)
-        if createdIds:
-            return json.dumps({'code': "ERROR", 'message': f"Ocorreu um erro ao armazenar a Licença no banco de dados. {len(createdIds)} licença(s) foram criadas antes do erro."}), 500
+        if created:
+            return json.dumps({'code': "ERROR", 'message': f"Ocorreu um erro ao armazenar a Licença no banco de dados. {created} licença(s) foram criadas antes do erro."}), 500
         return json.dumps({'code': "ERROR", 'message': "Ocorreu um erro ao armazenar a Licença no banco de dados - #ERRO DESCONHECIDO!"}), 500
 
     return json.dumps({'code': "OKAY"}), 200
 
 
+def _logProgress(created, quantity):
+    if quantity > 1:
+        print(f"Created {created}/{quantity} license(s)", flush=True)
+
+
 def changeLicenseState(requestData):
     adminAcc = current_user
     licenseID = requestData.get('licenseID')
@@ -1,8 +1,16 @@
-from flask import render_template, request
-from .. import database_api as DBAPI
+from flask import render_template, request, Response, stream_with_context
+from .. import database_api as DBAPI, exports
+from . import utils as Utils
+from time import time
 import json
 import sys
 
+# Changelog and validation log entries per page (and the largest page a client may ask for)
+_LOG_PAGE_SIZE_ = 500
+_MAX_LOG_PAGE_SIZE_ = 5000
+# Entries serialized per chunk of the streamed response
+_STREAM_CHUNK_ = 100
+
 
 def displayChangelog():
     userList = DBAPI.obtainUser('_ALL_')
@@ -10,22 +18,51 @@ def displayChangelog():
 
 
 def queryLogs(requestData):
+    """
+        Streams one page of the changelog as JSON: {"code", "logs": [...], "next"}. Entries are sent newest first
+        while they are read from the database, so the memory used does not grow with the date range. The 'next'
+        cursor (sent last, null on the last page) is passed back as 'cursor' to get the following page.
+    """
     adminID = None if int(requestData.get('adminid')) == - \
         1 else int(requestData.get('adminid'))
     dateStart = 0 if int(requestData.get('datestart')) == - \
         1 else int(requestData.get('datestart'))
     dateEnd = sys.maxsize if int(requestData.get(
         'dateend')) == -1 else int(requestData.get('dateend'))
+    try:
+        limit = min(max(int(requestData.get('limit') or _LOG_PAGE_SIZE_), 1), _MAX_LOG_PAGE_SIZE_)
+        after = Utils.decodeCursor(requestData.get('cursor'))
+    except ValueError:
+        return json.dumps({'code': "ERROR", 'message': "A página indicada é inválida."}), 400
+    if(after is not None):
+        after = (int(after[0]), after[1])
+
+    # One extra row tells whether there is a next page
+    changelogs = DBAPI.queryLogs(adminID, dateStart, dateEnd, after, limit + 1)
+    return Response(stream_with_context(streamLogs(changelogs, limit)), mimetype='application/json')
 
-    changelogs = DBAPI.queryLogs(adminID, dateStart, dateEnd)
-    changelog = []
-    for log in changelogs:
-        changelog.append({
+
+def streamLogs(changelogs, limit):
+    yield '{"code": "OKAY", "logs": ['
+    chunk, separator, lastLog, nextCursor = [], '', None, None
+    for count, log in enumerate(changelogs):
+        if(count == limit):
+            nextCursor = Utils.encodeCursor((lastLog.timestamp, lastLog.id))
+            break
+        chunk.append(json.dumps({
+            'id': log.id,
             'adminid': log.userid,
             'timestamp': log.timestamp,
             'description': log.description
-        })
-    return json.dumps(changelog)
+        }))
+        lastLog = log
+        if(len(chunk) == _STREAM_CHUNK_):
+            yield separator + ','.join(chunk)
+            chunk, separator = [], ','
+    changelogs.close()
+    if(chunk):
+        yield separator + ','.join(chunk)
+    yield '], "next": ' + json.dumps(nextCursor) + '}'
 
 
 def displayValidationLog():
@@ -33,17 +70,37 @@ def displayValidationLog():
 
 
 def queryValidationLogs(requestData):
+    """
+        Streams one page of the validation logs as JSON: {"code", "logs": [...], "next"}, newest first, in the same
+        way as queryLogs. The archived days are only read once the page reaches past the logs still in the table.
+    """
     typeSearch = None if str(requestData.get('typeSearch')) == '' else str(
         requestData.get('typeSearch'))
     dateStart = 0 if int(requestData.get('datestart')) == - \
         1 else int(requestData.get('datestart'))
     dateEnd = sys.maxsize if int(requestData.get(
         'dateend')) == -1 else int(requestData.get('dateend'))
+    try:
+        limit = min(max(int(requestData.get('limit') or _LOG_PAGE_SIZE_), 1), _MAX_LOG_PAGE_SIZE_)
+        before = Utils.decodeCursor(requestData.get('cursor'))
+        if(before is not None):
+            before = (int(before[0]), before[1])
+    except (TypeError, ValueError):
+        return json.dumps({'code': "ERROR", 'message': "A página indicada é inválida."}), 400
+
+    # One extra row tells whether there is a next page
+    validationLogs = DBAPI.queryValidationLogs(typeSearch, dateStart, dateEnd, before, limit + 1)
+    return Response(stream_with_context(streamValidationLogs(validationLogs, limit)), mimetype='application/json')
 
-    validationLogs = DBAPI.queryValidationLogs(typeSearch, dateStart, dateEnd)
-    responseArray = []
-    for log in validationLogs:
-        responseArray.append({
+
+def streamValidationLogs(validationLogs, limit):
+    yield '{"code": "OKAY", "logs": ['
+    chunk, separator, lastLog, nextCursor = [], '', None, None
+    for count, log in enumerate(validationLogs):
+        if(count == limit):
+            nextCursor = Utils.encodeCursor((lastLog.timestamp, lastLog.id))
+            break
+        chunk.append(json.dumps({
             'timestamp': log.timestamp,
             'result': log.result,
             'type': log.type,
@@ -51,5 +108,39 @@ def queryValidationLogs(requestData):
             'apiKey': log.apiKey,
             'serialKey': log.serialKey,
             'hardwareID': log.hardwareID
-        })
-    return json.dumps(responseArray)
+        }))
+        lastLog = log
+        if(len(chunk) == _STREAM_CHUNK_):
+            yield separator + ','.join(chunk)
+            chunk, separator = [], ','
+    validationLogs.close()
+    if(chunk):
+        yield separator + ','.join(chunk)
+    yield '], "next": ' + json.dumps(nextCursor) + '}'
+
+
+def exportValidationLogs(requestData):
+    """
+        Streams the validation logs as a file download. Query string (all optional): format ('ndjson' or 'csv'),
+        gzip ('1'), result, type, product, serial, datestart and dateend.
+    """
+    exportFormat = requestData.get('format') or 'ndjson'
+    compress = requestData.get('gzip') in ('1', 'true')
+    try:
+        if(exportFormat not in exports.EXPORT_FORMATS):
+            raise ValueError(exportFormat)
+        filters = {
+            'result': requestData.get('result') or None,
+            'type': requestData.get('type') or None,
+            'productid': int(requestData['product']) if requestData.get('product') else None,
+            'serialKey': (requestData.get('serial') or '').strip() or None,
+            'timestampStart': int(requestData['datestart']) if requestData.get('datestart') not in (None, '', '-1') else None,
+            'timestampEnd': int(requestData['dateend']) if requestData.get('dateend') not in (None, '', '-1') else None
+        }
+    except ValueError:
+        return json.dumps({'code': "ERROR", 'message': "Os filtros da exportação são inválidos."}), 400
+
+    fileName = exports.exportFileName(exportFormat, compress, '-' + str(int(time())))
+    mimetype = 'application/gzip' if compress else 'text/csv' if exportFormat == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(exports.exportValidationLogs(filters, exportFormat, compress)),
+                    mimetype=mimetype, headers={'Content-Disposition': 'attachment; filename=' + fileName})
@@ -1,10 +1,14 @@
-from ..keys import create_product_keys
+from ..keys import create_product_keys, get_key_type, KEY_TYPES
 from flask import render_template, request
 from flask_login import current_user
-from .. import database_api as DBAPI
+from .. import database_api as DBAPI, scheduler
 from . import utils as Utils
 import json
 
+# Licenses returned per page by the license listing (and the largest page a client may ask for)
+_PAGE_SIZE_ = 50
+_MAX_PAGE_SIZE_ = 200
+
 
 def displayProductList():
     products = DBAPI.getProduct('_ALL_')
@@ -19,13 +23,58 @@ def displayProduct(productID):
     if(productContent == None):
         return Utils.render404("Produto não encontrado", "Desculpe, mas o produto informado ainda não existe ...")
 
-    DBAPI.updateKeyStatesFromProduct(productID)
+    # The maintenance scheduler sweeps the expired licenses in the background when it is enabled
+    if(not scheduler.enabled()):
+        DBAPI.updateKeyStatesFromProduct(productID)
 
-    licenses = DBAPI.getKeys(productID)
-    customers = DBAPI.getCustomer('_ALL_')
+    licenseCount = DBAPI.getKeyCount(productID)
+    customerCount = DBAPI.getCustomerCount()
     clientcount = DBAPI.getDistinctClients(productID)
 
-    return render_template('product.html', licenses=licenses, clients=clientcount, product=productContent, pubKey=productContent.publicK.decode('utf-8'), pubKeyXML=Utils.PemToXML(productContent.publicK), customers=customers, mode=request.cookies.get('mode'))
+    return render_template('product.html', licenseCount=licenseCount, pageSize=_PAGE_SIZE_, clients=clientcount, product=productContent, pubKey=productContent.publicK.decode('utf-8'), pubKeyXML=Utils.PemToXML(productContent.publicK), keyType=get_key_type(productContent.publicK), customerCount=customerCount, mode=request.cookies.get('mode'))
+
+
+def queryLicenses(productID, requestData):
+    """
+        Returns one page of the licenses of a product as JSON. The filters, the sorting and the cursor of the
+        next page are read from the query string:
+        status, customer, serial (prefix), hwid (prefix), expiresfrom, expiresto, expirytype, sort, order, cursor, limit
+    """
+    if(not str(productID).isnumeric() or DBAPI.getProductByID(productID) is None):
+        return json.dumps({'code': "ERROR", 'message': "O produto indicado é inválido ou não existe."}), 404
+
+    try:
+        filters = {
+            'status': optionalInt(requestData.get('status')),
+            'clientid': optionalInt(requestData.get('customer')),
+            'serialPrefix': (requestData.get('serial') or '').strip().upper(),
+            'hardwareID': (requestData.get('hwid') or '').strip(),
+            'expiresFrom': optionalInt(requestData.get('expiresfrom')),
+            'expiresTo': optionalInt(requestData.get('expiresto')),
+            'expiryType': requestData.get('expirytype') if requestData.get('expirytype') in ('0', '1', 'perpetual') else None
+        }
+        sort = requestData.get('sort') or 'id'
+        if(sort not in DBAPI.LICENSE_SORT_COLUMNS):
+            raise ValueError(sort)
+        limit = min(max(int(requestData.get('limit') or _PAGE_SIZE_), 1), _MAX_PAGE_SIZE_)
+        after = Utils.decodeCursor(requestData.get('cursor'))
+    except (TypeError, ValueError):
+        return json.dumps({'code': "ERROR", 'message': "Os filtros ou a página indicados são inválidos."}), 400
+
+    licenses, nextCursor, total = DBAPI.queryLicensePage(int(productID), filters, sort,
+                                                         requestData.get('order') == 'desc', after, limit)
+    return json.dumps({
+        'code': "OKAY",
+        'licenses': [license._asdict() for license in licenses],
+        'next': Utils.encodeCursor(nextCursor),
+        'total': total
+    })
+
+
+def optionalInt(value):
+    if(value is None or str(value).strip() in ('', 'all')):
+        return None
+    return int(value)
 
 
 def createProduct(requestData):
@@ -36,9 +85,13 @@ def createProduct(requestData):
     category = requestData.get('category')
     image = requestData.get('image')
     details = requestData.get('details')
+    keyType = requestData.get('keytype') or 'RSA'
     # ###################################################
 
-    product_keys = create_product_keys()
+    if(keyType not in KEY_TYPES):
+        return json.dumps({'code': "ERROR", 'message': "Tipo de chave inválido (use RSA ou X25519)."}), 500
+
+    product_keys = create_product_keys(keyType)
     newProduct = DBAPI.createProduct(
         name, category, image, details, product_keys[0], product_keys[1], product_keys[2])
     DBAPI.submitLog(None, adminAcc.id, 'EditedProduct', '$$' +
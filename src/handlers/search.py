@@ -0,0 +1,26 @@
+from .. import database_api as DBAPI
+import json
+
+# Results returned by the typeahead search (and the most a client may ask for)
+_RESULT_LIMIT_ = 10
+_MAX_RESULT_LIMIT_ = 50
+
+
+def search(requestData):
+    """
+        Typeahead search used by the admin pages. Query string: q (the typed text), kind (comma separated list of
+        customer, product, license and device; all of them by default), product (only results of that product)
+        and limit.
+    """
+    term = (requestData.get('q') or '').strip()
+    kinds = [kind for kind in (requestData.get('kind') or '').split(',') if kind]
+    if(any(kind not in DBAPI.SEARCH_KINDS for kind in kinds)):
+        return json.dumps({'code': "ERROR", 'message': "O tipo de pesquisa indicado é inválido."}), 400
+    try:
+        limit = min(max(int(requestData.get('limit') or _RESULT_LIMIT_), 1), _MAX_RESULT_LIMIT_)
+        productID = int(requestData['product']) if requestData.get('product') else None
+    except ValueError:
+        return json.dumps({'code': "ERROR", 'message': "Os parâmetros da pesquisa são inválidos."}), 400
+
+    results = DBAPI.search(term, kinds, limit, productID) if len(term) > 0 else []
+    return json.dumps({'code': "OKAY", 'results': [result._asdict() for result in results]})
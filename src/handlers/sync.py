@@ -3,7 +3,7 @@ import json
 import time
 from flask import request, render_template, send_from_directory, abort, jsonify
 from .. import database_api as DBAPI
-from ..keys import decrypt_data
+from .. import decryptpool
 
 SYNC_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'database', 'sync')
 
@@ -16,7 +16,7 @@ def handleSync(requestData):
         }), 400
 
     # 1. Validar apiKey
-    product = DBAPI.getProductThroughAPI(requestData.get('apiKey'))
+    product = DBAPI.getProductRecordThroughAPI(requestData.get('apiKey'))
     if not product:
         return jsonify({
             'HttpCode': '401',
@@ -26,7 +26,7 @@ def handleSync(requestData):
 
     # 2. Descriptografar payload
     try:
-        decryptedData = decrypt_data(requestData.get('payload'), product)
+        decryptedData = decryptpool.decrypt(requestData.get('payload'), product)
         serialKey = decryptedData[0]
         hardwareID = decryptedData[1]
     except Exception:
@@ -5,7 +5,9 @@ from time import time
 from datetime import datetime
 from binascii import unhexlify
 from cryptography.hazmat.primitives import serialization
-from base64 import standard_b64encode
+from cryptography.hazmat.primitives.asymmetric import x25519
+from base64 import standard_b64encode, urlsafe_b64decode, urlsafe_b64encode
+import json
 
 
 def validateMultiple_Customer(name, email, phoneNumber):
@@ -93,6 +95,25 @@ def validateExpiryDate(expiryDate):
 # ############## MISC
 # #######################################################################################
 
+def encodeCursor(cursor):
+    """
+        Opaque (url-safe) form of the (sort value, id) cursor of a keyset-paginated listing.
+    """
+    if(cursor is None):
+        return None
+    return urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def decodeCursor(cursor):
+    if(not cursor):
+        return None
+    try:
+        value, lastID = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception as exp:
+        raise ValueError(cursor) from exp
+    return value, int(lastID)
+
+
 def render404(mainMessage=None, subMessage=None):
     mainMessage = "Page not found" if mainMessage is None else mainMessage
     subMessage = "Sorry, but the page you are looking for does not exist." if subMessage is None else subMessage
@@ -117,6 +138,15 @@ def PemToXML(pubkey):
         return s
 
     pubk = serialization.load_pem_public_key(pubkey)
+    if isinstance(pubk, x25519.X25519PublicKey):
+        pubKxml = '<X25519KeyValue>'
+        pubKxml += '<PublicKey>'
+        pubKxml += standard_b64encode(pubk.public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)).decode('utf-8')
+        pubKxml += '</PublicKey>'
+        pubKxml += '</X25519KeyValue>'
+        return pubKxml
+
     pubKxml = '<RSAKeyValue>'
     pubKxml += '<Modulus>'
     pubKxml += standard_b64encode(
@@ -1,10 +1,15 @@
 from .. import database_api as DBAPI
-from ..keys import decrypt_data
-from flask import request
+from .. import logsink, decryptpool, validationcache
+from ..keys import sign_lease, issue_session_token, verify_session_token
+from flask import current_app, request
+from sqlalchemy.exc import SQLAlchemyError
 import json
 import math
 import time
 
+# Maximum number of items accepted by a single batch validation request
+_BATCH_LIMIT_ = 500
+
 
 def handleValidation(requestData):
     response = validate(requestData)
@@ -12,37 +17,163 @@ def handleValidation(requestData):
     return json.dumps(response)
 
 
+def handleBatchValidation(requestData):
+    """
+        Validates several {apiKey, payload} items in one request. Lookups are grouped into set-based
+        queries and every registration and log entry is written in a single transaction.
+        The response is a JSON array with one standard response per item, in the same order.
+    """
+    items = requestData.get('items') if isinstance(requestData, dict) else requestData
+    if(not isinstance(items, list) or len(items) == 0 or not all(isinstance(item, dict) for item in items)):
+        return json.dumps(responseMessage(400, 'ERR_INVALID_BATCH', 'ERRO :: O lote deve ser uma lista não vazia de objetos {apiKey, payload}.')), 400
+    if(len(items) > _BATCH_LIMIT_):
+        return json.dumps(responseMessage(400, 'ERR_BATCH_TOO_LARGE', 'ERRO :: O lote excede o limite de ' + str(_BATCH_LIMIT_) + ' itens.')), 400
+
+    try:
+        responses = validateBatch(items)
+        DBAPI.submitValidationLogs([logsink.buildRow(*extractLogFields(item, response))
+                                    for item, response in zip(items, responses)], commit=False)
+        DBAPI.commitSession()
+    except Exception:
+        DBAPI.rollbackSession()
+        raise
+    return json.dumps(responses)
+
+
+def validateBatch(items):
+    """
+        Runs every item through the same steps as 'validate', without committing.
+    """
+    responses = [None] * len(items)
+    decrypted = {}
+
+    # STEP 1 & 2 :: Resolve the API Keys (cached) and decrypt the payloads (in parallel when a decrypt pool is set)
+    pending = []
+    for index, item in enumerate(items):
+        product = DBAPI.getProductRecordThroughAPI(item.get('apiKey'))
+        if(product is None):
+            responses[index] = responseMessage(401, 'ERR_API_KEY', 'ERRO :: A chave de API informada é inválida. A requisição de validação não foi processada.')
+        elif(item.get('sessionToken')):
+            try:
+                decrypted[index] = (product, decryptRequest(item, product))
+            except Exception:
+                responses[index] = decryptionFailure(item)
+        else:
+            pending.append((index, product))
+
+    results = decryptpool.decryptMany([(items[index].get('payload'), product) for index, product in pending])
+    for (index, product), result in zip(pending, results):
+        try:
+            if(isinstance(result, Exception)):
+                raise result
+            decrypted[index] = (product, checkDecryptedData(result))
+        except Exception:
+            responses[index] = decryptionFailure(items[index])
+
+    # Already registered devices are answered from the validation cache
+    for index, (product, decryptedData) in list(decrypted.items()):
+        try:
+            expiryDate = validationcache.get(product.id, decryptedData[0], decryptedData[1])
+            if(expiryDate is not None):
+                responses[index] = attachCredentials(registeredResponse(decryptedData, expiryDate), product, items[index])
+                del decrypted[index]
+        except SQLAlchemyError:
+            raise
+        except Exception:
+            responses[index] = decryptionFailure(items[index])
+            del decrypted[index]
+
+    # STEP 3 :: Fetch every License and Registration involved with one query each
+    keyObjects = DBAPI.getKeysBySerialKeys({data[0] for _, data in decrypted.values()})
+    registered = DBAPI.getRegistrationPairs({key.id for key in keyObjects.values()},
+                                            {data[1] for _, data in decrypted.values()})
+
+    for index, (product, decryptedData) in decrypted.items():
+        # A failing item gets its own error response instead of failing the whole batch (database errors still
+        # abort it: the transaction shared by every item can no longer be committed)
+        try:
+            responses[index] = validateBatchItem(items[index], product, decryptedData, keyObjects, registered)
+        except SQLAlchemyError:
+            raise
+        except Exception:
+            responses[index] = decryptionFailure(items[index])
+    return responses
+
+
+def validateBatchItem(item, product, decryptedData, keyObjects, registered):
+    keyObject = keyObjects.get(decryptedData[0])
+    if(keyObject is None or keyObject.productid != product.id):
+        return responseMessage(401, 'ERR_SERIAL_KEY', 'ERRO :: A chave serial informada é inválida. A requisição de validação foi processada mas foi rejeitada.', decryptedData)
+    if((keyObject.id, decryptedData[1]) in registered):
+        return attachCredentials(handleExistingState(keyObject, decryptedData, commit=False), product, item)
+    response = attachCredentials(handleNonExistingState(keyObject, decryptedData, commit=False), product, item)
+    if(response['Code'] == 'SUCCESS'):
+        registered.add((keyObject.id, decryptedData[1]))
+    return response
+
+
 def validate(requestData):
     # STEP 1 :: Validate the existence of an API Key
-    product = DBAPI.getProductThroughAPI(requestData.get('apiKey'))
+    product = DBAPI.getProductRecordThroughAPI(requestData.get('apiKey'))
     if(product is None or product == []):
         return responseMessage(401, 'ERR_API_KEY', 'ERRO :: A chave de API informada é inválida. A requisição de validação não foi processada.')
     # ##############################################################################
 
     # STEP 2 :: Extract the descrypted data (fail if it is invalid)
     try:
-        decryptedData = decrypt_data(requestData.get('payload'), product)
+        decryptedData = decryptRequest(requestData, product)
     except Exception:
-        return responseMessage(401, 'ERR_PUB_PRIV_KEY', 'ERRO :: A descriptografia falhou. Sua chave pode ser inválida.')
+        return decryptionFailure(requestData)
 
     # The data in the decryptedData section is organized as:
     # decryptedData[0] - Serial Key
     # decryptedData[1] - Hardware ID
     # ##############################################################################
 
-    # STEP 3 :: Validate the Serial Key by matching it to an existing License object
-    keyObject = DBAPI.getKeysBySerialKey(decryptedData[0], product.id)
-    if(keyObject is None or keyObject == []):
+    # Repeat validations of an already registered device are answered from the validation cache
+    expiryDate = validationcache.get(product.id, decryptedData[0], decryptedData[1])
+    if(expiryDate is not None):
+        return attachCredentials(registeredResponse(decryptedData, expiryDate), product, requestData)
+
+    # STEP 3 :: Validate the Serial Key by matching it to an existing License (the registration of the device is fetched along)
+    keyObject = DBAPI.getValidationContext(product.id, decryptedData[0], decryptedData[1])
+    if(keyObject is None):
         return responseMessage(401, 'ERR_SERIAL_KEY', 'ERRO :: A chave serial informada é inválida. A requisição de validação foi processada mas foi rejeitada.', decryptedData)
     # ##############################################################################
 
-    if(DBAPI.getRegistration(keyObject.id, decryptedData[1]) is None):
-        return handleNonExistingState(keyObject, decryptedData)
+    if(keyObject.registrationid is None):
+        response = handleNonExistingState(keyObject, decryptedData)
     else:
-        return handleExistingState(keyObject, decryptedData)
+        response = handleExistingState(keyObject, decryptedData)
+    return attachCredentials(response, product, requestData)
+
+
+def decryptRequest(requestData, product):
+    """
+        Extracts the [serialKey, hardwareID] pair of a validation request. Requests either carry an RSA 'payload'
+        or a 'sessionToken' issued by a previous validation, which is verified with cheap symmetric crypto instead.
+    """
+    if(requestData.get('sessionToken')):
+        return checkDecryptedData(verify_session_token(current_app.config['SECRET_KEY'], requestData.get('sessionToken'), product.id))
+    return checkDecryptedData(decryptpool.decrypt(requestData.get('payload'), product))
 
 
-def handleExistingState(keyObject, decryptedData):
+def checkDecryptedData(decryptedData):
+    """
+        Rejects decrypted payloads that are not exactly a [serialKey, hardwareID] pair (e.g. a payload without ':').
+    """
+    if(not isinstance(decryptedData, (list, tuple)) or len(decryptedData) != 2):
+        raise ValueError("The payload must hold exactly two fields: serialKey:hardwareID")
+    return decryptedData
+
+
+def decryptionFailure(requestData):
+    if(requestData.get('sessionToken')):
+        return responseMessage(401, 'ERR_SESSION_TOKEN', 'ERRO :: O token de sessão é inválido ou expirou. Valide novamente com o payload criptografado.')
+    return responseMessage(401, 'ERR_PUB_PRIV_KEY', 'ERRO :: A descriptografia falhou. Sua chave pode ser inválida.')
+
+
+def handleExistingState(keyObject, decryptedData, commit=True):
     """
         Handles the situation where a device is already linked to the specified license. 
         In this situation, the method merely checks whether or not the license is still valid.
@@ -52,13 +183,18 @@ def handleExistingState(keyObject, decryptedData):
     activationDate = getattr(keyObject, 'activationdate', None)
     
     if(validateExpirationDate(keyObject.expirydate, expiryType, expiryDays, activationDate)):
-        return responseMessage(200, 'OKAY', 'SUCESSO :: Este dispositivo ainda está registrado e tudo está funcionando corretamente.', decryptedData, keyObject.expirydate)
+        validUntil = keyObject.expirydate
+        if expiryType == 1 and expiryDays is not None and activationDate is not None:
+            validUntil = activationDate + (expiryDays * 86400)
+        validationcache.set(keyObject.productid, keyObject.serialkey,
+                            decryptedData[1], keyObject.expirydate, validUntil)
+        return registeredResponse(decryptedData, keyObject.expirydate)
     else:
-        DBAPI.applyExpirationState(keyObject.id)
+        DBAPI.applyExpirationState(keyObject.id, commit)
         return responseMessage(400, 'ERR_KEY_EXPIRED', 'ERRO :: Esta licença não é mais válida.', decryptedData, keyObject.expirydate)
 
 
-def handleNonExistingState(keyObject, decryptedData):
+def handleNonExistingState(keyObject, decryptedData, commit=True):
     """
         Handles the situation where a device is not yet linked to the specified license. 
         Multiple checks are done before the license is authorized for validation.
@@ -74,19 +210,27 @@ def handleNonExistingState(keyObject, decryptedData):
     activationDate = getattr(keyObject, 'activationdate', None)
     
     if(not validateExpirationDate(keyObject.expirydate, expiryType, expiryDays, activationDate)):
-        DBAPI.applyExpirationState(keyObject.id)
+        DBAPI.applyExpirationState(keyObject.id, commit)
         return responseMessage(400, 'ERR_KEY_EXPIRED', 'ERRO :: Esta licença não é mais válida e não aceitará novos dispositivos.', decryptedData, keyObject.expirydate)
 
-    # STEP 3 :: Check if the License's device list can hold more devices.
-    if(keyObject.devices == keyObject.maxdevices):
+    # STEP 3 :: Claim one of the License's device seats. The check and the increment happen in a single
+    # conditional UPDATE, so concurrent validations of the same license can never exceed 'maxdevices'.
+    outcome, expiryDate = DBAPI.claimSeat(keyObject.id, decryptedData[1], commit=commit)
+    if(outcome == DBAPI.SEAT_FULL):
         return responseMessage(400, 'ERR_KEY_DEVICES_FULL', 'ERRO :: O número máximo de dispositivos para esta chave de licença foi atingido.', decryptedData, keyObject.expirydate)
+    if(outcome == DBAPI.SEAT_REGISTERED):
+        # Another request registered this device in the meantime
+        return handleExistingState(keyObject, decryptedData, commit)
 
     # If all steps above go through, then we accept the validation
-    DBAPI.addRegistration(keyObject.id, decryptedData[1], keyObject)
-    return responseMessage(201, 'SUCCESS', 'SUCESSO :: Seu registro foi realizado com sucesso!', decryptedData, keyObject.expirydate)
+    return responseMessage(201, 'SUCCESS', 'SUCESSO :: Seu registro foi realizado com sucesso!', decryptedData, expiryDate)
 
 
 # Utility Functions
+def registeredResponse(decryptedData, expirationDate):
+    return responseMessage(200, 'OKAY', 'SUCESSO :: Este dispositivo ainda está registrado e tudo está funcionando corretamente.', decryptedData, expirationDate)
+
+
 def responseMessage(HTTPCode=200, ResponseCode='OKAY', Message='Tudo está funcionando corretamente (RESPOSTA PADRÃO)', decryptedData=None, expirationDate=None):
     """
         Creates a JSON string that contains all the individual components of a standard response.
@@ -103,7 +247,29 @@ def responseMessage(HTTPCode=200, ResponseCode='OKAY', Message='Tudo está funci
     }
 
 
+def attachCredentials(responseMsg, product, requestData):
+    """
+        Adds a signed offline lease ('Lease' field) to successful responses, so the client does not need to
+        validate again until the lease expires. Requests authenticated with the RSA payload also receive a
+        'SessionToken' that can replace the payload on the next checks.
+    """
+    if(responseMsg['Code'] in ('OKAY', 'SUCCESS')):
+        lease = sign_lease(product, responseMsg['SerialKey'], responseMsg['HardwareID'],
+                           responseMsg['ExpirationDate'], current_app.config['LEASE_TTL'], decryptpool.sign)
+        if(lease is not None):
+            responseMsg['Lease'] = lease
+        if(not requestData.get('sessionToken')):
+            responseMsg['SessionToken'] = issue_session_token(current_app.config['SECRET_KEY'], product.id,
+                                                              responseMsg['SerialKey'], responseMsg['HardwareID'],
+                                                              current_app.config['SESSION_TOKEN_TTL'])
+    return responseMsg
+
+
 def generateLogContents(requestData, responseMsg):
+    logsink.submit(*extractLogFields(requestData, responseMsg))
+
+
+def extractLogFields(requestData, responseMsg):
     # ################################################# SET-UP DATABASE FIELDS
     result = 'ERROR' if ('ERR' in responseMsg['Code']) else 'SUCCESS'
     code = str(responseMsg['Code'])
@@ -112,8 +278,7 @@ def generateLogContents(requestData, responseMsg):
     hardwareID = str(responseMsg['HardwareID'])
     ipaddress = str(request.access_route[-1])
     # ########################################################################
-    DBAPI.submitValidationLog(result, code, ipaddress,
-                              apiKey, serialKey, hardwareID)
+    return result, code, ipaddress, apiKey, serialKey, hardwareID
 
 
 # MERELY AUXILIARY FUNCTIONS
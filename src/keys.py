@@ -1,15 +1,45 @@
 from uuid import uuid4
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, x25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
+from .cache import BoundedCache
+from time import time
 import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
 import string
-import random
 
+# Characters of the serial keys, and the table that maps a random byte to one of them
+_SERIAL_ALPHABET_ = string.ascii_uppercase + string.digits
+_SERIAL_TABLE_ = bytes(ord(_SERIAL_ALPHABET_[byte % len(_SERIAL_ALPHABET_)]) for byte in range(256))
+_SERIAL_REJECTED_ = bytes(range(256 - 256 % len(_SERIAL_ALPHABET_), 256))
 
-def create_product_keys():
-    private_key = rsa.generate_private_key(
-        key_size=2048, public_exponent=65537)
+# Deserialized private keys, keyed by (product id, PEM fingerprint)
+_PRIVATE_KEY_CACHE_ = BoundedCache(maxsize=int(os.getenv("KEY_CACHE_SIZE") or 256))
+# Signed offline leases, keyed by (product id, serial key, hardware ID, expiration date, lease TTL)
+_LEASE_CACHE_ = BoundedCache(maxsize=int(os.getenv("LEASE_CACHE_SIZE") or 10000))
+
+
+# Supported product key types. The type of a product is not stored separately: it is implied by its key pair.
+KEY_TYPES = ('RSA', 'X25519')
+
+
+def create_product_keys(keyType='RSA'):
+    if keyType not in KEY_TYPES:
+        raise Exception("Unsupported key type: " + str(keyType))
+
+    if keyType == 'X25519':
+        private_key = x25519.X25519PrivateKey.generate()
+        private_format = serialization.PrivateFormat.PKCS8
+    else:
+        private_key = rsa.generate_private_key(
+            key_size=2048, public_exponent=65537)
+        private_format = serialization.PrivateFormat.TraditionalOpenSSL
     api_key = uuid4()
 
     public_key = private_key.public_key().public_bytes(
@@ -21,23 +51,75 @@ def create_product_keys():
 
     return [private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        format=private_format,
         encryption_algorithm=serialization.NoEncryption()), public_key,
         str(api_key)]
 
 
+def get_key_type(publicK):
+    """
+        Returns the key type ('RSA' or 'X25519') of a product, based on its PEM-encoded public key.
+    """
+    if isinstance(serialization.load_pem_public_key(publicK), x25519.X25519PublicKey):
+        return 'X25519'
+    return 'RSA'
+
+
 def get_private_key(product):
-    return serialization.load_pem_private_key(product.privateK, password=None)
+    """
+        Returns the deserialized private key of a product. Parsing the PEM is expensive, so the result
+        is kept in a process-wide cache keyed by the product id and a fingerprint of the PEM itself.
+    """
+    cacheKey = (product.id, hashlib.sha256(product.privateK).digest())
+    private_key = _PRIVATE_KEY_CACHE_.get(cacheKey)
+    if private_key is None:
+        private_key = serialization.load_pem_private_key(
+            product.privateK, password=None)
+        _PRIVATE_KEY_CACHE_.set(cacheKey, private_key)
+    return private_key
+
+
+def invalidate_private_key(productid):
+    """
+        Drops the cached private key(s) and signed leases of a product. Must be called whenever a product is edited
+        or deleted.
+    """
+    _PRIVATE_KEY_CACHE_.evict(lambda cacheKey: cacheKey[0] == int(productid))
+    _LEASE_CACHE_.evict(lambda cacheKey: cacheKey[0] == int(productid))
 
 
 def generateSerialKey(length):
-    characters = string.ascii_uppercase + string.digits
-    serialKey = ''
-    for i in range(length):
-        if(i % 5 == 0 and i != 0):
-            serialKey += '-'
-        serialKey += random.choice(characters)
-    return serialKey
+    return generateSerialKeys(1, length)[0]
+
+
+def generateSerialKeys(count, length=20, taken=None):
+    """
+        Generates 'count' distinct serial keys of 'length' random characters, in groups of five ('XXXXX-XXXXX-...').
+        'taken', if given, is called with each set of new candidates and returns the ones that are already in use
+        (see database_api.existingSerialKeys); only those are generated again.
+    """
+    serials = set()
+    while len(serials) < count:
+        candidates = set(_randomSerials(count - len(serials), length)) - serials
+        if taken is not None and candidates:
+            candidates -= set(taken(candidates))
+        serials |= candidates
+    return list(serials)
+
+
+def _randomSerials(count, length):
+    # The characters are drawn from one block of random bytes. Bytes past the largest multiple of the alphabet
+    # size are dropped, so every character is equally likely.
+    alphabetSize = len(_SERIAL_ALPHABET_)
+    accepted = 256 - 256 % alphabetSize
+    needed = count * length
+    characters = b''
+    while len(characters) < needed:
+        block = secrets.token_bytes((needed - len(characters)) * 256 // accepted + 16)
+        characters += block.translate(_SERIAL_TABLE_, _SERIAL_REJECTED_)
+    characters = characters[:needed].decode('ascii')
+    return ['-'.join(characters[start + group:start + min(group + 5, length)] for group in range(0, length, 5))
+            for start in range(0, needed, length)]
 
 # Data Format: licensekey:hardwareID
 
@@ -47,12 +129,152 @@ def decrypt_data(payload, product):
 
     original_payload = base64.b64decode(payload.encode('utf-8'))
 
-    plaintext = private_key.decrypt(
-        original_payload,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        ))
+    if isinstance(private_key, x25519.X25519PrivateKey):
+        plaintext = ecies_decrypt(private_key, original_payload)
+    else:
+        plaintext = private_key.decrypt(
+            original_payload,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            ))
 
     return plaintext.decode('utf-8').split(':')
+
+
+# X25519 Payload Format: ephemeral public key (32 bytes) | nonce (12 bytes) | AES-256-GCM ciphertext + tag
+# The AES key is HKDF-SHA256(ECDH(ephemeral, product), salt = ephemeral public key | product public key).
+
+_ECIES_INFO_ = b'license-key-manager/x25519'
+
+
+def _ecies_key(shared_secret, ephemeral_public, recipient_public):
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=ephemeral_public + recipient_public,
+                info=_ECIES_INFO_).derive(shared_secret)
+
+
+def ecies_encrypt(public_key, plaintext):
+    """
+        Encrypts 'plaintext' to an X25519 product public key (what clients of X25519 products do).
+    """
+    ephemeral_key = x25519.X25519PrivateKey.generate()
+    ephemeral_public = ephemeral_key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+    recipient_public = public_key.public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+    key = _ecies_key(ephemeral_key.exchange(public_key),
+                     ephemeral_public, recipient_public)
+    nonce = os.urandom(12)
+    return ephemeral_public + nonce + AESGCM(key).encrypt(nonce, plaintext, None)
+
+
+def ecies_decrypt(private_key, payload):
+    ephemeral_public, nonce, ciphertext = payload[:32], payload[32:44], payload[44:]
+    recipient_public = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+    shared_secret = private_key.exchange(
+        x25519.X25519PublicKey.from_public_bytes(ephemeral_public))
+    key = _ecies_key(shared_secret, ephemeral_public, recipient_public)
+    return AESGCM(key).decrypt(nonce, ciphertext, None)
+
+
+# Lease Format: base64url(JSON claims).base64url(RSA PKCS#1 v1.5 / SHA-256 signature of the first part)
+
+
+def _b64url_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64url_decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def sign_data(data, product):
+    """
+        Signs 'data' (bytes) with the product's RSA private key (PKCS#1 v1.5, SHA-256).
+    """
+    return get_private_key(product).sign(data, padding.PKCS1v15(), hashes.SHA256())
+
+
+def sign_lease(product, serialKey, hardwareID, expirationDate, ttl, sign=sign_data):
+    """
+        Creates an offline lease for a device that has just been validated. The lease is signed with the
+        product's private key, so clients can verify it locally with the public key and only call the
+        server again once 'leaseExpiry' has passed. The lease never outlives the license itself.
+        Returns None for products whose key type cannot sign (X25519).
+
+        An RSA signature costs far more than the rest of a cached or session-token validation, so the lease of a
+        device is reused for the first half of its lifetime: repeat validations get the same lease, which still
+        has at least half of 'ttl' left. The signature itself is made by 'sign(data, product)' (see
+        decryptpool.sign, which runs it in the process pool).
+    """
+    expirationDate = max(int(expirationDate or 0), 0)
+    cacheKey = (product.id, serialKey, hardwareID, expirationDate, int(ttl))
+    lease = _LEASE_CACHE_.get(cacheKey)
+    if lease is not None:
+        return lease
+    if not isinstance(get_private_key(product), rsa.RSAPrivateKey):
+        # X25519 keys can only be used for key agreement, not for signatures
+        return None
+    issuedAt = int(time())
+    leaseExpiry = issuedAt + int(ttl)
+    if expirationDate:
+        leaseExpiry = min(leaseExpiry, expirationDate)
+    claims = {'serialKey': serialKey, 'hardwareID': hardwareID, 'expirationDate': expirationDate,
+              'issuedAt': issuedAt, 'leaseExpiry': leaseExpiry}
+    body = _b64url_encode(json.dumps(
+        claims, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+    signature = sign(body.encode('ascii'), product)
+    lease = body + '.' + _b64url_encode(signature)
+    _LEASE_CACHE_.set(cacheKey, lease, (leaseExpiry - issuedAt) / 2)
+    return lease
+
+
+def verify_lease(public_key, lease):
+    """
+        Returns the claims of a lease if its signature is valid, or None otherwise.
+        Note: the caller is responsible for checking the serial key, hardware ID and 'leaseExpiry'.
+    """
+    try:
+        body, signature = lease.split('.')
+        public_key.verify(_b64url_decode(signature), body.encode('ascii'),
+                          padding.PKCS1v15(), hashes.SHA256())
+        return json.loads(_b64url_decode(body))
+    except Exception:
+        return None
+
+
+# Session Token Format: base64url(JSON claims).base64url(HMAC-SHA256 of the first part)
+
+
+def _session_secret(secret):
+    return hashlib.sha256(b'session-token:' + str(secret).encode('utf-8')).digest()
+
+
+def issue_session_token(secret, productid, serialKey, hardwareID, ttl):
+    """
+        Creates a short-lived symmetric session token for a device that has just passed an RSA-authenticated
+        validation. The token can then replace the RSA payload until it expires, skipping the private-key decryption.
+    """
+    claims = {'productid': int(productid), 'serialKey': serialKey,
+              'hardwareID': hardwareID, 'expiry': int(time()) + int(ttl)}
+    body = _b64url_encode(json.dumps(
+        claims, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+    mac = hmac.new(_session_secret(secret), body.encode('ascii'), hashlib.sha256).digest()
+    return body + '.' + _b64url_encode(mac)
+
+
+def verify_session_token(secret, token, productid):
+    """
+        Checks a session token and returns the same [serialKey, hardwareID] list as 'decrypt_data'.
+        Raises an exception if the token is malformed, forged, expired or belongs to another product.
+    """
+    body, mac = token.split('.')
+    expected = hmac.new(_session_secret(secret), body.encode('ascii'), hashlib.sha256).digest()
+    if not hmac.compare_digest(expected, _b64url_decode(mac)):
+        raise Exception("Invalid session token signature")
+    claims = json.loads(_b64url_decode(body))
+    if claims['productid'] != int(productid) or claims['expiry'] < time():
+        raise Exception("Session token expired or issued for another product")
+    return [claims['serialKey'], claims['hardwareID']]
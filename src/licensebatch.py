@@ -0,0 +1,104 @@
+import click
+import sys
+from flask.cli import with_appcontext
+from . import database_api as DBAPI
+from .exports import csvLines, outputOption
+from .keys import generateSerialKeys
+
+LICENSE_COLUMNS = ('id', 'serialkey')
+# Licenses written per transaction: large enough to amortize the commit, small enough to keep the write lock short
+_CHUNK_SIZE_ = 5000
+
+
+def createLicenses(productID, clientID, quantity, maxDevices, expiryDate, expiryType=0, expiryDays=None,
+                   user=None, chunkSize=_CHUNK_SIZE_, progress=None):
+    """
+        Creates 'quantity' identical licenses (see database_api.createKeys), generating their serial keys in memory
+        'chunkSize' at a time (checked against the ones already in use, including those of the previous chunks).
+        Yields the (id, serialkey) rows of every committed chunk, after calling 'progress(created, quantity)' if given.
+    """
+    def serialBatches():
+        remaining = quantity
+        while remaining > 0:
+            serials = generateSerialKeys(min(remaining, chunkSize), 20, DBAPI.existingSerialKeys)
+            remaining -= len(serials)
+            yield serials
+
+    created = 0
+    for rows in DBAPI.createKeys(productID, clientID, serialBatches(), maxDevices, expiryDate, expiryType,
+                                 expiryDays, user):
+        created += len(rows)
+        if progress is not None:
+            progress(created, quantity)
+        yield rows
+
+
+def licensesCSV(chunks):
+    """
+        Encodes the rows yielded by createLicenses as CSV (with a header row), one byte chunk per committed chunk.
+        If a chunk fails, the error is raised again after the licenses created before it were sent, so a streamed
+        response is aborted instead of looking like a complete (shorter) file.
+    """
+    yield csvLines([LICENSE_COLUMNS], asBytes=True)
+    try:
+        for rows in chunks:
+            yield csvLines(rows, asBytes=True)
+    except Exception as exp:
+        print(f"Bulk license creation failed: {exp}", flush=True)
+        raise
+
+
+@click.command('create-licenses')
+@click.argument('productid', type=int)
+@click.argument('clientid', type=int)
+@click.option('--quantity', '-n', type=click.IntRange(1), default=1, show_default=True)
+@click.option('--max-devices', 'maxDevices', type=click.IntRange(1), default=1, show_default=True)
+@click.option('--expiry', 'expiryDate', type=int, default=0, help='Expiry date (timestamp, 0 = perpetual).')
+@click.option('--days', 'expiryDays', type=click.IntRange(1),
+              help='Days of validity counted from the activation (instead of --expiry).')
+@click.option('--admin', required=True, help='Name of the administrator the changelog entries are attributed to.')
+@outputOption(help="CSV file ('-' for standard output).")
+@with_appcontext
+def createLicensesCommand(productid, clientid, quantity, maxDevices, expiryDate, expiryDays, admin, output):
+    """
+        Creates licenses in bulk and writes their ids and serial keys as CSV.
+    """
+    user = DBAPI.obtainUser(admin)
+    if DBAPI.getProductByID(productid) is None or user is None:
+        raise click.UsageError("Unknown product or administrator.")
+    expiryType = 1 if expiryDays else 0
+    chunks = createLicenses(productid, clientid, quantity, maxDevices, 0 if expiryType else expiryDate,
+                            expiryType, expiryDays, user)
+    with click.progressbar(length=quantity, label='Creating licenses', file=sys.stderr) as progress:
+        output.write(csvLines([LICENSE_COLUMNS], asBytes=True))
+        for rows in chunks:
+            output.write(csvLines(rows, asBytes=True))
+            progress.update(len(rows))
+    output.flush()
+
+
+@click.command('generate-serials')
+@click.option('--quantity', '-n', type=click.IntRange(1), default=1, show_default=True)
+@click.option('--length', type=click.IntRange(5), default=20, show_default=True,
+              help='Random characters per serial key (without the dashes).')
+@outputOption('w')
+@with_appcontext
+def generateSerialsCommand(quantity, length, output):
+    """
+        Writes distinct serial keys that no license uses yet, one per line (e.g. for licenses printed in advance).
+    """
+    written = set()
+
+    def taken(candidates):
+        return DBAPI.existingSerialKeys(candidates) | (candidates & written)
+
+    for start in range(0, quantity, _CHUNK_SIZE_):
+        serials = generateSerialKeys(min(quantity - start, _CHUNK_SIZE_), length, taken)
+        written.update(serials)
+        output.write(''.join(serial + '\n' for serial in serials))
+    output.flush()
+
+
+def init_app(app):
+    app.cli.add_command(createLicensesCommand)
+    app.cli.add_command(generateSerialsCommand)
@@ -0,0 +1,181 @@
+import atexit
+import os
+import queue
+import threading
+from flask import has_app_context
+from time import time, monotonic
+
+
+class ValidationLogSink:
+    """
+        Buffers Validationlog rows in memory and writes them to the database in multi-row transactions,
+        so the validation endpoint does not pay for a commit (and an fsync) on every request.
+
+        - Rows are flushed once 'batchSize' rows are queued or 'flushInterval' seconds have passed.
+        - The queue is bounded by 'maxQueue'. When it is full the caller waits up to 'putTimeout' seconds
+          and then writes its row synchronously (backpressure instead of unbounded memory growth).
+        - A batch the writer thread fails to store is kept and retried with the next one (up to 'maxQueue' rows).
+        - Pending rows are flushed when the worker process exits.
+
+        The writer thread is created lazily in the process that submits the first row, which keeps it
+        compatible with gunicorn's '--preload' (threads do not survive the fork) and with gevent workers,
+        where 'threading' and 'queue' are monkey-patched into greenlet-friendly versions.
+    """
+
+    def __init__(self, app, asynchronous=True, batchSize=200, flushInterval=1.0, maxQueue=10000, putTimeout=0.5):
+        self.app = app
+        self.asynchronous = asynchronous
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxQueue = maxQueue
+        self.putTimeout = putTimeout
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._startLock = threading.Lock()
+        self._stopping = False
+
+    def submit(self, result, logtype, ipaddress, apiKey, serialKey, hardwareID):
+        row = buildRow(result, logtype, ipaddress,
+                       apiKey, serialKey, hardwareID)
+        if not self.asynchronous or self._stopping:
+            self._write([row])
+            return
+
+        self._ensureStarted()
+        try:
+            self._queue.put(row, timeout=self.putTimeout)
+        except queue.Full:
+            self._write([row])
+
+    def flush(self):
+        """
+            Writes every queued row right away, on the calling thread.
+        """
+        if self._queue is None:
+            return
+        rows = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is not None:
+                rows.append(row)
+            if len(rows) >= self.batchSize:
+                self._write(rows)
+                rows = []
+        if rows:
+            self._write(rows)
+
+    def close(self):
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping = True
+        self._queue.put(None)
+        self._thread.join(timeout=max(5.0, self.flushInterval * 2))
+        self._thread = None
+        self.flush()
+
+    # ##########################################################################
+
+    def _ensureStarted(self):
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._startLock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._queue = queue.Queue(maxsize=self.maxQueue)
+            self._thread = threading.Thread(
+                target=self._run, name='validation-log-sink', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        pending = []  # Rows of the batches that could not be written, retried with the next one
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flushInterval)
+            except queue.Empty:
+                if pending:
+                    pending = self._writeOrKeep(pending)
+                continue
+            if first is None:
+                self._write(pending)
+                return
+
+            rows = [first]
+            deadline = monotonic() + self.flushInterval
+            stop = False
+            while len(rows) < self.batchSize:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stop = True
+                    break
+                rows.append(row)
+
+            if stop:
+                self._write(pending + rows)
+                return
+            pending = self._writeOrKeep(pending + rows)
+
+    def _writeOrKeep(self, rows):
+        """
+            Writes 'rows' and returns the ones to retry: none on success, otherwise the newest 'maxQueue' of them.
+        """
+        if self._write(rows):
+            return []
+        if len(rows) > self.maxQueue:
+            self.app.logger.error("Dropped %d validation log(s) that could not be stored", len(rows) - self.maxQueue)
+        return rows[-self.maxQueue:]
+
+    def _write(self, rows):
+        """
+            Stores 'rows' in one transaction. Returns False (after rolling the session back, so the caller's session
+            stays usable) if they could not be stored.
+        """
+        if not rows:
+            return True
+        # Reuse the caller's application context (and its session) when there is one
+        if has_app_context():
+            return self._store(rows)
+        with self.app.app_context():
+            return self._store(rows)
+
+    def _store(self, rows):
+        from . import db, database_api as DBAPI  # pylint: disable=C0415
+        try:
+            DBAPI.submitValidationLogs(rows)
+            return True
+        except Exception:
+            db.session.rollback()
+            self.app.logger.exception("Failed to store %d validation log(s)", len(rows))
+            return False
+
+
+def buildRow(result, logtype, ipaddress, apiKey, serialKey, hardwareID):
+    return {'timestamp': int(time()), 'result': result, 'type': logtype, 'ipaddress': ipaddress,
+            'apiKey': apiKey, 'serialKey': serialKey, 'hardwareID': hardwareID}
+
+
+sink = None
+
+
+def init_app(app):
+    global sink  # pylint: disable=W0603
+    sink = ValidationLogSink(app,
+                             asynchronous=app.config['VALIDATION_LOG_ASYNC'],
+                             batchSize=app.config['VALIDATION_LOG_BATCH'],
+                             flushInterval=app.config['VALIDATION_LOG_INTERVAL'],
+                             maxQueue=app.config['VALIDATION_LOG_QUEUE'])
+
+
+def submit(result, logtype, ipaddress, apiKey, serialKey, hardwareID):
+    sink.submit(result, logtype, ipaddress, apiKey, serialKey, hardwareID)
@@ -3,7 +3,7 @@ from flask_httpauth import HTTPTokenAuth
 from flask_login import login_required
 from . import database_api as DBAPI
 
-from .handlers import admins as AdminHandler, customers as CustomerHandler, logs as LogHandler, products as ProductHandler, licenses as LicenseHandler, validation as ValidationHandler, sync as SyncHandler
+from .handlers import admins as AdminHandler, customers as CustomerHandler, logs as LogHandler, products as ProductHandler, licenses as LicenseHandler, validation as ValidationHandler, sync as SyncHandler, search as SearchHandler
 
 main = Blueprint('main', __name__)
 auth = HTTPTokenAuth(scheme='Bearer')
@@ -52,6 +52,12 @@ def productDisplay(productid):
     return ProductHandler.displayProduct(productid)
 
 
+@main.route('/products/id/<productid>/licenses')
+@login_required
+def productLicenses(productid):
+    return ProductHandler.queryLicenses(productid, request.args.to_dict())
+
+
 @main.route('/products/create', methods=['POST'])
 @login_required
 def createProduct():
@@ -78,6 +84,15 @@ def clearProductCheck(productid):
     return "DONE! Next time the product page of the indicated product is loaded, the server will check for expired keys."
 
 
+###########################################################################
+# SEARCH
+###########################################################################
+@main.route('/search')
+@login_required
+def search():
+    return SearchHandler.search(request.args.to_dict())
+
+
 ###########################################################################
 # CUSTOMER HANDLING
 ###########################################################################
@@ -174,6 +189,12 @@ def getvalidationlogs():
     return LogHandler.queryValidationLogs(request.args.to_dict())
 
 
+@main.route('/logs/validations/export')
+@login_required
+def exportvalidationlogs():
+    return LogHandler.exportValidationLogs(request.args.to_dict())
+
+
 ###########################################################################
 # LICENSE VALIDATION
 ###########################################################################
@@ -201,16 +222,11 @@ def validate_license():
         apiKey = data.get('apiKey')
         print(f"DEBUG: Buscando produto com API Key: '{apiKey}'", flush=True)
         
-        product = DBAPI.getProductThroughAPI(apiKey)
+        product = DBAPI.getProductRecordThroughAPI(apiKey)
         if product:
             print(f"DEBUG: Produto encontrado: {product.name} (ID: {product.id})", flush=True)
         else:
             print(f"DEBUG: Produto NÃO encontrado para a chave fornecida.", flush=True)
-            # Listar todas as chaves do banco para comparação (Debug extremo)
-            all_products = DBAPI.getProduct('_ALL_')
-            print("DEBUG: Chaves disponíveis no banco:", flush=True)
-            for p in all_products:
-                print(f" - ID: {p.id} | Nome: {p.name} | Key: '{p.apiK}'", flush=True)
 
         # O handler retorna uma string JSON, então precisamos criar uma Response com o mimetype correto
         response_content = ValidationHandler.handleValidation(data)
@@ -225,6 +241,31 @@ def validate_license():
         }), 500
 
 
+@main.route('/api/v1/validate/batch', methods=['POST'])
+def validate_license_batch():
+    try:
+        data = request.get_json(force=True, silent=True)
+        if data is None:
+            from flask import jsonify
+            return jsonify({
+                'HttpCode': '400',
+                'Code': 'ERR_INVALID_JSON',
+                'Message': 'ERRO :: O corpo da requisição deve ser um JSON válido.'
+            }), 400
+        response_content = ValidationHandler.handleBatchValidation(data)
+        if isinstance(response_content, tuple):
+            return Response(response_content[0], status=response_content[1], mimetype='application/json')
+        return Response(response_content, mimetype='application/json')
+    except Exception as e:
+        print(f"DEBUG: Exception in validate_license_batch: {e}", flush=True)
+        from flask import jsonify
+        return jsonify({
+            'HttpCode': '500',
+            'Code': 'ERR_INTERNAL',
+            'Message': f'ERRO INTERNO :: {str(e)}'
+        }), 500
+
+
 ###########################################################################
 # ADMINISTRATOR ACCOUNTS - HANDLING
 ###########################################################################
@@ -0,0 +1,244 @@
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateIndex
+from . import db
+
+# Rows updated per transaction by the backfills, so a large table never holds the write lock for long
+_BATCH_SIZE_ = 5000
+
+
+def _columns(table):
+    return {row[1] for row in db.session.execute(text(f'PRAGMA table_info("{table}")'))}
+
+
+def _indexes():
+    return {row[0] for row in db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+
+
+def _createIndexes(*names):
+    existing = _indexes()
+    declared = {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+    for name in names:
+        if name not in existing:
+            print(f"Creating index {name}...", flush=True)
+            db.session.execute(CreateIndex(declared[name]))
+
+
+def _backfill(table, assignments):
+    """
+        Runs 'UPDATE table SET assignments' over id ranges of '_BATCH_SIZE_' rows, committing after each range.
+    """
+    lastID = db.session.execute(text(f'SELECT MAX(id) FROM "{table}"')).scalar() or 0
+    for lowerBound in range(0, lastID, _BATCH_SIZE_):
+        db.session.execute(text(f'UPDATE "{table}" SET {assignments} WHERE id > :lower AND id <= :upper'),
+                           {'lower': lowerBound, 'upper': lowerBound + _BATCH_SIZE_})
+        db.session.commit()
+
+
+# ##########################################################################
+# Migration steps. Each one must leave the database consistent on its own and be safe to run again
+# (a worker started without '--preload' may race another one for the same step). A step starts with the write
+# lock held (see upgrade), so its checks and the changes they guard are atomic until its first commit.
+
+
+def _addExpiryModelColumns():
+    columns = _columns('key')
+    if 'expirytype' not in columns:
+        db.session.execute(text('ALTER TABLE "key" ADD COLUMN expirytype INTEGER NOT NULL DEFAULT 0'))
+    if 'expirydays' not in columns:
+        db.session.execute(text('ALTER TABLE "key" ADD COLUMN expirydays INTEGER'))
+    if 'activationdate' not in columns:
+        db.session.execute(text('ALTER TABLE "key" ADD COLUMN activationdate INTEGER'))
+
+
+def _uniqueRegistrations():
+    if 'uq_registration_key_hwid' in _indexes():
+        return
+    duplicates = db.session.execute(text(
+        "DELETE FROM registration WHERE id NOT IN (SELECT MIN(id) FROM registration GROUP BY keyID, hardwareID)")).rowcount
+    db.session.commit()
+    if duplicates:
+        print(f"Removed {duplicates} duplicated device registration(s).", flush=True)
+        _backfill('key', 'devices = (SELECT COUNT(*) FROM registration WHERE registration.keyID = key.id)')
+    _createIndexes('uq_registration_key_hwid')
+
+
+def _queryIndexes():
+    _createIndexes('ix_key_productid_status', 'ix_key_clientid', 'ix_changelog_timestamp',
+                   'ix_changelog_userid_timestamp', 'ix_changelog_keyid', 'ix_validationlog_timestamp_result')
+
+
+def _licenseListingIndexes():
+    _createIndexes('ix_key_productid_expirydate', 'ix_registration_hardwareid')
+
+
+# The search index holds one row per customer, product, license and registered device. Its rowid is derived
+# from the id of the source row ('id * 4 + kind'), so the triggers update it through the rowid instead of a scan.
+_SEARCH_SOURCES_ = {
+    'customer': ('client', 0, 'NULL', "{row}.name", "coalesce({row}.name, '') || ' ' || coalesce({row}.email, '') || ' ' || coalesce({row}.phone, '')", 'name, email, phone'),
+    'product': ('product', 1, '{row}.id', "{row}.name", "coalesce({row}.name, '') || ' ' || coalesce({row}.category, '')", 'name, category'),
+    'license': ('key', 2, '{row}.productid', "{row}.serialkey", "{row}.serialkey", 'serialkey, productid'),
+    'device': ('registration', 3, '(SELECT productid FROM "key" WHERE "key".id = {row}."keyID")', '{row}."hardwareID"', '{row}."hardwareID"', None),
+}
+
+
+def _searchRow(kind, row):
+    table, code, productid, label, content, _ = _SEARCH_SOURCES_[kind]
+    refid = f'{row}."keyID"' if kind == 'device' else f'{row}.id'
+    return (f"{row}.id * 4 + {code}, '{kind}', {refid}, {productid.format(row=row)}, "
+            f"{label.format(row=row)}, {content.format(row=row)}")
+
+
+def _searchIndex():
+    # Every statement is safe to run again, so a step interrupted half-way (or run by two workers) completes the
+    # index instead of leaving it without triggers or rows
+    try:
+        db.session.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(kind UNINDEXED, "
+                                "refid UNINDEXED, productid UNINDEXED, label UNINDEXED, content, prefix='2 3')"))
+    except OperationalError as exp:
+        db.session.rollback()
+        if 'fts5' not in str(exp).lower():
+            raise
+        print(f"WARNING: SQLite was built without FTS5 ({exp}). The search falls back to prefix queries.", flush=True)
+        return
+
+    columns = "rowid, kind, refid, productid, label, content"
+    for kind, (table, code, _, _, _, updatedColumns) in _SEARCH_SOURCES_.items():
+        insert = f"INSERT INTO search_index ({columns}) VALUES ({_searchRow(kind, 'new')});"
+        delete = f"DELETE FROM search_index WHERE rowid = old.id * 4 + {code};"
+        db.session.execute(text(f'CREATE TRIGGER IF NOT EXISTS search_{table}_insert AFTER INSERT ON "{table}" '
+                                f'BEGIN {insert} END'))
+        db.session.execute(text(f'CREATE TRIGGER IF NOT EXISTS search_{table}_delete AFTER DELETE ON "{table}" '
+                                f'BEGIN {delete} END'))
+        if updatedColumns:
+            db.session.execute(text(f'CREATE TRIGGER IF NOT EXISTS search_{table}_update AFTER UPDATE OF '
+                                    f'{updatedColumns} ON "{table}" BEGIN {delete} {insert} END'))
+    db.session.commit()
+
+    # Only the rows missing from the index are added (a lookup by rowid each)
+    for kind, (table, code, _, _, _, _) in _SEARCH_SOURCES_.items():
+        lastID = db.session.execute(text(f'SELECT MAX(id) FROM "{table}"')).scalar() or 0
+        for lowerBound in range(0, lastID, _BATCH_SIZE_):
+            db.session.execute(text(f'INSERT INTO search_index ({columns}) SELECT {_searchRow(kind, table)} '
+                                    f'FROM "{table}" WHERE id > :lower AND id <= :upper AND NOT EXISTS '
+                                    f'(SELECT 1 FROM search_index WHERE rowid = "{table}".id * 4 + {code})'),
+                               {'lower': lowerBound, 'upper': lowerBound + _BATCH_SIZE_})
+            db.session.commit()
+
+
+def _validationRollups():
+    # The table may already exist (create_all runs first on databases that predate the versioning), but it is only
+    # filled here: an empty table means the counters of the existing logs were never computed
+    db.metadata.tables['validationstat'].create(db.session.connection(), checkfirst=True)
+    if db.session.execute(text("SELECT 1 FROM validationstat LIMIT 1")).first():
+        return
+    # One pass over the logs (the result has one row per day, product and result). 'OR IGNORE' makes a second
+    # worker running the same step a no-op instead of counting the logs twice.
+    db.session.execute(text(
+        "INSERT OR IGNORE INTO validationstat (day, productid, result, count) "
+        "SELECT validationlog.timestamp - validationlog.timestamp % 86400, coalesce(product.id, 0), "
+        "validationlog.result, COUNT(*) FROM validationlog LEFT JOIN product ON product.\"apiK\" = validationlog.\"apiKey\" "
+        "GROUP BY 1, 2, 3"))
+    db.session.commit()
+
+
+def _effectiveExpiry():
+    if 'effectiveexpiry' not in _columns('key'):
+        db.session.execute(text('ALTER TABLE "key" ADD COLUMN effectiveexpiry INTEGER'))
+        db.session.commit()
+    # Same rules as database_api.effectiveExpiry and claimSeat (days model: only once the license was activated)
+    _backfill('key', "effectiveexpiry = CASE WHEN expirytype = 1 THEN CASE WHEN activationdate IS NOT NULL "
+                     "AND expirydays IS NOT NULL AND expirydate != 0 THEN activationdate + expirydays * 86400 END "
+                     "ELSE NULLIF(expirydate, 0) END")
+    _createIndexes('ix_key_productid_effectiveexpiry')
+
+
+def _maintenanceJobs():
+    db.metadata.tables['maintenancejob'].create(db.session.connection(), checkfirst=True)
+
+
+# Ordered list of (version, description, step). Append new steps at the end and never change applied ones.
+MIGRATIONS = [
+    (1, 'Expiry model columns of the key table', _addExpiryModelColumns),
+    (2, 'Unique (keyID, hardwareID) registrations', _uniqueRegistrations),
+    (3, 'Indexes of the validation, listing and log queries', _queryIndexes),
+    (4, 'Indexes of the paginated license listing', _licenseListingIndexes),
+    (5, 'Full-text search index of customers, products, licenses and devices', _searchIndex),
+    (6, 'Daily validation counters of the dashboard', _validationRollups),
+    (7, 'Effective expiry of the licenses', _effectiveExpiry),
+    (8, 'State of the maintenance jobs', _maintenanceJobs),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _lock():
+    """
+        Ends the current transaction and starts a write transaction right away ('BEGIN IMMEDIATE'), so another worker
+        migrating the same database waits here until this one commits instead of racing it between a check and the
+        change it guards (e.g. a column lookup and its 'ALTER TABLE').
+    """
+    db.session.commit()
+    db.session.execute(text("BEGIN IMMEDIATE"))
+
+
+def currentVersion():
+    """
+        Returns the schema version of the database, or None when it has no 'schema_version' table.
+    """
+    try:
+        return db.session.execute(text("SELECT version FROM schema_version")).scalar() or 0
+    except Exception:
+        db.session.rollback()
+        return None
+
+
+def upgrade():
+    """
+        Brings the database schema up to date. In the common case this is a single cheap query on the version table.
+        - A new database is created from models.py and stamped with the latest version.
+        - A database created before versioning existed starts at version 0 and runs every step.
+    """
+    version = currentVersion()
+    if version == LATEST_VERSION:
+        return
+    if version is not None and version > LATEST_VERSION:
+        print(f"WARNING: the database schema (version {version}) is newer than this application "
+              f"(version {LATEST_VERSION}).", flush=True)
+        return
+
+    if version is None:
+        _lock()
+        if db.session.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'")).first() is not None:
+            version = currentVersion()
+    if version is None:
+        fresh = db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'key'")).first() is None
+        # On the session's connection, which holds the write lock
+        db.metadata.create_all(db.session.connection())
+        db.session.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+        db.session.execute(text("INSERT INTO schema_version (version) SELECT :version "
+                                "WHERE NOT EXISTS (SELECT 1 FROM schema_version)"),
+                           {'version': LATEST_VERSION if fresh else 0})
+        db.session.commit()
+        if fresh:
+            # The search index and its triggers are not declared in models.py
+            _searchIndex()
+            print("Database created successfully with new schema.", flush=True)
+            return
+        version = 0
+
+    for stepVersion, description, step in MIGRATIONS:
+        if stepVersion <= version:
+            continue
+        # The version is read again under the write lock: another worker may have run the step in the meantime
+        _lock()
+        version = currentVersion()
+        if stepVersion <= version:
+            db.session.commit()
+            continue
+        print(f"Migrating database schema to version {stepVersion}: {description}...", flush=True)
+        step()
+        db.session.execute(text("UPDATE schema_version SET version = :version"), {'version': stepVersion})
+        db.session.commit()
+    print(f"Database schema is at version {LATEST_VERSION}.", flush=True)
@@ -44,6 +44,12 @@ class Client(db.Model):
 
 class Key(db.Model):
     __tablename__ = "key"
+    __table_args__ = (db.Index('ix_key_productid_status', 'productid', 'status'),
+                      db.Index('ix_key_productid_expirydate', 'productid', 'expirydate'),
+                      # Only the licenses that can still expire, so the expiry sweep reads just the ones past due
+                      db.Index('ix_key_productid_effectiveexpiry', 'productid', 'effectiveexpiry',
+                               sqlite_where=db.text('status != 3')),
+                      db.Index('ix_key_clientid', 'clientid'))
     id = db.Column(db.Integer, primary_key=True)
     productid = db.Column(db.Integer, db.ForeignKey(
         'product.id', ondelete="cascade"), nullable=False)
@@ -57,6 +63,8 @@ class Key(db.Model):
     expirytype = db.Column(db.Integer, nullable=False, default=0)  # 0 = data fixa, 1 = dias a partir da ativação
     expirydays = db.Column(db.Integer, nullable=True, default=None)  # Número de dias (quando expirytype = 1)
     activationdate = db.Column(db.Integer, nullable=True, default=None)  # Timestamp de quando foi ativada
+    # Momento em que a licença expira, nos dois modelos (NULL = não expira ou ainda não foi ativada)
+    effectiveexpiry = db.Column(db.Integer, nullable=True, default=None)
     registrations = db.relationship(
         'Registration', cascade='all,delete', backref='key')
     changelogs = db.relationship(
@@ -65,6 +73,10 @@ class Key(db.Model):
 
 class Registration(db.Model):
     __tablename__ = "registration"
+    # A device can only be linked once to the same license (see DBAPI.claimSeat)
+    __table_args__ = (db.Index('uq_registration_key_hwid',
+                      'keyID', 'hardwareID', unique=True),
+                      db.Index('ix_registration_hardwareid', 'hardwareID'))
     id = db.Column(db.Integer, primary_key=True)
     keyID = db.Column(db.Integer, db.ForeignKey(
         'key.id', ondelete="cascade"), nullable=False)
@@ -73,6 +85,9 @@ class Registration(db.Model):
 
 class Changelog(db.Model):
     __tablename__ = "changeLog"
+    __table_args__ = (db.Index('ix_changelog_timestamp', 'timestamp'),
+                      db.Index('ix_changelog_userid_timestamp', 'userid', 'timestamp'),
+                      db.Index('ix_changelog_keyid', 'keyID'))
     id = db.Column(db.Integer, primary_key=True)
     keyID = db.Column(db.Integer, db.ForeignKey(
         'key.id', ondelete="cascade"), nullable=True)
@@ -85,6 +100,8 @@ class Changelog(db.Model):
 
 class Validationlog(db.Model):
     __tablename__ = "validationlog"
+    # Covers the date-range listings and the per-result counters of the dashboard
+    __table_args__ = (db.Index('ix_validationlog_timestamp_result', 'timestamp', 'result'),)
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.Integer, nullable=False)
     result = db.Column(db.String(40), nullable=False, default='')
@@ -93,3 +110,27 @@ class Validationlog(db.Model):
     apiKey = db.Column(db.String(100), nullable=False, default='')
     serialKey = db.Column(db.String(100), nullable=False, default='')
     hardwareID = db.Column(db.String(200), nullable=False, default='')
+
+
+class ValidationStat(db.Model):
+    # Number of validation logs per day (UTC midnight timestamp), product and result. It is updated as the logs
+    # are written (see database_api.submitValidationLogs), so the dashboard never counts the log table itself.
+    __tablename__ = "validationstat"
+    day = db.Column(db.Integer, primary_key=True)
+    productid = db.Column(db.Integer, primary_key=True)  # 0 when the API key did not match any product
+    result = db.Column(db.String(40), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class MaintenanceJob(db.Model):
+    # State of the periodic maintenance jobs (see scheduler.py). The lease columns make sure a single gunicorn
+    # worker runs each job; the others skip it until 'nextrun'.
+    __tablename__ = "maintenancejob"
+    name = db.Column(db.String(40), primary_key=True)
+    nextrun = db.Column(db.Integer, nullable=False, default=0)
+    leaseowner = db.Column(db.String(100), nullable=True)
+    leaseuntil = db.Column(db.Integer, nullable=True)
+    lastrun = db.Column(db.Integer, nullable=True)
+    lastduration = db.Column(db.Float, nullable=True)  # seconds
+    lastresult = db.Column(db.String(200), nullable=True)
+    runs = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,78 @@
+from sqlalchemy import event, text
+from . import db
+
+# PRAGMA name -> app.config key (applied in this order on every new connection)
+_SETTINGS_ = [('auto_vacuum', 'SQLITE_AUTO_VACUUM'),
+              ('journal_mode', 'SQLITE_JOURNAL_MODE'),
+              ('synchronous', 'SQLITE_SYNCHRONOUS'),
+              ('busy_timeout', 'SQLITE_BUSY_TIMEOUT'),
+              ('cache_size', 'SQLITE_CACHE_SIZE'),
+              ('mmap_size', 'SQLITE_MMAP_SIZE'),
+              ('foreign_keys', 'SQLITE_FOREIGN_KEYS')]
+
+_AUTO_VACUUM_MODES_ = {'NONE': 0, 'FULL': 1, 'INCREMENTAL': 2}
+
+
+def init_app(app):
+    """
+        Applies the configured PRAGMAs to every connection the engine opens.
+        SQLite's defaults are tuned for a single writer: in WAL mode readers no longer block behind the writer,
+        'synchronous=NORMAL' skips the fsync of every commit (the WAL is still synced on checkpoints) and the
+        busy timeout makes concurrent writers from other gunicorn workers wait instead of failing with
+        'database is locked'.
+    """
+    pragmas = [(name, app.config[setting]) for name, setting in _SETTINGS_
+               if app.config.get(setting) is not None]
+
+    def applyPragmas(dbapiConnection, connectionRecord):  # pylint: disable=W0613
+        cursor = dbapiConnection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+
+    with app.app_context():
+        engine = db.get_engine(app)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', applyPragmas)
+
+
+def activeSettings():
+    """
+        Reads back the PRAGMAs in effect on a connection of the current application.
+    """
+    return {name: db.session.execute(text(f"PRAGMA {name}")).scalar() for name, _ in _SETTINGS_}
+
+
+def report(app):
+    """
+        Prints the active SQLite settings at startup, warning about the ones that did not take effect
+        (e.g. WAL is not available for in-memory databases or some network filesystems).
+    """
+    settings = activeSettings()
+    print("SQLite settings: " + ", ".join(f"{name}={value}" for name, value in settings.items()), flush=True)
+    requested = str(app.config.get('SQLITE_JOURNAL_MODE') or '').lower()
+    if requested and str(settings['journal_mode']).lower() != requested:
+        print(f"WARNING: journal_mode={requested} was requested but SQLite is using "
+              f"journal_mode={settings['journal_mode']}.", flush=True)
+    requested = str(app.config.get('SQLITE_AUTO_VACUUM') or '').upper()
+    if requested in _AUTO_VACUUM_MODES_ and settings['auto_vacuum'] != _AUTO_VACUUM_MODES_[requested]:
+        print(f"NOTE: auto_vacuum={requested} only applies to databases created with it (or after a VACUUM).",
+              flush=True)
+
+
+def optimize(analysisLimit=1000, vacuumPages=1000):
+    """
+        Periodic upkeep of the database file (run by the scheduler): refreshes the statistics of the query planner
+        (ANALYZE, sampling at most 'analysisLimit' rows per index) and, in incremental auto_vacuum mode, returns up
+        to 'vacuumPages' free pages to the filesystem.
+    """
+    db.session.execute(text(f"PRAGMA analysis_limit = {int(analysisLimit)}"))
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
+    if db.session.execute(text("PRAGMA auto_vacuum")).scalar() == _AUTO_VACUUM_MODES_['INCREMENTAL']:
+        # Every step of the statement frees a single page and the sqlite3 module stops after the first one (the
+        # statement returns no columns); executescript steps it until it is done
+        db.session.connection().connection.executescript(f"PRAGMA incremental_vacuum({int(vacuumPages)});")
+        db.session.commit()
@@ -0,0 +1,55 @@
+import threading
+import traceback
+from sqlalchemy import event
+from . import db
+
+
+def init_app(app):
+    """
+        When 'SQLITE_EXPLAIN' is enabled, prints the 'EXPLAIN QUERY PLAN' of every distinct SELECT the application
+        runs, along with the database_api function that issued it. Plans that scan a whole table are flagged, so a
+        query that stops using its index is noticed during development instead of in production.
+    """
+    if not app.config['SQLITE_EXPLAIN']:
+        return
+
+    seen = set()
+    lock = threading.Lock()
+
+    def explain(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=W0613
+        if executemany or not statement.lstrip().upper().startswith('SELECT'):
+            return
+        with lock:
+            if statement in seen:
+                return
+            seen.add(statement)
+        try:
+            plan = cursor.connection.execute(
+                "EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+        except Exception as exp:
+            print(f"EXPLAIN QUERY PLAN failed: {exp}", flush=True)
+            return
+        print(formatPlan(caller(), statement, [row[-1] for row in plan]), flush=True)
+
+    with app.app_context():
+        engine = db.get_engine(app)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'before_cursor_execute', explain)
+
+
+def caller():
+    """
+        Name of the innermost database_api function in the current call stack.
+    """
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename.endswith('database_api.py'):
+            return frame.name
+    return '?'
+
+
+def formatPlan(function, statement, details):
+    lines = [f"EXPLAIN QUERY PLAN :: {function}", "    " + " ".join(statement.split())]
+    for detail in details:
+        fullScan = detail.startswith('SCAN') and 'INDEX' not in detail
+        lines.append(("  ! " if fullScan else "    ") + detail)
+    return "\n".join(lines)
@@ -0,0 +1,164 @@
+import atexit
+import click
+import os
+import socket
+import threading
+from flask.cli import with_appcontext
+from time import time, monotonic
+from . import pragmas
+
+
+def _sweepExpiredKeys(app):  # pylint: disable=W0613
+    from . import database_api as DBAPI  # pylint: disable=C0415
+    return f"{DBAPI.sweepExpiredKeys()} license(s) expired"
+
+
+def _rebuildValidationStats(app):  # pylint: disable=W0613
+    from . import database_api as DBAPI  # pylint: disable=C0415
+    # Today and yesterday: the days whose logs may still be written
+    now = int(time())
+    DBAPI.rebuildValidationStats(now - now % 86400 - 86400)
+    return "OK"
+
+
+def _optimizeDatabase(app):
+    pragmas.optimize(app.config['SQLITE_ANALYSIS_LIMIT'], app.config['SQLITE_VACUUM_PAGES'])
+    return "OK"
+
+
+def _archiveValidationLogs(app):
+    from . import database_api as DBAPI  # pylint: disable=C0415
+    # At least two days: the 'validation-stats' job recomputes the counters of today and yesterday from the logs
+    days = max(app.config['VALIDATION_LOG_RETENTION_DAYS'], 2)
+    moved = DBAPI.archiveValidationLogs(int(time()) - days * 86400, app.config['VALIDATION_LOG_RETENTION_CHUNK'])
+    return f"{moved} validation log(s) archived"
+
+
+# Job name -> (app.config key of its interval in seconds, function). A job with an interval of 0 never runs.
+JOBS = {
+    'expiry-sweep': ('JOB_EXPIRY_SWEEP_INTERVAL', _sweepExpiredKeys),
+    'validation-stats': ('JOB_VALIDATION_STATS_INTERVAL', _rebuildValidationStats),
+    'optimize': ('JOB_OPTIMIZE_INTERVAL', _optimizeDatabase),
+    'retention': ('JOB_RETENTION_INTERVAL', _archiveValidationLogs),
+}
+
+
+class MaintenanceScheduler:
+    """
+        Runs the periodic maintenance jobs (JOBS) outside the request path.
+
+        - Every worker process runs a thread that wakes up every 'tick' seconds and tries to claim the jobs
+          that are due. The claim is a lease stored in the 'maintenancejob' table and taken with a single
+          conditional UPDATE, so each run happens in exactly one worker, even across gunicorn workers.
+        - A lease expires after 'leaseTime' seconds, so a worker that dies in the middle of a job does not
+          block it forever.
+        - The start, duration and result of the last run of every job are recorded in the same table.
+
+        Like the validation log sink, the thread is created lazily in the process that serves the first
+        request, which keeps it compatible with gunicorn's '--preload' and with gevent workers.
+    """
+
+    def __init__(self, app, enabled=True, tick=30, leaseTime=900):
+        self.app = app
+        self.enabled = enabled
+        self.tick = tick
+        self.leaseTime = leaseTime
+        self._thread = None
+        self._pid = None
+        self._startLock = threading.Lock()
+        self._stopping = threading.Event()
+
+    @property
+    def owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def ensureStarted(self):
+        if not self.enabled or (self._pid == os.getpid() and self._thread is not None):
+            return
+        with self._startLock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, name='maintenance-scheduler', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread = None
+
+    def runDueJobs(self, names=None, force=False):
+        """
+            Runs the jobs that are due (all of 'names', regardless of their schedule, with 'force') and whose lease
+            this worker gets. Must be called within an application context. Returns the names of the jobs run.
+        """
+        from . import database_api as DBAPI  # pylint: disable=C0415
+        ran = []
+        for name in names or JOBS:
+            interval = self.app.config[JOBS[name][0]]
+            if interval <= 0 and not force:
+                continue
+            startedAt = int(time())
+            if not DBAPI.acquireJobLease(name, self.owner, startedAt, self.leaseTime, force):
+                continue
+
+            start = monotonic()
+            try:
+                result = JOBS[name][1](self.app)
+            except Exception as exp:
+                DBAPI.rollbackSession()
+                result = f"ERROR: {exp}"
+            duration = monotonic() - start
+            DBAPI.finishJob(name, self.owner, startedAt, duration, result, startedAt + max(interval, 0))
+            print(f"Maintenance job '{name}' finished in {duration:.2f}s: {result}", flush=True)
+            ran.append(name)
+        return ran
+
+    # ##########################################################################
+
+    def _run(self):
+        stopping = self._stopping
+        while not stopping.wait(self.tick):
+            try:
+                with self.app.app_context():
+                    self.runDueJobs()
+            except Exception as exp:
+                print(f"Maintenance scheduler failed: {exp}", flush=True)
+
+
+@click.command('run-maintenance')
+@click.argument('names', nargs=-1, type=click.Choice(list(JOBS)))
+@with_appcontext
+def runMaintenanceCommand(names):
+    """
+        Runs the given maintenance jobs now (all of them by default), unless another worker is running them.
+    """
+    ran = scheduler.runDueJobs(list(names) or None, force=True)
+    for name in set(names or JOBS) - set(ran):
+        print(f"Maintenance job '{name}' is already running in another worker.", flush=True)
+
+
+scheduler = None
+
+
+def init_app(app):
+    global scheduler  # pylint: disable=W0603
+    scheduler = MaintenanceScheduler(app,
+                                     enabled=app.config['SCHEDULER_ENABLED'],
+                                     tick=app.config['SCHEDULER_TICK'],
+                                     leaseTime=app.config['SCHEDULER_LEASE'])
+    app.before_request(scheduler.ensureStarted)
+    app.cli.add_command(runMaintenanceCommand)
+
+
+def registerJobs():
+    from . import database_api as DBAPI  # pylint: disable=C0415
+    DBAPI.registerJobs(list(JOBS))
+
+
+def enabled():
+    return scheduler is not None and scheduler.enabled
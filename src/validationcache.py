@@ -0,0 +1,139 @@
+import os
+from time import time
+from .cache import BoundedCache
+
+
+class StampFile:
+    """
+        File shared by the gunicorn workers of one database: touching it tells every worker to drop the caches
+        that watch it (see SharedCache). A missing path (e.g. when testing) turns it into a no-op.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def read(self):
+        """
+            Modification time of the file (nanoseconds), None if it does not exist (yet).
+        """
+        if self.path is None:
+            return None
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def touch(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'a', encoding='utf-8'):
+                os.utime(self.path, None)
+        except OSError as exp:
+            print(f"Failed to propagate the cache eviction: {exp}", flush=True)
+
+
+class SharedCache(BoundedCache):
+    """
+        BoundedCache whose evictions reach the other gunicorn workers: 'evict' and 'clear' touch 'stamp', and a
+        worker drops all its entries on the first lookup after the stamp changed.
+    """
+
+    def __init__(self, maxsize=128, ttl=None, stamp=None):
+        super().__init__(maxsize, ttl)
+        self.stamp = stamp if stamp is not None else StampFile()
+        self._seen = self.stamp.read()
+
+    def get(self, key, default=None):
+        seen = self.stamp.read()
+        if seen != self._seen:
+            self._seen = seen
+            super().clear()
+        return super().get(key, default)
+
+    def evict(self, predicate):
+        super().evict(predicate)
+        self.stamp.touch()
+
+    def clear(self):
+        super().clear()
+        self.stamp.touch()
+
+
+class ValidationCache:
+    """
+        Remembers, for a short time, that a (product, serial key, hardware ID) tuple belongs to a device that is
+        registered on a valid license, so repeat validations are answered without touching the database.
+
+        - Entries live for 'ttl' seconds at most, and never beyond the remaining validity of the license.
+        - The administrator actions that change a license evict its entries (see database_api.py).
+        - Every gunicorn worker keeps its own cache. Evictions are propagated to the other workers by touching
+          'stampFile': when its modification time changes, the whole cache of the worker is dropped.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60, stampFile=None):
+        self.ttl = ttl
+        self.stampFile = stampFile
+        self._entries = SharedCache(maxsize=maxsize, ttl=ttl, stamp=StampFile(stampFile))
+
+    def get(self, productID, serialKey, hardwareID):
+        """
+            Returns the expiration date of the license if the device's validation result is cached, otherwise None.
+        """
+        return self._entries.get((productID, serialKey, hardwareID))
+
+    def set(self, productID, serialKey, hardwareID, expiryDate, validUntil=None):
+        ttl = self.ttl
+        if validUntil:
+            ttl = min(ttl, int(validUntil) - int(time()))
+        if ttl > 0:
+            self._entries.set((productID, serialKey, hardwareID), expiryDate, ttl)
+
+    def evictSerial(self, serialKey):
+        self._entries.evict(lambda key: key[1] == serialKey)
+
+    def evictProduct(self, productID):
+        self._entries.evict(lambda key: key[0] == int(productID))
+
+    def clear(self):
+        self._entries.clear()
+
+
+cache = None
+# Watched by the caches that must be dropped in every worker, whether or not the validation cache is enabled
+stamp = StampFile()
+
+
+def init_app(app):
+    global cache  # pylint: disable=W0603
+    cache = None
+    stamp.path = app.config['VALIDATION_CACHE_STAMP']
+    if app.config['VALIDATION_CACHE_TTL'] > 0:
+        cache = ValidationCache(app.config['VALIDATION_CACHE_SIZE'], app.config['VALIDATION_CACHE_TTL'],
+                                app.config['VALIDATION_CACHE_STAMP'])
+
+
+def get(productID, serialKey, hardwareID):
+    if cache is None:
+        return None
+    return cache.get(productID, serialKey, hardwareID)
+
+
+def set(productID, serialKey, hardwareID, expiryDate, validUntil=None):  # pylint: disable=W0622
+    if cache is not None:
+        cache.set(productID, serialKey, hardwareID, expiryDate, validUntil)
+
+
+def evictSerial(serialKey):
+    if cache is not None:
+        cache.evictSerial(serialKey)
+
+
+def evictProduct(productID):
+    if cache is not None:
+        cache.evictProduct(productID)
+
+
+def clear():
+    if cache is not None:
+        cache.clear()
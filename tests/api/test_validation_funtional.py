@@ -4,7 +4,8 @@ from uuid import uuid4
 import pytest
 from src import database_api, db
 from src.models import Product, Client, Key, Registration
-from src.keys import create_product_keys, generateSerialKey
+from src.keys import create_product_keys, generateSerialKey, verify_lease, ecies_encrypt, get_key_type
+from src.handlers.utils import PemToXML
 from datetime import datetime
 from time import time
 from cryptography.hazmat.primitives.asymmetric import padding
@@ -685,3 +686,264 @@ def test_bad_encryption(auth, client, app, created_product_1, created_product_2,
         licenseEntry = database_api.getKeyData(created_license.id)
         assert licenseEntry.devices == 0
         assert licenseEntry.maxdevices >= licenseEntry.devices
+
+
+def encrypt_payload(publicK, serialKey, hardwareID):
+    return encrypt_raw_payload(publicK, serialKey + ':' + hardwareID)
+
+
+def encrypt_raw_payload(publicK, data):
+    public_key = serialization.load_pem_public_key(publicK)
+    payload = public_key.encrypt(
+        bytes(data, 'utf-8'),
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+    )
+    return base64.b64encode(payload).decode('utf-8')
+
+
+@pytest.fixture
+def created_valid_license(app, created_customer, created_product_1):
+    with app.app_context():
+        keyId = database_api.createKey(created_product_1.id, created_customer.id, generateSerialKey(20), 2,
+                                       int(time()) + 30 * 86400)
+        key = Key.query.filter_by(id=keyId).first()
+    yield key
+
+
+def test_batch_validation(client, app, created_product_1, created_customer, created_valid_license):
+    """Tests if the batch endpoint validates every item and answers in the same order
+
+    Parameters
+    ----------
+    client : FlaskClient
+        The test client to use for requests
+
+    app :  FlaskApp
+        The app needed to query the Database
+
+    created_product_1 : Product
+        Product ORM object added to the database before the test (fixture)
+
+    created_customer : Customer
+        Customer ORM object added to the database before the test (fixture)
+
+    created_valid_license : Key
+        License ORM object (not yet expired, 2 devices) added to the database before the test (fixture)
+
+    Returns
+    -------
+    """
+
+    hw_ids = [str(uuid4()) for _ in range(3)]
+    items = [{'apiKey': created_product_1.apiK,
+              'payload': encrypt_payload(created_product_1.publicK, created_valid_license.serialkey, hw_id)}
+             for hw_id in hw_ids]
+    items.append(items[0])
+    items.append({'apiKey': str(uuid4()), 'payload': items[0]['payload']})
+    items.append({'apiKey': created_product_1.apiK, 'payload': encrypt_payload(
+        created_product_1.publicK, 'AAAAA-BBBBB-CCCCC-DDDDD', hw_ids[0])})
+
+    response = client.post("/api/v1/validate/batch", json=items)
+    assert response.status_code == 200
+    codes = [entry['Code'] for entry in json.loads(response.data)]
+    assert codes == ['SUCCESS', 'SUCCESS', 'ERR_KEY_DEVICES_FULL',
+                     'OKAY', 'ERR_API_KEY', 'ERR_SERIAL_KEY']
+
+    with app.app_context():
+        licenseEntry = database_api.getKeyData(created_valid_license.id)
+        assert licenseEntry.devices == 2
+        assert len(database_api.getKeyHWIDs(created_valid_license.id)) == 2
+        assert len(list(database_api.queryValidationLogs())) == len(items)
+
+    response = client.post("/api/v1/validate/batch", json={'items': []})
+    assert response.status_code == 400
+
+
+def test_batch_validation_malformed_items(client, app, created_product_1, created_customer, created_valid_license):
+    """Tests if malformed items of a batch get their own error response while the valid items are still validated
+
+    Parameters
+    ----------
+    client : FlaskClient
+        The test client to use for requests
+
+    app :  FlaskApp
+        The app needed to query the Database
+
+    created_product_1 : Product
+        Product ORM object added to the database before the test (fixture)
+
+    created_customer : Customer
+        Customer ORM object added to the database before the test (fixture)
+
+    created_valid_license : Key
+        License ORM object (not yet expired, 2 devices) added to the database before the test (fixture)
+
+    Returns
+    -------
+    """
+
+    publicK, serialKey = created_product_1.publicK, created_valid_license.serialkey
+    items = [{'apiKey': created_product_1.apiK, 'payload': encrypt_payload(publicK, serialKey, str(uuid4()))},
+             {'apiKey': created_product_1.apiK, 'payload': encrypt_raw_payload(publicK, 'NO-SEPARATOR')},
+             {'apiKey': created_product_1.apiK, 'payload': encrypt_raw_payload(publicK, serialKey + ':a:b')},
+             {'apiKey': created_product_1.apiK, 'payload': encrypt_payload(publicK, serialKey, str(uuid4()))}]
+
+    response = client.post("/api/v1/validate/batch", json=items)
+    assert response.status_code == 200
+    codes = [entry['Code'] for entry in json.loads(response.data)]
+    assert codes == ['SUCCESS', 'ERR_PUB_PRIV_KEY', 'ERR_PUB_PRIV_KEY', 'SUCCESS']
+
+    # The single endpoint rejects the same payload the same way
+    response = client.post("/api/v1/validate", json=items[1])
+    assert json.loads(response.data)['Code'] == 'ERR_PUB_PRIV_KEY'
+
+
+def test_validation_lease(client, app, created_product_1, created_customer, created_valid_license):
+    """Tests if a successful validation returns an offline lease signed with the product's private key
+
+    Parameters
+    ----------
+    client : FlaskClient
+        The test client to use for requests
+
+    app :  FlaskApp
+        The app needed to query the Database
+
+    created_product_1 : Product
+        Product ORM object added to the database before the test (fixture)
+
+    created_customer : Customer
+        Customer ORM object added to the database before the test (fixture)
+
+    created_valid_license : Key
+        License ORM object (not yet expired, 2 devices) added to the database before the test (fixture)
+
+    Returns
+    -------
+    """
+
+    hw_id = str(uuid4())
+    json_info = {
+        'apiKey': created_product_1.apiK,
+        'payload': encrypt_payload(created_product_1.publicK, created_valid_license.serialkey, hw_id)
+    }
+
+    response = client.post("/api/v1/validate", json=json_info)
+    loaded_response = json.loads(response.data)
+    assert loaded_response['Code'] == "SUCCESS"
+
+    public_key = serialization.load_pem_public_key(created_product_1.publicK)
+    claims = verify_lease(public_key, loaded_response['Lease'])
+    assert claims['serialKey'] == created_valid_license.serialkey
+    assert claims['hardwareID'] == hw_id
+    assert claims['issuedAt'] < claims['leaseExpiry'] <= created_valid_license.expirydate
+
+    body, signature = loaded_response['Lease'].split('.')
+    assert verify_lease(public_key, body + 'x.' + signature) is None
+
+    json_info['apiKey'] = str(uuid4())
+    response = client.post("/api/v1/validate", json=json_info)
+    assert 'Lease' not in json.loads(response.data)
+
+
+def test_session_token_validation(client, app, created_product_1, created_product_2, created_customer, created_valid_license):
+    """Tests if the session token issued by an RSA validation can replace the payload on later checks
+
+    Parameters
+    ----------
+    client : FlaskClient
+        The test client to use for requests
+
+    app :  FlaskApp
+        The app needed to query the Database
+
+    created_product_1 : Product
+        Product (1) ORM object added to the database before the test (fixture)
+
+    created_product_2 : Product
+        Product (2) ORM object added to the database before the test (fixture)
+
+    created_customer : Customer
+        Customer ORM object added to the database before the test (fixture)
+
+    created_valid_license : Key
+        License ORM object (not yet expired, 2 devices) added to the database before the test (fixture)
+
+    Returns
+    -------
+    """
+
+    hw_id = str(uuid4())
+    response = client.post("/api/v1/validate", json={
+        'apiKey': created_product_1.apiK,
+        'payload': encrypt_payload(created_product_1.publicK, created_valid_license.serialkey, hw_id)
+    })
+    token = json.loads(response.data)['SessionToken']
+
+    response = client.post("/api/v1/validate", json={'apiKey': created_product_1.apiK, 'sessionToken': token})
+    loaded_response = json.loads(response.data)
+    assert loaded_response['Code'] == "OKAY"
+    assert loaded_response['HardwareID'] == hw_id
+    assert 'SessionToken' not in loaded_response
+
+    response = client.post("/api/v1/validate", json={'apiKey': created_product_2.apiK, 'sessionToken': token})
+    assert json.loads(response.data)['Code'] == "ERR_SESSION_TOKEN"
+
+    body, mac = token.split('.')
+    response = client.post("/api/v1/validate", json={'apiKey': created_product_1.apiK,
+                                                     'sessionToken': body[:-2] + 'xx.' + mac})
+    assert json.loads(response.data)['Code'] == "ERR_SESSION_TOKEN"
+
+
+def test_x25519_product_validation(client, app, created_customer):
+    """Tests if products with X25519 keys validate payloads encrypted with the ECIES scheme
+
+    Parameters
+    ----------
+    client : FlaskClient
+        The test client to use for requests
+
+    app :  FlaskApp
+        The app needed to query the Database
+
+    created_customer : Customer
+        Customer ORM object added to the database before the test (fixture)
+
+    Returns
+    -------
+    """
+
+    with app.app_context():
+        product_keys = create_product_keys('X25519')
+        product = database_api.createProduct('X25519 product', 'CAT 003SA', '', 'Testing product only',
+                                             product_keys[0], product_keys[1], product_keys[2])
+        keyId = database_api.createKey(product.id, created_customer.id, generateSerialKey(20), 1,
+                                       int(time()) + 30 * 86400)
+        serialKey = database_api.getKeyData(keyId).serialkey
+        assert get_key_type(product.publicK) == 'X25519'
+        assert PemToXML(product.publicK).startswith('<X25519KeyValue>')
+
+    public_key = serialization.load_pem_public_key(product_keys[1])
+    hw_id = str(uuid4())
+    payload = ecies_encrypt(public_key, bytes(serialKey + ':' + hw_id, 'utf-8'))
+    response = client.post("/api/v1/validate", json={
+        'apiKey': product_keys[2],
+        'payload': base64.b64encode(payload).decode('utf-8')
+    })
+    loaded_response = json.loads(response.data)
+    assert loaded_response['Code'] == "SUCCESS"
+    assert loaded_response['HardwareID'] == hw_id
+    assert 'Lease' not in loaded_response
+
+    tampered = bytearray(payload)
+    tampered[-1] ^= 1
+    response = client.post("/api/v1/validate", json={
+        'apiKey': product_keys[2],
+        'payload': base64.b64encode(bytes(tampered)).decode('utf-8')
+    })
+    assert json.loads(response.data)['Code'] == "ERR_PUB_PRIV_KEY"
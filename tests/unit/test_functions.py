@@ -1,6 +1,15 @@
-from src import database_api as DBAPI
-from src.handlers import customers, licenses, utils
-from src import keys
+from src import db, database_api as DBAPI
+from src.models import Changelog
+from src.handlers import customers, licenses, logs, products, search, utils
+from src import keys, decryptpool, exports, licensebatch, validationcache
+from flask_login import login_user
+from sqlalchemy.exc import IntegrityError
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives import hashes, serialization
+import base64
+import csv
+import gzip
+import json
 import pytest
 import time
 
@@ -161,3 +170,398 @@ def test_utils():
             'name'), newCustomer.get('email'), newCustomer.get('phone'))
     except Exception as exc:
         assert False, f"'newcustomer_validation' raised an exception {exc}"
+
+
+def test_private_key_cache(app):
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Cached product', 'CAT 003SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+
+        first = keys.get_private_key(product)
+        assert keys.get_private_key(product) is first
+
+        DBAPI.editProduct(product.id, 'Cached product', 'CAT 004ZA', '', 'Edited')
+        assert keys.get_private_key(product) is not first
+
+
+def test_lease_cache(app, monkeypatch):
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Leased product', 'CAT 003SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        public_key = serialization.load_pem_public_key(product_keys[1])
+        lease = keys.sign_lease(product, 'AAAAA-BBBBB', 'HWID', 0, 3600)
+
+        # Repeat validations reuse the signed lease instead of signing a new one
+        now = time.time()
+        monkeypatch.setattr(keys, 'time', lambda: now + 600)
+        assert keys.sign_lease(product, 'AAAAA-BBBBB', 'HWID', 0, 3600) == lease
+        assert keys.sign_lease(product, 'AAAAA-BBBBB', 'OTHER', 0, 3600) != lease
+
+        # Editing the product drops its leases
+        DBAPI.editProduct(product.id, 'Leased product', 'CAT 004ZA', '', 'Edited')
+        renewed = keys.sign_lease(product, 'AAAAA-BBBBB', 'HWID', 0, 3600)
+        assert renewed != lease
+        assert keys.verify_lease(public_key, renewed)['issuedAt'] == int(now + 600)
+
+
+def test_api_key_cache(app):
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        assert DBAPI.getProductRecordThroughAPI(product_keys[2]) is None
+
+        product = DBAPI.createProduct('Cached product', 'CAT 003SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        record = DBAPI.getProductRecordThroughAPI(product_keys[2])
+        assert record.id == product.id
+        assert record.name == 'Cached product'
+
+        DBAPI.deleteProduct(product.id)
+        assert DBAPI.getProductRecordThroughAPI(product_keys[2]) is None
+
+
+def test_decrypt_executor():
+    product_keys = keys.create_product_keys()
+    product = DBAPI.ProductRecord(1, 'Pooled product', product_keys[0])
+    public_key = serialization.load_pem_public_key(product_keys[1])
+    payload = base64.b64encode(public_key.encrypt(b'AAAAA-BBBBB:HWID', padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None))).decode('utf-8')
+
+    executor = decryptpool.DecryptExecutor(1, loadKeys=lambda: [product])
+    try:
+        assert executor.decrypt(payload, product) == ['AAAAA-BBBBB', 'HWID']
+        results = executor.decryptMany([(payload, product), ('invalid', product)])
+        assert results[0] == ['AAAAA-BBBBB', 'HWID']
+        assert isinstance(results[1], Exception)
+        lease = keys.sign_lease(product, 'AAAAA-CCCCC', 'HWID', 0, 3600, executor.sign)
+        assert keys.verify_lease(public_key, lease)['hardwareID'] == 'HWID'
+    finally:
+        executor.shutdown()
+
+
+def test_validation_cache(app, tmp_path):
+    # Two workers sharing the same stamp file
+    stamp = str(tmp_path / 'sqlite.db.cache-stamp')
+    worker1 = validationcache.ValidationCache(ttl=60, stampFile=stamp)
+    worker2 = validationcache.ValidationCache(ttl=60, stampFile=stamp)
+    worker1.set(1, 'AAAAA-BBBBB', 'HWID', 0)
+    worker2.set(1, 'AAAAA-BBBBB', 'HWID', 0)
+    worker1.set(1, 'AAAAA-CCCCC', 'HWID', 100, int(time.time()) - 1)
+    assert worker1.get(1, 'AAAAA-BBBBB', 'HWID') == 0
+    assert worker1.get(1, 'AAAAA-CCCCC', 'HWID') is None
+
+    worker1.evictSerial('AAAAA-BBBBB')
+    assert worker1.get(1, 'AAAAA-BBBBB', 'HWID') is None
+    assert worker2.get(1, 'AAAAA-BBBBB', 'HWID') is None
+
+    # The administrator actions evict the cached results of the license
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Cached product', 'CAT 003SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        DBAPI.createCustomer('Test Customer', 'test@customer.com', '123456789', 'PORTUGAL')
+        keyid = DBAPI.createKey(product.id, 1, 'AAAAA-DDDDD', 1, 0)
+        validationcache.set(product.id, 'AAAAA-DDDDD', 'HWID', 0)
+        assert validationcache.get(product.id, 'AAAAA-DDDDD', 'HWID') == 0
+        DBAPI.setKeyState(keyid, 2)
+        assert validationcache.get(product.id, 'AAAAA-DDDDD', 'HWID') is None
+
+
+def test_api_key_cache_eviction(app, tmp_path, monkeypatch):
+    # The worker that changes a product clears the API key cache of the other workers
+    stamp = validationcache.StampFile(str(tmp_path / 'sqlite.db.cache-stamp'))
+    monkeypatch.setattr(validationcache.stamp, 'path', stamp.path)
+    worker2 = validationcache.SharedCache(stamp=validationcache.StampFile(stamp.path))
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        assert DBAPI.getProductRecordThroughAPI(product_keys[2]) is None
+        worker2.set(product_keys[2], None)
+        product = DBAPI.createProduct('Shared product', 'CAT 003SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        assert worker2.get(product_keys[2], 'missing') == 'missing'
+        assert DBAPI.getProductRecordThroughAPI(product_keys[2]).id == product.id
+
+
+def test_license_pages(app):
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Paged product', 'CAT 003SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        productID = product.id
+        DBAPI.createCustomer('Test Customer', 'test@customer.com', '123456789', 'PORTUGAL')
+        for serial in ['CCCCC-00001', 'AAAAA-00002', 'BBBBB-00003', 'AAAAA-00004', 'DDDDD-00005']:
+            DBAPI.createKey(productID, 1, serial, 2, 0)
+        DBAPI.claimSeat(2, 'HWID-PAGED')
+        DBAPI.setKeyState(5, 2)
+
+        # Walk every page, sorted by serial key
+        serials, cursor = [], None
+        while True:
+            page = json.loads(products.queryLicenses(productID, {'sort': 'serialkey', 'limit': '2', 'cursor': cursor}))
+            assert page['total'] == (5 if cursor is None else None)
+            serials += [license['serialkey'] for license in page['licenses']]
+            cursor = page['next']
+            if cursor is None:
+                break
+        assert serials == sorted(serials) and len(serials) == 5
+
+        page = json.loads(products.queryLicenses(productID, {'serial': 'aaaaa', 'order': 'desc'}))
+        assert [license['id'] for license in page['licenses']] == [4, 2]
+        page = json.loads(products.queryLicenses(productID, {'hwid': 'HWID-P'}))
+        assert [license['hwids'] for license in page['licenses']] == [['HWID-PAGED']]
+        page = json.loads(products.queryLicenses(productID, {'status': '2'}))
+        assert [license['serialkey'] for license in page['licenses']] == ['DDDDD-00005']
+
+        assert products.queryLicenses(productID, {'sort': 'name'})[1] == 400
+        assert products.queryLicenses(productID, {'cursor': 'invalid'})[1] == 400
+
+
+def test_search(app):
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Searchable Suite', 'Office', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        productID = product.id
+        DBAPI.createCustomer('Maria Silva', 'maria@customer.com', '912345678', 'PORTUGAL')
+        DBAPI.createCustomer('Mario Rossi', 'mario@customer.com', '333444555', 'ITALY')
+        keyID = DBAPI.createKey(productID, 1, 'SRCH1-ABCDE-FGHIJ', 2, 0)
+        DBAPI.claimSeat(keyID, 'CPU0_BFEBFBFF000806C3')
+
+        assert [result.label for result in DBAPI.search('mar', ['customer'])] == ['Maria Silva', 'Mario Rossi']
+        assert [result.label for result in DBAPI.search('maria@')] == ['Maria Silva']
+        assert [(result.kind, result.id) for result in DBAPI.search('srch1')] == [('license', keyID)]
+        assert [(result.kind, result.id, result.productid) for result in DBAPI.search('cpu0_bfe')] == \
+            [('device', keyID, productID)]
+        assert [result.kind for result in DBAPI.search('searchable office')] == ['product']
+        assert DBAPI.search('"') == [] and DBAPI.search('  ') == []
+
+        # The index follows the writes on the source tables
+        maria = DBAPI.getCustomer('Maria')[0]
+        DBAPI.modifyCustomer(maria.id, 'Joana Silva', 'joana@customer.com', '912345678', 'PORTUGAL')
+        assert [result.label for result in DBAPI.search('mar', ['customer'])] == ['Mario Rossi']
+        assert [customer.name for customer in DBAPI.getCustomer('oana Sil')] == ['Joana Silva']
+        assert [product.name for product in DBAPI.getProduct('able Su')] == ['Searchable Suite']
+        DBAPI.deleteKey(keyID)
+        assert DBAPI.search('srch1') == [] and DBAPI.search('cpu0') == []
+
+        page = json.loads(search.search({'q': 'silva', 'kind': 'customer,license'}))
+        assert [result['label'] for result in page['results']] == ['Joana Silva']
+        assert search.search({'q': 'silva', 'kind': 'users'})[1] == 400
+
+        # The product filter is applied before the limit: matches of other products cannot crowd out its own
+        other_keys = keys.create_product_keys()
+        other = DBAPI.createProduct('Other Suite', 'Office', '', 'Testing product only',
+                                    other_keys[0], other_keys[1], other_keys[2])
+        list(DBAPI.createKeys(other.id, 1, [[f'BATCH-OTHER-{index}' for index in range(60)]], 1, 0))
+        ownKey = DBAPI.createKey(productID, 1, 'BATCH-OWN-0', 1, 0)
+        page = json.loads(search.search({'q': 'batch', 'kind': 'license', 'product': str(productID), 'limit': '2'}))
+        assert [result['id'] for result in page['results']] == [ownKey]
+        assert [result.id for result in DBAPI._searchByPrefix('BATCH', ['license'], 2, productID)] == [ownKey]
+
+
+def test_changelog_pages(app):
+    with app.app_context():
+        # Several entries share each timestamp, so the pages must also be keyed on the id
+        db.session.execute(Changelog.__table__.insert(), [
+            {'userid': 1 + index % 2, 'timestamp': 1000 + index // 7, 'action': 'Test', 'description': f'Log {index}'}
+            for index in range(250)])
+        db.session.commit()
+
+        def page(**params):
+            query = dict({'adminid': -1, 'datestart': -1, 'dateend': -1}, **params)
+            with app.test_request_context():
+                return json.loads(logs.queryLogs(query).get_data(as_text=True))
+
+        entries, cursor = [], None
+        while True:
+            result = page(limit=120, cursor=cursor)
+            entries += result['logs']
+            cursor = result['next']
+            if cursor is None:
+                break
+        assert len(entries) == 250 and len({entry['id'] for entry in entries}) == 250
+        assert entries == sorted(entries, key=lambda entry: (entry['timestamp'], entry['id']), reverse=True)
+
+        result = page(adminid=2, datestart=1010, dateend=1019)
+        assert {entry['adminid'] for entry in result['logs']} == {2} and result['next'] is None
+        assert all(1010 <= entry['timestamp'] <= 1019 for entry in result['logs'])
+        assert page(limit='0')['next'] is not None and len(page(limit='0')['logs']) == 1
+        assert logs.queryLogs({'adminid': -1, 'datestart': -1, 'dateend': -1, 'cursor': '!'})[1] == 400
+
+
+def test_validation_log_pages(app):
+    with app.app_context():
+        DBAPI.submitValidationLogs([
+            {'timestamp': 1000 + index // 7, 'result': 'SUCCESS' if index % 3 else 'ERROR', 'type': 'Validation',
+             'ipaddress': '127.0.0.1', 'apiKey': 'api-key', 'serialKey': f'SERIAL-{index}', 'hardwareID': 'HWID'}
+            for index in range(250)])
+
+        def page(**params):
+            query = dict({'typeSearch': '', 'datestart': -1, 'dateend': -1}, **params)
+            with app.test_request_context():
+                return json.loads(logs.queryValidationLogs(query).get_data(as_text=True))
+
+        entries, cursor = [], None
+        while True:
+            result = page(limit=120, cursor=cursor)
+            entries += result['logs']
+            cursor = result['next']
+            if cursor is None:
+                break
+        assert len({entry['serialKey'] for entry in entries}) == 250
+        assert [entry['timestamp'] for entry in entries] == sorted((entry['timestamp'] for entry in entries),
+                                                                   reverse=True)
+        result = page(typeSearch='ERROR', datestart=1010, dateend=1019)
+        assert {entry['result'] for entry in result['logs']} == {'ERROR'} and result['next'] is None
+        assert logs.queryValidationLogs({'typeSearch': '', 'datestart': -1, 'dateend': -1, 'cursor': '!'})[1] == 400
+
+
+def test_validation_log_export(app, tmp_path):
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Exported product', 'CAT 004SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        apiKey = product.apiK
+        DBAPI.submitValidationLogs([
+            {'timestamp': 2000 + index, 'result': 'SUCCESS' if index % 3 else 'ERROR', 'type': 'Validation',
+             'ipaddress': '127.0.0.1', 'apiKey': apiKey if index % 2 else 'other', 'serialKey': f'SERIAL-{index % 5}',
+             'hardwareID': 'HWID, "quoted"'} for index in range(23)])
+
+        # Small chunks, so the rows go through several fetches
+        lines = b''.join(exports.exportValidationLogs(chunkRows=4)).decode('utf-8').splitlines()
+        rows = [json.loads(line) for line in lines]
+        assert [row['timestamp'] for row in rows] == list(range(2000, 2023))
+        assert rows[0]['hardwareID'] == 'HWID, "quoted"'
+
+        filters = {'result': 'SUCCESS', 'productid': product.id, 'timestampStart': 2005, 'timestampEnd': 2015}
+        compressed = b''.join(exports.exportValidationLogs(filters, 'csv', compress=True, chunkRows=4))
+        table = list(csv.reader(gzip.decompress(compressed).decode('utf-8').splitlines()))
+        assert tuple(table[0]) == exports.VALIDATION_LOG_COLUMNS
+        assert [int(row[1]) - 2000 for row in table[1:]] == [5, 7, 11, 13]
+        assert table[1][7] == 'HWID, "quoted"'
+
+        output = tmp_path / 'export.ndjson'
+        result = app.test_cli_runner().invoke(args=['export-validation-logs', '--serial', 'SERIAL-1', '-o', str(output)])
+        assert result.exit_code == 0
+        assert [json.loads(line)['timestamp'] for line in output.read_text().splitlines()] == [2001, 2006, 2011, 2016, 2021]
+
+        with app.test_request_context():
+            assert logs.exportValidationLogs({'format': 'xml'})[1] == 400
+            response = logs.exportValidationLogs({'format': 'csv', 'gzip': '1', 'result': 'ERROR'})
+            assert response.mimetype == 'application/gzip'
+            assert len(gzip.decompress(response.get_data()).decode('utf-8').splitlines()) == 1 + 8
+
+
+def test_validation_rollups(app):
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Counted product', 'CAT 005SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        productID, apiKey = product.id, product.apiK
+        today = int(time.time()) - int(time.time()) % 86400
+
+        def row(timestamp, result, key):
+            return {'timestamp': timestamp, 'result': result, 'type': 'Validation', 'ipaddress': '127.0.0.1',
+                    'apiKey': key, 'serialKey': 'SERIAL', 'hardwareID': 'HWID'}
+
+        DBAPI.submitValidationLogs([row(today + 10, 'SUCCESS', apiKey), row(today + 20, 'SUCCESS', apiKey),
+                                    row(today - 86400, 'ERROR', 'unknown'), row(today - 40 * 86400, 'SUCCESS', apiKey)])
+        DBAPI.submitValidationLogs([row(today + 30, 'SUCCESS', apiKey)])
+        DBAPI.submitValidationLog('ERROR', 'Validation', '127.0.0.1', apiKey, 'SERIAL', 'HWID')
+
+        # The counters are kept per day, product and result as the logs are written
+        assert DBAPI.queryValidationsStats() == (3, 2)
+        assert [tuple(stat) for stat in DBAPI.getDailyValidationStats(30, productID)] == \
+            [(today, 'ERROR', 1), (today, 'SUCCESS', 3)]
+        assert [tuple(stat) for stat in DBAPI.getDailyValidationStats(60)][0] == (today - 40 * 86400, 'SUCCESS', 1)
+
+
+def test_bulk_license_creation(app, tmp_path, monkeypatch):
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Bulk product', 'CAT 008SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        productID = product.id
+        DBAPI.generateUser('BulkAdmin', 'password', 'bulk@admin.com')
+        admin = DBAPI.obtainUser('BulkAdmin')
+        DBAPI.createCustomer('Test Customer', 'test@customer.com', '123456789', 'PORTUGAL')
+
+        # Small chunks, so the licenses are written in several transactions
+        progress = []
+        chunks = list(licensebatch.createLicenses(productID, 1, 12, 2, 0, 1, 30, admin, chunkSize=5,
+                                                  progress=lambda created, total: progress.append((created, total))))
+        assert [len(rows) for rows in chunks] == [5, 5, 2]
+        assert progress == [(5, 12), (10, 12), (12, 12)]
+        created = [key for key in DBAPI.getKeys(productID)]
+        assert sorted(key.id for key in created) == sorted(keyID for rows in chunks for keyID, _ in rows)
+        assert all(key.expirytype == 1 and key.expirydays == 30 and key.maxdevices == 2 for key in created)
+        keyID, serial = chunks[2][1]
+        assert DBAPI.getKeyData(keyID).serialkey == serial
+        assert DBAPI.getKeyData(keyID).effectiveexpiry is None
+        assert [log.description for log, _ in DBAPI.getKeyLogs(keyID)] == [
+            f"$$BulkAdmin$$ created license #{keyID} for product #{productID}"]
+
+        with app.test_request_context():
+            login_user(admin)
+            request = {'idclient': 1, 'maxdevices': 1, 'expirydate': 0, 'quantity': 7, 'format': 'csv'}
+            response = licenses.createLicense(productID, request)
+            assert response.mimetype == 'text/csv'
+            table = list(csv.reader(response.get_data().decode('utf-8').splitlines()))
+            assert tuple(table[0]) == licensebatch.LICENSE_COLUMNS and len(table) == 1 + 7
+            assert DBAPI.getKeyData(int(table[1][0])).serialkey == table[1][1]
+
+            request = dict(request, quantity=app.config['LICENSE_BATCH_MAX'] + 1)
+            assert licenses.createLicense(productID, request)[1] == 500
+
+        # A chunk that fails (here, a serial key of the previous chunk) aborts the CSV after the licenses created before it
+        batches = iter([['FAIL-1', 'FAIL-2'], ['FAIL-1', 'FAIL-3']])
+        monkeypatch.setattr(licensebatch, 'generateSerialKeys', lambda count, length, taken: next(batches))
+        response = licensebatch.licensesCSV(licensebatch.createLicenses(productID, 1, 4, 1, 0, chunkSize=2))
+        received = [next(response), next(response)]
+        with pytest.raises(IntegrityError):
+            next(response)
+        assert received[1].decode('utf-8').count('FAIL-') == 2
+        assert DBAPI.existingSerialKeys(['FAIL-1', 'FAIL-2', 'FAIL-3']) == {'FAIL-1', 'FAIL-2'}
+        monkeypatch.undo()
+
+        output = tmp_path / 'licenses.csv'
+        result = app.test_cli_runner().invoke(args=['create-licenses', str(productID), '1', '-n', '3',
+                                                    '--admin', 'BulkAdmin', '-o', str(output)])
+        assert result.exit_code == 0
+        assert len(output.read_text().splitlines()) == 1 + 3
+        assert len(DBAPI.getKeys(productID)) == 12 + 7 + 2 + 3
+
+
+def test_serial_key_batch(app, tmp_path, monkeypatch):
+    serials = keys.generateSerialKeys(2000)
+    assert len(set(serials)) == 2000
+    assert all(len(serial) == 23 and serial.count('-') == 3 for serial in serials)
+    assert set(''.join(serials).replace('-', '')) <= set(keys._SERIAL_ALPHABET_)
+    assert len(keys.generateSerialKey(7)) == 8
+
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Serial product', 'CAT 009SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        DBAPI.createCustomer('Test Customer', 'test@customer.com', '123456789', 'PORTUGAL')
+        DBAPI.createKey(product.id, 1, 'TAKEN', 1, 0)
+
+        # Duplicates within the batch and serial keys already in use are the only ones generated again
+        batches = iter([['TAKEN', 'NEW-1', 'NEW-1'], ['NEW-2', 'NEW-3'], ['NEW-4']])
+        requested = []
+
+        def randomSerials(count, length):
+            requested.append(count)
+            return next(batches)
+
+        monkeypatch.setattr(keys, '_randomSerials', randomSerials)
+        assert sorted(keys.generateSerialKeys(3, taken=DBAPI.existingSerialKeys)) == ['NEW-1', 'NEW-2', 'NEW-3']
+        assert requested == [3, 2]
+        assert DBAPI.existingSerialKeys(['TAKEN', 'NEW-4'], chunkSize=1) == {'TAKEN'}
+        monkeypatch.undo()
+
+        output = tmp_path / 'serials.txt'
+        result = app.test_cli_runner().invoke(args=['generate-serials', '-n', '5', '--length', '10', '-o', str(output)])
+        assert result.exit_code == 0
+        assert len(set(output.read_text().splitlines())) == 5
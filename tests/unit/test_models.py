@@ -1,8 +1,13 @@
-from src import database_api as DBAPI
-from src.models import User, Product
+from src import create_app, archive, db, exports, logsink, migrations, pragmas, scheduler, database_api as DBAPI
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from src.models import User, Product, Validationlog
 from src import keys
 from src.handlers import products
 from werkzeug.security import check_password_hash
+import json
+import sqlite3
+import time
 
 
 def test_newuser(auth, client, app):
@@ -111,6 +116,7 @@ def test_key_registration(auth, client, app):
         product = DBAPI.createProduct(productspec.get('name'), productspec.get('category'), productspec.get(
             'image'), productspec.get('details'), product_keys[0], product_keys[1], product_keys[2])
 
+        DBAPI.createCustomer('Test Customer', 'test@customer.com', '123456789', 'PORTUGAL')
         serial = keys.generateSerialKey(10)
         keyidd = DBAPI.createKey(product.id, 1, serial, 3, 1000000000000000000)
         assert keyidd is not None
@@ -169,5 +175,399 @@ def test__admin_logs(auth, client, app):
 
         DBAPI.submitValidationLog(
             'OK', 'Key', '12.32.1234.221.1', 12342, 123432, 1234)
-        result = DBAPI.queryValidationLogs()
+        result = list(DBAPI.queryValidationLogs())
         assert len(result) > 0
+
+
+def test_validation_log_sink(tmp_path):
+    # GIVEN an application backed by a file database (the background writer needs a shared database)
+    # WHEN validation logs are submitted through the asynchronous sink
+    # THEN check they are only guaranteed to be stored once the sink is closed, in a single batch
+    app = create_app(database=str(tmp_path / 'sink.db'))
+    logsink.sink.flushInterval = 60
+    for index in range(5):
+        logsink.submit('SUCCESS', 'OKAY', '127.0.0.1',
+                       'api-key', 'serial-' + str(index), 'hwid')
+    logsink.sink.close()
+
+    with app.app_context():
+        assert len(list(DBAPI.queryValidationLogs('SUCCESS'))) == 5
+        DBAPI.submitValidationLogs([])
+        assert len(list(DBAPI.queryValidationLogs())) == 5
+
+
+def test_validation_log_sink_failures(app, tmp_path, monkeypatch):
+    # GIVEN a database error while the logs are written
+    # WHEN the rows are written on the caller's session
+    # THEN check the session is rolled back and stays usable
+    submitValidationLogs = DBAPI.submitValidationLogs
+
+    def failingSubmit(rows, commit=True):
+        db.session.add(Validationlog(id=1, timestamp=0))
+        db.session.flush()
+
+    with app.app_context():
+        DBAPI.submitValidationLog('OK', 'Key', '127.0.0.1', 'api-key', 'serial', 'hwid')
+        monkeypatch.setattr(DBAPI, 'submitValidationLogs', failingSubmit)
+        logsink.submit('OK', 'Key', '127.0.0.1', 'api-key', 'serial', 'hwid')
+        assert len(list(DBAPI.queryValidationLogs())) == 1
+
+    # WHEN the background writer fails to store a batch
+    # THEN check the rows are kept and stored by the next attempt
+    calls = []
+
+    def flakySubmit(rows, commit=True):
+        calls.append(len(rows))
+        if len(calls) == 1:
+            raise OperationalError('INSERT', {}, Exception('database is locked'))
+        submitValidationLogs(rows, commit)
+
+    monkeypatch.setattr(DBAPI, 'submitValidationLogs', flakySubmit)
+    sinkApp = create_app(database=str(tmp_path / 'sink.db'))
+    logsink.sink.flushInterval = 0.05
+    for index in range(3):
+        logsink.submit('SUCCESS', 'OKAY', '127.0.0.1', 'api-key', 'serial-' + str(index), 'hwid')
+    time.sleep(0.5)
+    logsink.sink.close()
+    with sinkApp.app_context():
+        monkeypatch.setattr(DBAPI, 'submitValidationLogs', submitValidationLogs)
+        assert len(list(DBAPI.queryValidationLogs('SUCCESS'))) == 3
+    assert calls[0] == 3 and calls[-1] == 3
+
+
+def test_validation_context(auth, client, app):
+    # GIVEN a Key model with one registered device
+    # WHEN the validation context is queried for a registered and an unregistered device
+    # THEN check the key, product and registration columns come back in a single row
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Testing product', 'CAT 003SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        DBAPI.createCustomer('Test', 'email@test.com', '87654321', 'Mozambique')
+        serial = keys.generateSerialKey(20)
+        keyid = DBAPI.createKey(product.id, 1, serial, 3, 1000000000000000000)
+        DBAPI.addRegistration(keyid, 'HWID-1')
+
+        context = DBAPI.getValidationContext(product.id, serial, 'HWID-1')
+        assert context.id == keyid
+        assert context.productname == 'Testing product'
+        assert context.devices == 1
+        assert context.registrationid is not None
+
+        assert DBAPI.getValidationContext(product.id, serial, 'HWID-2').registrationid is None
+        assert DBAPI.getValidationContext(product.id + 1, serial, 'HWID-1') is None
+
+
+def test_claim_seat(auth, client, app):
+    # GIVEN a Key model limited to two devices
+    # WHEN devices claim seats, including a repeated device and one over the limit
+    # THEN check the device count never exceeds 'maxdevices' and no device is linked twice
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Testing product', 'CAT 003SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        DBAPI.createCustomer('Test', 'email@test.com', '87654321', 'Mozambique')
+        keyid = DBAPI.createKey(product.id, 1, keys.generateSerialKey(20), 2, 1000000000000000000)
+
+        assert DBAPI.claimSeat(keyid, 'HWID-1')[0] == DBAPI.SEAT_CLAIMED
+        assert DBAPI.claimSeat(keyid, 'HWID-1')[0] == DBAPI.SEAT_REGISTERED
+        assert DBAPI.claimSeat(keyid, 'HWID-2')[0] == DBAPI.SEAT_CLAIMED
+        assert DBAPI.claimSeat(keyid, 'HWID-3')[0] == DBAPI.SEAT_FULL
+
+        keyObject = DBAPI.getKeyData(keyid)
+        assert keyObject.devices == 2
+        assert keyObject.status == 1
+        assert sorted(reg.hardwareID for reg in DBAPI.getKeyHWIDs(keyid)) == ['HWID-1', 'HWID-2']
+
+        DBAPI.deleteRegistrationOfHWID(keyid, 'HWID-1')
+        assert DBAPI.getKeyData(keyid).devices == 1
+        assert DBAPI.claimSeat(keyid, 'HWID-3')[0] == DBAPI.SEAT_CLAIMED
+
+
+def test_sqlite_pragmas(tmp_path):
+    # GIVEN an application backed by a database file
+    # WHEN a connection is opened
+    # THEN check the configured PRAGMAs are in effect
+    app = create_app(False, str(tmp_path / 'sqlite.db'))
+    with app.app_context():
+        settings = pragmas.activeSettings()
+        assert settings['journal_mode'] == 'wal'
+        assert settings['synchronous'] == 1
+        assert settings['busy_timeout'] == app.config['SQLITE_BUSY_TIMEOUT']
+        assert settings['foreign_keys'] == 1
+
+
+def test_indexes(tmp_path, monkeypatch, capsys):
+    # GIVEN a database created before the indexes were declared
+    # WHEN the application starts again (with the query plan diagnostic enabled)
+    # THEN check the missing indexes are created and the lookups use them
+    database = str(tmp_path / 'sqlite.db')
+    app = create_app(False, database)
+    with app.app_context():
+        db.session.execute(text('DROP INDEX ix_key_productid_status'))
+        db.session.execute(text('DROP INDEX ix_validationlog_timestamp_result'))
+        db.session.execute(text('UPDATE schema_version SET version = 2'))
+        db.session.commit()
+
+    monkeypatch.setenv('SQLITE_EXPLAIN', '1')
+    app = create_app(False, database)
+    with app.app_context():
+        indexes = {row[0] for row in db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+        assert {'ix_key_productid_status', 'ix_validationlog_timestamp_result'} <= indexes
+
+        capsys.readouterr()
+        DBAPI.getKeys(1)
+        output = capsys.readouterr().out
+        assert 'EXPLAIN QUERY PLAN :: getKeys' in output
+        assert 'USING INDEX ix_key_productid_status' in output
+
+
+def test_migrations(tmp_path):
+    # GIVEN a database created before the schema was versioned (no expiry model columns, duplicated devices)
+    # WHEN the application starts
+    # THEN check the schema is migrated in place and the existing data is kept
+    database = str(tmp_path / 'sqlite.db')
+    app = create_app(False, database)
+    with app.app_context():
+        db.session.execute(text('DROP TABLE schema_version'))
+        db.session.execute(text('DROP TABLE registration'))
+        db.session.execute(text('DROP TABLE "key"'))
+        db.session.execute(text('CREATE TABLE "key" (id INTEGER PRIMARY KEY, productid INTEGER NOT NULL, '
+                                'clientid INTEGER NOT NULL, serialkey VARCHAR(100) UNIQUE, maxdevices INTEGER, '
+                                'devices INTEGER, status INTEGER, expirydate INTEGER NOT NULL)'))
+        db.session.execute(text('CREATE TABLE registration (id INTEGER PRIMARY KEY, "keyID" INTEGER NOT NULL, '
+                                '"hardwareID" VARCHAR(200) NOT NULL)'))
+        db.session.execute(text("INSERT INTO \"key\" VALUES (1, 1, 1, 'AAAAA-BBBBB', 5, 3, 1, 0), "
+                                "(2, 1, 1, 'CCCCC-DDDDD', 1, 0, 0, 1000)"))
+        db.session.execute(text("INSERT INTO registration (\"keyID\", \"hardwareID\") VALUES (1, 'A'), (1, 'A'), (1, 'B')"))
+        db.session.execute(text("INSERT INTO validationlog (timestamp, result, type, ipaddress, \"apiKey\", \"serialKey\", "
+                                "\"hardwareID\") VALUES (86400, 'SUCCESS', '', '', 'unknown', '', ''), "
+                                "(86401, 'SUCCESS', '', '', 'unknown', '', ''), (172800, 'ERROR', '', '', 'unknown', '', '')"))
+        db.session.commit()
+
+    app = create_app(False, database)
+    with app.app_context():
+        assert migrations.currentVersion() == migrations.LATEST_VERSION
+        keyObject = DBAPI.getKeyData(1)
+        assert keyObject.serialkey == 'AAAAA-BBBBB'
+        assert keyObject.expirytype == 0
+        assert keyObject.activationdate is None
+        assert keyObject.devices == 2
+        assert DBAPI.claimSeat(1, 'A')[0] == DBAPI.SEAT_REGISTERED
+        assert (keyObject.effectiveexpiry, DBAPI.getKeyData(2).effectiveexpiry) == (None, 1000)
+        assert sorted(db.session.execute(text('SELECT day, productid, result, count FROM validationstat'))) == \
+            [(86400, 0, 'SUCCESS', 2), (172800, 0, 'ERROR', 1)]
+        # The tables were recreated without their search triggers: the step adds them back and indexes the rows
+        assert [result.id for result in DBAPI.search('AAAAA', ['license'])] == [1]
+        DBAPI.createKey(1, 1, 'EEEEE-FFFFF', 1, 0)
+        assert [result.label for result in DBAPI.search('EEEEE', ['license'])] == ['EEEEE-FFFFF']
+
+
+def test_search_index_migration(tmp_path):
+    # GIVEN a search index step that stopped after creating the table (no customer trigger, no customer rows)
+    # WHEN the application starts again
+    # THEN check the step completes the index instead of skipping it
+    database = str(tmp_path / 'sqlite.db')
+    app = create_app(False, database)
+    with app.app_context():
+        DBAPI.createCustomer('Indexed Customer', 'indexed@test.com', '1234', 'Portugal')
+        db.session.execute(text('DROP TRIGGER search_client_insert'))
+        db.session.execute(text("DELETE FROM search_index WHERE kind = 'customer'"))
+        db.session.execute(text('UPDATE schema_version SET version = 4'))
+        db.session.commit()
+        assert DBAPI.search('Indexed', ['customer']) == []
+
+    app = create_app(False, database)
+    with app.app_context():
+        assert [result.label for result in DBAPI.search('Indexed', ['customer'])] == ['Indexed Customer']
+        DBAPI.createCustomer('Another Customer', 'another@test.com', '1234', 'Portugal')
+        assert [result.label for result in DBAPI.search('Another', ['customer'])] == ['Another Customer']
+        assert db.session.execute(text("SELECT COUNT(*) FROM search_index WHERE kind = 'customer'")).scalar() == 2
+
+
+def test_concurrent_migrations(tmp_path, monkeypatch, capsys):
+    # GIVEN a worker that runs the 'effectiveexpiry' step while another one waits for the write lock
+    # WHEN the waiting worker gets the lock
+    # THEN check it reads the version again and skips the step instead of adding the column twice
+    database = str(tmp_path / 'sqlite.db')
+    app = create_app(False, database)
+    with app.app_context():
+        db.session.execute(text('DROP INDEX ix_key_productid_effectiveexpiry'))
+        db.session.execute(text('ALTER TABLE "key" DROP COLUMN effectiveexpiry'))
+        db.session.execute(text('UPDATE schema_version SET version = 6'))
+        db.session.commit()
+
+    lock = migrations._lock  # pylint: disable=W0212
+
+    def otherWorkerFirst():
+        if 'effectiveexpiry' not in migrations._columns('key'):  # pylint: disable=W0212
+            other = sqlite3.connect(database, isolation_level=None)
+            other.execute('BEGIN IMMEDIATE')
+            other.execute('ALTER TABLE "key" ADD COLUMN effectiveexpiry INTEGER')
+            other.execute('UPDATE schema_version SET version = 7')
+            other.execute('COMMIT')
+            other.close()
+        lock()
+
+    monkeypatch.setattr(migrations, '_lock', otherWorkerFirst)
+    capsys.readouterr()
+    app = create_app(False, database)
+    assert 'to version 7' not in capsys.readouterr().out
+    with app.app_context():
+        assert migrations.currentVersion() == migrations.LATEST_VERSION
+        assert 'effectiveexpiry' in migrations._columns('key')  # pylint: disable=W0212
+
+
+def test_license_rows(auth, client, app):
+    # GIVEN a product with two licenses, one of them with two registered devices
+    # WHEN the licenses of the product are listed
+    # THEN check each row carries the customer name and the hardware IDs, fetched with a single query
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Testing product', 'CAT 003SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        DBAPI.createCustomer('Test', 'email@test.com', '87654321', 'Mozambique')
+        first = DBAPI.createKey(product.id, 1, 'AAAAA-BBBBB', 3, 0)
+        second = DBAPI.createKey(product.id, 1, 'AAAAA-CCCCC', 3, 0)
+        DBAPI.claimSeat(first, 'HWID-1')
+        DBAPI.claimSeat(first, 'HWID-2')
+        productID = product.id
+
+        statements = []
+
+        def countStatement(conn, cursor, statement, *args):  # pylint: disable=W0613
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', countStatement)
+        try:
+            licenses = DBAPI.getKeys(productID)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', countStatement)
+        assert len(statements) == 1
+        assert [row.id for row in licenses] == [first, second]
+        assert sorted(licenses[0].hwids) == ['HWID-1', 'HWID-2']
+        assert licenses[1].hwids == ()
+        assert licenses[0].name == 'Test'
+        assert licenses[0].devices == 2
+
+
+def test_expiry_sweep(auth, client, app):
+    # GIVEN licenses of both expiry models, some of them past their deadline
+    # WHEN the product page runs the daily expiry sweep
+    # THEN check only the licenses that reached their effective expiry are marked as expired
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Sweep product', 'CAT 006SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        productID = product.id
+        DBAPI.createCustomer('Test Customer', 'test@customer.com', '123456789', 'PORTUGAL')
+        now = int(time.time())
+        pastFixed = DBAPI.createKey(productID, 1, 'SWEEP-00001', 1, now - 3 * 86400)
+        futureFixed = DBAPI.createKey(productID, 1, 'SWEEP-00002', 1, now + 3 * 86400)
+        perpetual = DBAPI.createKey(productID, 1, 'SWEEP-00003', 1, 0)
+        pastDays = DBAPI.createKey(productID, 1, 'SWEEP-00004', 1, 0, 1, 10)
+        notActivated = DBAPI.createKey(productID, 1, 'SWEEP-00005', 1, 0, 1, 10)
+        DBAPI.claimSeat(pastDays, 'HWID-SWEEP')
+
+        assert DBAPI.getKeyData(pastFixed).effectiveexpiry == now - 3 * 86400
+        assert DBAPI.getKeyData(perpetual).effectiveexpiry is None
+        assert DBAPI.getKeyData(notActivated).effectiveexpiry is None
+        assert DBAPI.getKeyData(pastDays).effectiveexpiry - now in (10 * 86400, 10 * 86400 + 1)
+
+        # Activated 20 days ago
+        db.session.execute(text('UPDATE "key" SET activationdate = activationdate - 1728000, '
+                                'effectiveexpiry = effectiveexpiry - 1728000 WHERE id = :id'), {'id': pastDays})
+        db.session.commit()
+        DBAPI.updateKeyStatesFromProduct(productID)
+        statuses = {keyID: DBAPI.getKeyData(keyID).status
+                    for keyID in (pastFixed, futureFixed, perpetual, pastDays, notActivated)}
+        assert statuses == {pastFixed: 3, futureFixed: 0, perpetual: 0, pastDays: 3, notActivated: 0}
+
+
+def test_scheduler(auth, client, app):
+    # GIVEN an expired license and a validation log that was not counted yet
+    # WHEN the maintenance jobs run in two "workers"
+    # THEN check each job runs once, records its run and does its work
+    with app.app_context():
+        product_keys = keys.create_product_keys()
+        product = DBAPI.createProduct('Scheduled product', 'CAT 007SA', '', 'Testing product only',
+                                      product_keys[0], product_keys[1], product_keys[2])
+        DBAPI.createCustomer('Test Customer', 'test@customer.com', '123456789', 'PORTUGAL')
+        keyID = DBAPI.createKey(product.id, 1, 'SCHED-00001', 1, int(time.time()) - 60)
+        now = int(time.time())
+        db.session.execute(text("INSERT INTO validationlog (timestamp, result, type, ipaddress, \"apiKey\", "
+                                "\"serialKey\", \"hardwareID\") VALUES (:now, 'SUCCESS', '', '', '', '', '')"),
+                           {'now': now})
+        db.session.commit()
+
+        class OtherWorker(scheduler.MaintenanceScheduler):
+            owner = 'other-host:1'
+
+        first = scheduler.MaintenanceScheduler(app, enabled=False)
+        second = OtherWorker(app, enabled=False)
+        assert first.runDueJobs() == list(scheduler.JOBS)
+        assert second.runDueJobs() == []
+
+        assert DBAPI.getKeyData(keyID).status == 3
+        assert DBAPI.queryValidationsStats() == (1, 0)
+        jobs = {job.name: job for job in DBAPI.getJobs()}
+        assert all(job.runs == 1 and job.lastduration is not None and job.leaseowner is None for job in jobs.values())
+        assert jobs['expiry-sweep'].lastresult == '1 license(s) expired'
+        assert jobs['validation-stats'].lastresult == jobs['optimize'].lastresult == 'OK'
+        assert jobs['optimize'].nextrun >= now + app.config['JOB_OPTIMIZE_INTERVAL']
+
+        # A job leased by a live worker is not run by another one, even when forced
+        assert DBAPI.acquireJobLease('optimize', 'other-host:1', int(time.time()), 60, force=True)
+        assert first.runDueJobs(['optimize'], force=True) == []
+
+
+def test_validation_log_retention(app, tmp_path, monkeypatch):
+    # GIVEN validation logs spread over four old days and one recent day
+    # WHEN the logs of the old days are moved to the archive, in chunks smaller than a day
+    # THEN check they leave the table but are still listed, exported and counted
+    monkeypatch.setattr(archive, 'logArchive', archive.ValidationLogArchive(str(tmp_path / 'archive')))
+    day = 100 * 86400
+    now = int(time.time())
+    with app.app_context():
+        DBAPI.submitValidationLogs([
+            {'timestamp': day + index * 43200, 'result': 'SUCCESS' if index % 2 else 'ERROR', 'type': 'Validation',
+             'ipaddress': '127.0.0.1', 'apiKey': 'api-key', 'serialKey': f'SERIAL-{index}', 'hardwareID': 'HWID'}
+            for index in range(8)] + [
+            {'timestamp': now, 'result': 'SUCCESS', 'type': 'Validation', 'ipaddress': '127.0.0.1',
+             'apiKey': 'api-key', 'serialKey': 'SERIAL-NOW', 'hardwareID': 'HWID'}])
+        stats = DBAPI.queryValidationsStats()
+
+        # A previous run that stopped after writing the file of the first day but before deleting its logs
+        firstDay = DBAPI.streamValidationLogs({'timestampEnd': day + 86399})
+        assert archive.logArchive.append(day, firstDay) == 2
+
+        assert DBAPI.archiveValidationLogs(day + 3 * 86400 + 60, chunkSize=1) == 4
+        assert archive.logArchive.days() == [day, day + 86400, day + 2 * 86400]
+        assert archive.logArchive.path(day).endswith('validationlogs-1970-04-11.ndjson.gz')
+        remaining = db.session.execute(text("SELECT \"serialKey\" FROM validationlog ORDER BY id")).scalars().all()
+        assert remaining == ['SERIAL-6', 'SERIAL-7', 'SERIAL-NOW']
+
+        # Archived and live days are read together, without duplicates
+        logs = DBAPI.queryValidationLogs()
+        assert sorted(log.serialKey for log in logs) == [f'SERIAL-{index}' for index in range(8)] + ['SERIAL-NOW']
+        assert [log.serialKey for log in DBAPI.queryValidationLogs('SUCCESS', day + 43200, day + 4 * 43200)] == [
+            'SERIAL-3', 'SERIAL-1']
+
+        # Pages are read newest first; the archive is only opened once the table runs out of rows
+        def unreadable(*args):
+            raise AssertionError('The archive was read')
+
+        with monkeypatch.context() as patch:
+            patch.setattr(archive.logArchive, 'read', unreadable)
+            page = list(DBAPI.queryValidationLogs(limit=3))
+        assert [log.serialKey for log in page] == ['SERIAL-NOW', 'SERIAL-7', 'SERIAL-6']
+        page = list(DBAPI.queryValidationLogs(before=(page[-1].timestamp, page[-1].id), limit=3))
+        assert [log.serialKey for log in page] == ['SERIAL-5', 'SERIAL-4', 'SERIAL-3']
+        page = list(DBAPI.queryValidationLogs(before=(page[-1].timestamp, page[-1].id)))
+        assert [log.serialKey for log in page] == ['SERIAL-2', 'SERIAL-1', 'SERIAL-0']
+        lines = b''.join(exports.exportValidationLogs({'result': 'ERROR'}, chunkRows=1)).decode('utf-8').splitlines()
+        assert [json.loads(line)['serialKey'] for line in lines] == ['SERIAL-0', 'SERIAL-2', 'SERIAL-4', 'SERIAL-6']
+        assert DBAPI.queryValidationsStats() == stats
+
+        # Nothing left to move
+        assert DBAPI.archiveValidationLogs(day + 3 * 86400 + 60) == 0